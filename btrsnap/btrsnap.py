@@ -6,10 +6,136 @@ btrsnap is a BTRFS wrapper to simplify working with timestamped snapshots.
 
 import os
 import re
+import sys
+import json
+import errno
+import contextlib
+import uuid
+import time
+import fcntl
+import shutil
+import shlex
+import queue
+import posixpath
+import tempfile
+import struct
+import tarfile
+import hashlib
+import zlib
+import lzma
+import bisect
+import operator
+import statistics
+import random
+import socket
+import socketserver
+import math
+import collections
+import functools
 import datetime
+import threading
 import subprocess
 
 
+TIMESTAMP_PATTERN = re.compile(
+    r'^\d{4}-\d{2}-\d{2}-(\d{4}|\d{6}(\.\d{6})?)$')
+# Timestamp resolutions: YYYY-MM-DD-####, YYYY-MM-DD-HHMMSS and
+# YYYY-MM-DD-HHMMSS.ffffff
+RESOLUTIONS = ('day', 'second', 'microsecond')
+SNAPSHOT_KEY_BITS = 40
+SNAPSHOT_KEY_MASK = (1 << SNAPSHOT_KEY_BITS) - 1
+# set in the low bits of time of day timestamps, which sort after all
+# YYYY-MM-DD-#### timestamps of the same day
+SNAPSHOT_KEY_TIME = 1 << (SNAPSHOT_KEY_BITS - 1)
+SNAPSHOT_SORT_KEY = operator.attrgetter('key')
+
+INDEX_FILE = '.btrsnap-index'
+INDEX_VERSION = 1
+# marks a directory as a subvolume of SimulatedBackend
+SIMULATED_SUBVOLUME = '.btrsnap-subvolume'
+# BTRFS ioctl interface, from linux/btrfs.h
+BTRFS_IOCTL_MAGIC = 0x94
+BTRFS_SUBVOL_RDONLY = 1 << 1
+BTRFS_PATH_NAME_MAX = 4087
+BTRFS_SUBVOL_NAME_MAX = 4039
+# struct btrfs_ioctl_vol_args: __s64 fd; char name[BTRFS_PATH_NAME_MAX + 1]
+BTRFS_VOL_ARGS = struct.Struct('=q{}s'.format(BTRFS_PATH_NAME_MAX + 1))
+# struct btrfs_ioctl_vol_args_v2: __s64 fd; __u64 transid; __u64 flags;
+# __u64 unused[4]; char name[BTRFS_SUBVOL_NAME_MAX + 1]
+BTRFS_VOL_ARGS_V2 = struct.Struct('=qQQ32s{}s'.format(
+    BTRFS_SUBVOL_NAME_MAX + 1))
+
+
+def _btrfs_iow(number, size):
+    return 1 << 30 | size << 16 | BTRFS_IOCTL_MAGIC << 8 | number
+
+
+BTRFS_IOC_SNAP_DESTROY = _btrfs_iow(15, BTRFS_VOL_ARGS.size)
+BTRFS_IOC_SNAP_CREATE_V2 = _btrfs_iow(23, BTRFS_VOL_ARGS_V2.size)
+BTRFS_IOC_SYNC = BTRFS_IOCTL_MAGIC << 8 | 8
+
+# Snapshots deleted per btrfs subvolume delete. When to wait for the deletions
+# to be committed: after the whole batch or after every snapshot.
+DELETE_BATCH_SIZE = 100
+COMMIT_MODES = ('after', 'each')
+# most clone sources passed to btrfs send along with the parent
+CLONE_SOURCES = 2
+# bytes moved per splice or copy, seconds between progress reports
+PUMP_CHUNK = 1024 * 1024
+PUMP_REPORT_SECONDS = 1
+MEGABYTE = 1000 * 1000
+# seconds a shared ssh connection outlives its last command
+TRANSPORT_PERSIST_SECONDS = 60
+
+# manifest of an export directory, size of the chunk files in bytes
+EXPORT_MANIFEST = 'btrsnap-manifest.json'
+EXPORT_VERSION = 1
+EXPORT_CHUNK_SIZE = 1000 * MEGABYTE
+# resumable sends: spool directory in SendPATH and ReceivePATH, chunk size
+SPOOL_DIR = '.btrsnap-spool'
+SPOOL_CHUNK_SIZE = 100 * MEGABYTE
+# sidecar file of send stream checksums in SendPATH and ReceivePATH, hash
+# algorithm, buffers in flight to the hashing thread
+CHECKSUM_FILE = '.btrsnap-checksums'
+CHECKSUM_VERSION = 1
+CHECKSUM_ALGORITHM = 'sha256'
+CHECKSUM_BUFFERS = 4
+
+# sidecar file of snapshot sizes in the PATH given to list --sizes
+SIZE_FILE = '.btrsnap-sizes'
+SIZE_VERSION = 1
+SIZE_COLUMNS = '{:<24} {:>10} {:>10}'
+
+# retention buckets from the shortest period to the longest, units of ages
+RETENTION_BUCKETS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+AGE_UNITS = {'h': datetime.timedelta(hours=1),
+             'd': datetime.timedelta(days=1),
+             'w': datetime.timedelta(weeks=1),
+             'm': datetime.timedelta(days=30),
+             'y': datetime.timedelta(days=365)}
+
+# suffixes of free space targets, the first batch of delete --free
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+FREE_FIRST_BATCH = 1
+
+# most a scheduled run is delayed, as a fraction of its interval, and the
+# keys a job of the daemon schedule may have
+DAEMON_JITTER = 0.1
+DAEMON_JOB_KEYS = ('name', 'path', 'recursive', 'snap_every', 'resolution',
+                   'keep', 'max_age', 'send_to', 'send_every', 'via', 'scan',
+                   'resumable', 'checksum') + RETENTION_BUCKETS
+
+QUEUE_FILE = '.btrsnap-queue'
+QUEUE_VERSION = 1
+# drain runs remembered for throughput, seconds between backlog checks
+QUEUE_RUNS = 20
+QUEUE_POLL_SECONDS = 5
+
+# A directory changed this close (in ns) to the moment it was scanned can
+# change again without its mtime moving, so such entries are always rescanned.
+INDEX_RACY_NS = 2 * 10 ** 9
+
+
 class PathError(Exception):
     '''
     Path does not exist on the filesystem
@@ -54,26 +180,380 @@ class Path:
             raise PathError('Path not valid')
 
 
+def _subdirectories(path, pattern=None):
+    '''
+    List the names of directories inside path.
+
+    Uses os.scandir so the directory type comes from d_type and only entries
+    of unknown type or symlinks need an extra stat call.
+
+    Args:
+        * path (str): path on the filesystem.
+        * pattern (re.Pattern): only return names matching pattern. Names are
+          matched before the type check to avoid needless stat calls.
+
+    Returns:
+        * (list(str)): names of directories inside path.
+    '''
+    names = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if pattern is not None and not pattern.match(entry.name):
+                continue
+            if entry.is_dir():
+                names.append(entry.name)
+    return names
+
+
+class Snapshot:
+    '''
+    A btrsnap timestamp parsed once into an integer sort key.
+
+    Snapshots order, compare and hash on their key instead of their name, so
+    sorting and set operations on large histories stay cheap. A Snapshot
+    also compares equal to its name and can be passed to os.path functions,
+    so it can be used wherever a timestamp string was used before.
+
+    Three formats are understood:
+
+        * YYYY-MM-DD-#### (resolution 'day'): a counter per day.
+        * YYYY-MM-DD-HHMMSS (resolution 'second'): the time of day.
+        * YYYY-MM-DD-HHMMSS.ffffff (resolution 'microsecond').
+
+    Time of day snapshots sort after every counter snapshot of the same day.
+
+    Args:
+        * name (str): btrsnap timestamp.
+
+    Attributes:
+        * name (str): the timestamp.
+        * key (int): date ordinal in the high bits. The low SNAPSHOT_KEY_BITS
+          bits hold the counter, or SNAPSHOT_KEY_TIME with the microsecond of
+          the day and a sub-second flag.
+
+    Raises:
+        * ValueError: name is not a valid btrsnap timestamp.
+    '''
+    __slots__ = ('name', 'key')
+
+    def __init__(self, name):
+        if not TIMESTAMP_PATTERN.match(name):
+            raise ValueError('{!r} is not a btrsnap timestamp'.format(name))
+        date = datetime.date(int(name[0:4]), int(name[5:7]), int(name[8:10]))
+        if len(name) == 15:
+            low = int(name[11:15])
+        else:
+            time = datetime.time(int(name[11:13]), int(name[13:15]),
+                                 int(name[15:17]))
+            micros = (time.hour * 3600 + time.minute * 60
+                      + time.second) * 10 ** 6
+            if len(name) == 17:
+                low = SNAPSHOT_KEY_TIME | micros << 1
+            else:
+                low = SNAPSHOT_KEY_TIME | (micros + int(name[18:24])) << 1 | 1
+        self.name = name
+        self.key = date.toordinal() << SNAPSHOT_KEY_BITS | low
+
+    @classmethod
+    def from_date(cls, date, counter):
+        '''
+        Args:
+            * date (datetime.date): day of the snapshot.
+            * counter (int): number of the snapshot on that day.
+
+        Returns:
+            * (Snapshot): snapshot named YYYY-MM-DD-####.
+        '''
+        return cls('{}-{:04d}'.format(date.isoformat(), counter))
+
+    @classmethod
+    def from_datetime(cls, when, resolution='second'):
+        '''
+        Args:
+            * when (datetime.datetime): time of the snapshot.
+            * resolution (str): 'second' or 'microsecond'.
+
+        Returns:
+            * (Snapshot): snapshot named YYYY-MM-DD-HHMMSS or
+              YYYY-MM-DD-HHMMSS.ffffff.
+        '''
+        if resolution == 'microsecond':
+            return cls(when.strftime('%Y-%m-%d-%H%M%S.%f'))
+        return cls(when.strftime('%Y-%m-%d-%H%M%S'))
+
+    @property
+    def date(self):
+        '''
+        (datetime.date): day the snapshot was taken.
+        '''
+        return datetime.date.fromordinal(self.key >> SNAPSHOT_KEY_BITS)
+
+    @property
+    def resolution(self):
+        '''
+        (str): 'day', 'second' or 'microsecond'.
+        '''
+        low = self.key & SNAPSHOT_KEY_MASK
+        if not low & SNAPSHOT_KEY_TIME:
+            return 'day'
+        return 'microsecond' if low & 1 else 'second'
+
+    @property
+    def counter(self):
+        '''
+        (int): number of the snapshot on its day, None for time of day
+        snapshots.
+        '''
+        low = self.key & SNAPSHOT_KEY_MASK
+        if low & SNAPSHOT_KEY_TIME:
+            return None
+        return low
+
+    @property
+    def datetime(self):
+        '''
+        (datetime.datetime): time the snapshot was taken. YYYY-MM-DD-####
+        snapshots are taken at midnight.
+        '''
+        low = self.key & SNAPSHOT_KEY_MASK
+        when = datetime.datetime.combine(self.date, datetime.time())
+        if low & SNAPSHOT_KEY_TIME:
+            micros = (low & ~SNAPSHOT_KEY_TIME) >> 1
+            when += datetime.timedelta(microseconds=micros)
+        return when
+
+    def __str__(self):
+        return self.name
+
+    def __fspath__(self):
+        return self.name
+
+    def __repr__(self):
+        return 'Snapshot({!r})'.format(self.name)
+
+    def __hash__(self):
+        # consistent with equality to the name; str caches its own hash
+        return hash(self.name)
+
+    def __eq__(self, other):
+        if isinstance(other, Snapshot):
+            return self.key == other.key
+        if isinstance(other, str):
+            return self.name == other
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Snapshot):
+            return self.key < other.key
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, Snapshot):
+            return self.key <= other.key
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, Snapshot):
+            return self.key > other.key
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, Snapshot):
+            return self.key >= other.key
+        return NotImplemented
+
+
+def _snapshots(names):
+    '''
+    Parse timestamp names into Snapshots, newest first.
+
+    Args:
+        * names (iterable(str)): names matching TIMESTAMP_PATTERN.
+
+    Returns:
+        * (list(Snapshot)): names that are valid dates, sorted newest first.
+    '''
+    snapshots = []
+    for name in names:
+        try:
+            snapshots.append(Snapshot(name))
+        except ValueError:
+            pass
+    snapshots.sort(key=SNAPSHOT_SORT_KEY, reverse=True)
+    return snapshots
+
+
+class SnapshotIndex:
+    '''
+    Cache of the SNAPPATHs inside parent directories.
+
+    Every parent directory gets an index file (.btrsnap-index) recording,
+    for each of its SNAPPATHs, the snapshot names, the symlink target and
+    whether the SNAPPATH is valid. Entries are keyed on the directory mtime,
+    so only SNAPPATHs that changed since the last run are scanned again.
+    Index files are loaded lazily, one per parent directory, and written by
+    save().
+
+    The index file is rewritten in place rather than replaced, so saving it
+    does not change the mtime of the parent directory.
+    '''
+
+    def __init__(self):
+        self._parents = {}
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+    def _parent(self, parent):
+        '''
+        Returns:
+            * (dict): the index data of parent, loading it if needed.
+        '''
+        with self._lock:
+            if parent not in self._parents:
+                self._parents[parent] = self._load(parent)
+            return self._parents[parent]
+
+    @staticmethod
+    def _load(parent):
+        try:
+            with open(os.path.join(parent, INDEX_FILE)) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+            data = {'version': INDEX_VERSION, 'mtime': None, 'scanned': None,
+                    'subdirectories': [], 'entries': {}}
+        return data
+
+    @staticmethod
+    def _fresh(record, mtime):
+        return (record.get('mtime') == mtime
+                and record['scanned'] - mtime > INDEX_RACY_NS)
+
+    @staticmethod
+    def _scan(path):
+        '''
+        Scan a SNAPPATH once for both snapshots and symlinks.
+
+        Returns:
+            * (dict): index entry for path.
+        '''
+        snapshots = []
+        links = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    links.append(entry.name)
+                if TIMESTAMP_PATTERN.match(entry.name) and entry.is_dir():
+                    snapshots.append(entry.name)
+        if len(links) == 1:
+            target = os.path.realpath(os.path.join(path, links[0]))
+            error = None
+        else:
+            target = None
+            error = ('there must be exactly 1 symlink pointing to a'
+                     ' target BTRFS subvolume in snapshot'
+                     ' directory {}'.format(path))
+        return {'snapshots': snapshots, 'target': target, 'error': error}
+
+    def entry(self, path):
+        '''
+        Look up a SNAPPATH, rescanning it if its mtime changed.
+
+        Args:
+            * path (str): absolute path of a SNAPPATH.
+
+        Returns:
+            * (dict): with keys snapshots (list(str), newest first),
+              target (str or None) and error (str or None).
+        '''
+        parent, name = os.path.split(path)
+        data = self._parent(parent)
+        mtime = os.stat(path).st_mtime_ns
+        entry = data['entries'].get(name)
+        if entry is None or not self._fresh(entry, mtime):
+            entry = self._scan(path)
+            entry['mtime'] = mtime
+            entry['scanned'] = time.time_ns()
+            with self._lock:
+                data['entries'][name] = entry
+                self._dirty.add(parent)
+        return entry
+
+    def snapshots(self, path):
+        '''
+        Returns:
+            * (list(Snapshot)): snapshots inside the SNAPPATH path, newest
+              first.
+        '''
+        return _snapshots(self.entry(path)['snapshots'])
+
+    def subdirectories(self, parent):
+        '''
+        Returns:
+            * (list(str)): names of the directories inside parent.
+        '''
+        data = self._parent(parent)
+        mtime = os.stat(parent).st_mtime_ns
+        if not self._fresh(data, mtime):
+            subdirectories = set(_subdirectories(parent))
+            with self._lock:
+                data['subdirectories'] = sorted(subdirectories)
+                data['entries'] = {name: entry for name, entry
+                                   in data['entries'].items()
+                                   if name in subdirectories}
+                data['mtime'] = mtime
+                data['scanned'] = time.time_ns()
+                self._dirty.add(parent)
+        return list(data['subdirectories'])
+
+    def save(self):
+        '''
+        Write the index files of every parent directory that changed.
+        '''
+        with self._lock:
+            for parent in sorted(self._dirty):
+                fd = os.open(os.path.join(parent, INDEX_FILE),
+                             os.O_RDWR | os.O_CREAT, 0o644)
+                with open(fd, 'r+') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    f.truncate()
+                    json.dump(self._parents[parent], f,
+                              separators=(',', ':'))
+            self._dirty.clear()
+
+
+def _index(index):
+    '''
+    Returns:
+        * (SnapshotIndex): INDEX when it is a SnapshotIndex, which keeps what
+          it read in memory between calls, a new one when INDEX is true,
+          otherwise None.
+    '''
+    if isinstance(index, SnapshotIndex):
+        return index
+    return SnapshotIndex() if index else None
+
+
 class SnapshotsMixin:
     '''
     Mixin to display btrsnap snapshots in self.path
     '''
+    index = None
 
     def snapshots(self):
         '''
         List folders in self.path with a name matching a btrsnap timestamp.
 
         Returns:
-            * (list(str)): a list of directories inside self.path that
-              match the btrsnap timestamp YYYY-MM-DD-####
+            * (list(Snapshot)): a list of directories inside self.path that
+              match a btrsnap timestamp (YYYY-MM-DD-####, YYYY-MM-DD-HHMMSS
+              or YYYY-MM-DD-HHMMSS.ffffff), newest first.
         '''
-        pattern = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{4}$')
-        contents = os.listdir(path=self.path)
-        contents = [d for d in contents
-                    if os.path.isdir(os.path.join(self.path, d))
-                    and re.search(pattern, d)]
-        contents.sort(reverse=True)
-        return contents
+        if self.index is not None:
+            return self.index.snapshots(self.path)
+        return _snapshots(_subdirectories(self.path, TIMESTAMP_PATTERN))
 
 
 class SnapDeep(Path):
@@ -82,13 +562,19 @@ class SnapDeep(Path):
 
     Args:
         * path (str): path on the filesystem.
+        * index (SnapshotIndex): optional index to read subdirectories and
+          SnapPaths from.
 
     Attributes:
         * path (str): absolute path on the filesystem.
+        * index (SnapshotIndex): index or None.
 
     Raises:
         * PathError
     '''
+    def __init__(self, path, index=None):
+        Path.__init__(self, path)
+        self.index = index
 
     def snap_paths(self):
         '''
@@ -97,12 +583,14 @@ class SnapDeep(Path):
             of self.path.
         '''
         snap_paths = []
-        contents = os.listdir(self.path)
-        contents = [os.path.join(self.path, d) for d in contents
-                    if os.path.isdir(os.path.join(self.path, d))]
+        if self.index is not None:
+            contents = self.index.subdirectories(self.path)
+        else:
+            contents = _subdirectories(self.path)
         for content in contents:
             try:
-                snap_paths.append(SnapPath(content))
+                snap_paths.append(SnapPath(os.path.join(self.path, content),
+                                           index=self.index))
             except Exception:
                 pass
         return snap_paths
@@ -115,13 +603,19 @@ class ReceiveDeep(Path):
 
     Args:
         * path (str): path on the filesystem.
+        * index (SnapshotIndex): optional index to read subdirectories and
+          ReceivePaths from.
 
     Attributes:
         * path (str): absolute path on the filesystem.
+        * index (SnapshotIndex): index or None.
 
     Raises:
         * PathError
     '''
+    def __init__(self, path, index=None):
+        Path.__init__(self, path)
+        self.index = index
 
     def receive_paths(self):
         '''
@@ -130,13 +624,14 @@ class ReceiveDeep(Path):
             subdirectory of self.path.
         '''
         receive_paths = []
-        contents = os.listdir(self.path)
-        contents = [d for d in contents
-                    if os.path.isdir(os.path.join(self.path, d))]
+        if self.index is not None:
+            contents = self.index.subdirectories(self.path)
+        else:
+            contents = _subdirectories(self.path)
         for content in contents:
             try:
                 receive_paths.append(ReceivePath(os.path.join(
-                    self.path, content)))
+                    self.path, content), index=self.index))
             except Exception:
                 pass
         return receive_paths
@@ -148,17 +643,21 @@ class SnapPath(Path, SnapshotsMixin):
 
     Agruments:
         * path (str): path on filesystem
+        * index (SnapshotIndex): optional index to read the target and
+          snapshots from.
 
     Attributes:
         * target (str): Absolute path where the symlink points.
         * path (str): Absolute path on the filesystem
+        * index (SnapshotIndex): index or None.
 
     Raises:
         * TargetError:
         * PathError:
     '''
-    def __init__(self, path):
+    def __init__(self, path, index=None):
         Path.__init__(self, path)
+        self.index = index
         self.target = 'initiate'
 
     @property
@@ -167,9 +666,14 @@ class SnapPath(Path, SnapshotsMixin):
 
     @target.setter
     def target(self, garbage):
-        contents = os.listdir(path=self.path)
-        contents = [link for link in contents
-                    if os.path.islink(os.path.join(self.path, link))]
+        if self.index is not None:
+            entry = self.index.entry(self.path)
+            if entry['error']:
+                raise TargetError(entry['error'])
+            self._target = entry['target']
+            return
+        with os.scandir(self.path) as entries:
+            contents = [entry.name for entry in entries if entry.is_symlink()]
         if not len(contents) == 1:
             raise TargetError('there must be exactly 1 symlink pointing to a'
                               ' target BTRFS subvolume in snapshot'
@@ -177,39 +681,56 @@ class SnapPath(Path, SnapshotsMixin):
         self._target = os.path.realpath(os.path.abspath(os.path.join(
                                         self.path, contents[0])))
 
-    def timestamp(self, counter=1):
+    def timestamp(self, counter=1, resolution='day'):
         '''
         Returns the next availible timestamp in self.path
 
+        The timestamp is always newer than the newest snapshot in self.path.
+        As snapshots() is sorted, only the newest snapshot needs to be
+        compared.
+
         Arguments:
             * counter (int): start number for last 4 digits of timestamp.
+            * resolution (str): 'day' for YYYY-MM-DD-####, 'second' for
+              YYYY-MM-DD-HHMMSS or 'microsecond' for
+              YYYY-MM-DD-HHMMSS.ffffff.
 
         Returns:
-            * (str): next availible timestamp
+            * (Snapshot): next availible timestamp
         '''
-        today = datetime.date.today()
+        if resolution not in RESOLUTIONS:
+            raise ValueError('resolution must be one of {}'.format(
+                ', '.join(RESOLUTIONS)))
+        now = datetime.datetime.now()
         snapshots = self.snapshots()
-        if snapshots:
-            last_snapshot = snapshots[0]
-            less_than_last_snapshot = True
-        else:
-            last_snapshot = None
-            less_than_last_snapshot = False
-        timestamp = None
-
-        while (timestamp is None or timestamp in snapshots
-               or less_than_last_snapshot is True):
-            timestamp = '{}-{:04d}'.format(today.isoformat(), counter)
-            if less_than_last_snapshot is True:
-                if timestamp <= last_snapshot:
-                    less_than_last_snapshot = True
-                else:
-                    less_than_last_snapshot = False
+        newest = snapshots[0] if snapshots else None
 
+        if resolution == 'day':
+            if newest is not None and newest.date == now.date():
+                if newest.counter is None:
+                    raise Exception('Newest snapshot {} has a higher'
+                                    ' resolution than YYYY-MM-DD-####.'
+                                    ' Aborting!'.format(newest))
+                counter = max(counter, newest.counter + 1)
             if counter > 9999:
                 raise Exception('More than 9999 snapshots created today.'
                                 ' Something is probably wrong. Aborting!')
-            counter += 1
+            timestamp = Snapshot.from_date(now.date(), counter)
+        else:
+            timestamp = Snapshot.from_datetime(now, resolution)
+            if (newest is not None and timestamp <= newest
+                    and newest.date == now.date()):
+                # more than one snapshot within one tick of the clock
+                if resolution == 'second':
+                    step = datetime.timedelta(seconds=1)
+                else:
+                    step = datetime.timedelta(microseconds=1)
+                timestamp = Snapshot.from_datetime(newest.datetime + step,
+                                                   resolution)
+
+        if newest is not None and timestamp <= newest:
+            raise Exception('Newest snapshot {} is in the future.'
+                            ' Aborting!'.format(newest))
         return timestamp
 
 
@@ -219,336 +740,5201 @@ class ReceivePath(Path, SnapshotsMixin):
 
     Args:
         * Path (str): Path on filesystem
+        * index (SnapshotIndex): optional index to read snapshots from.
 
     Attributes:
         * path (str): absolute path
         * Snapshots (list(str)): List of snapshots inside self.path
+        * index (SnapshotIndex): index or None.
 
     Raises:
         * PathError:
     '''
-    pass
+    def __init__(self, path, index=None):
+        Path.__init__(self, path)
+        self.index = index
 
 
-class Btrfs(Path):
+class Backend:
     '''
-    Wrapper class for BTRFS functions
-
-    Args:
-        * Path (str): Path on filesystem
-
-    Attributes:
-        * path (str): absolute path
+    The operations btrsnap needs from BTRFS. Btrfs forwards to a backend so
+    the way they are carried out can be swapped.
 
-    Raises:
-        * PathError:
+    Paths passed to a backend are absolute.
     '''
 
-    def snap(self, target, timestamp, readonly=True):
+    def snap(self, target, snapshot, readonly=True):
         '''
-        Create a snapshot in self.path
+        Create a snapshot.
 
         Args:
-            * target (str): absolute path of BTRFS subvolume to be cloned.
-            * timestamp (str): name of the snapshot to be created.
+            * target (str): path of BTRFS subvolume to be cloned.
+            * snapshot (str): path of the snapshot to be created.
             * readonly (bool): True/False, new snapshot is readonly.
 
         Raises:
             * BtrfsError:
         '''
-        snapshot = os.path.join(self.path, timestamp)
-        if readonly:
-            args = ['btrfs', 'subvolume', 'snapshot', '-r', target, snapshot]
-        else:
-            args = ['btrfs', 'subvolume', 'snapshot', target, snapshot]
+        raise NotImplementedError
 
-        return_code = subprocess.call(args)
-        if return_code:
-            raise BtrfsError('BTRFS failed to create a snapshot'
-                             ' of {} in \'{}\''.format(target, snapshot))
+    def snap_args(self, target, snapshot, readonly=True):
+        '''
+        Returns:
+            * (list(str)): command line that creates the snapshot, or None
+              when the backend does not run commands.
+        '''
+        return None
 
-    def unsnap(self, timestamp):
+    def delete(self, snapshot):
         '''
-        Delete a snapshot in self.path
+        Delete a snapshot.
 
         Args:
-            * timestamp (str): name of the snapshot to be deleted.
+            * snapshot (str): path of the snapshot to be deleted.
 
         Raises:
             * BtrfsError:
         '''
-        snapshot = os.path.join(self.path, timestamp)
-        args = ['btrfs', 'subvolume', 'delete', snapshot]
-        return_code = subprocess.call(args)
-        if return_code:
-            raise BtrfsError('BTRFS failed to delete the subvolume.'
-                             ' Perhaps you need root permissions')
+        raise NotImplementedError
 
-    def send(self, snapshot, parent=None):
+    def delete_batch(self, snapshots, commit=None):
         '''
-        Send a snapshot using btrfs-progs.
+        Delete several snapshots, on the same filesystem, at once.
 
         Args:
-            * snapshot (str): absolute path of snapshot to be sent.
-            * parent (str): absolute path of parent snapshot alread on
-            receiving filesystem.
+            * snapshots (list(str)): paths of the snapshots to be deleted.
+            * commit (str): None to return without waiting for the
+              transaction commit, 'after' to wait once at the end or 'each'
+              to wait after every snapshot.
+
+        Raises:
+            * BtrfsError:
+        '''
+        for snapshot in snapshots:
+            self.delete(snapshot)
+
+    def cleaning(self, path):
+        '''
+        Args:
+            * path (str): path on the filesystem.
 
         Returns:
-            * (subprocess.Popen): can be used to pipe output to receive.
+            * (int): number of deleted subvolumes btrfs-cleaner has not
+              cleaned up yet.
+
+        Raises:
+            * BtrfsError:
         '''
-        args = ['btrfs', 'send']
-        if parent:
-            parent = os.path.join(self.path, parent)
-            args.extend(['-p', parent])
+        raise NotImplementedError
 
-        args.append(os.path.join(self.path, snapshot))
-        p1 = subprocess.Popen(args, stdout=subprocess.PIPE)
-        return p1
+    def send(self, snapshot, parent=None, clones=()):
+        '''
+        Start sending a snapshot.
+
+        Args:
+            * snapshot (str): path of snapshot to be sent.
+            * parent (str): path of parent snapshot already on the
+              receiving filesystem.
+            * clones (list(str)): paths of more snapshots already on the
+              receiving filesystem that data may be cloned from.
+
+        Returns:
+            * process with a readable stdout, wait() and returncode, like
+              subprocess.Popen.
+        '''
+        raise NotImplementedError
 
-    def receive(self, p1):
+    def receive(self, path, stream):
         '''
-        Receive a snapshot using btrfs-progs.
+        Receive a snapshot.
 
         Args:
-            * p1 (subprocess.Popen): send process
+            * path (str): directory to receive the snapshot in.
+            * stream (file): binary file object to read the stream from.
+
+        Raises:
+            * BtrfsError:
+        '''
+        raise NotImplementedError
+
+    def list(self, path):
+        '''
+        List the subvolumes directly inside path.
+
+        Args:
+            * path (str): directory on the filesystem.
+
+        Returns:
+            * (list(dict)): keys path (absolute), id, generation, uuid,
+              parent_uuid and received_uuid. Missing uuids are None.
+
+        Raises:
+            * BtrfsError:
+        '''
+        raise NotImplementedError
+
+    def list_filesystem(self, paths):
+        '''
+        List the subvolumes directly inside each of PATHS, which are on the
+        same filesystem, and the other subvolumes of that filesystem the
+        backend can see. Backends that can list a whole filesystem at once
+        override this to do so.
+
+        Args:
+            * paths (list(str)): directories on the filesystem.
+
+        Returns:
+            * (tuple): (listing, subvolumes). listing maps each path of
+              PATHS to its subvolumes, see list. subvolumes holds every
+              subvolume found, those of listing included. The path of a
+              subvolume outside the mount of PATHS is None.
+        '''
+        listing = {path: self.list(path) for path in paths}
+        return listing, [subvolume for subvolumes in listing.values()
+                         for subvolume in subvolumes]
+
+    def qgroups(self, path):
+        '''
+        Read the sizes of every subvolume of the filesystem holding path at
+        once, from the level 0 qgroups. Quotas must be enabled.
+
+        Args:
+            * path (str): path on the filesystem.
+
+        Returns:
+            * (dict): subvolume id to a dict with keys referenced (bytes the
+              subvolume refers to) and exclusive (bytes only it refers to,
+              which deleting it would free).
+
+        Raises:
+            * BtrfsError:
+        '''
+        raise NotImplementedError
+
+    def du(self, paths):
+        '''
+        Measure subvolumes by walking their extents, for filesystems
+        without quotas. Slower than qgroups, but a single pass measures
+        every path.
+
+        Args:
+            * paths (list(str)): subvolumes on one filesystem.
+
+        Returns:
+            * (dict): each path of PATHS to a dict with keys referenced and
+              exclusive, see qgroups.
+
+        Raises:
+            * BtrfsError:
+        '''
+        raise NotImplementedError
+
+    def free_space(self, path):
+        '''
+        Args:
+            * path (str): path on the filesystem.
+
+        Returns:
+            * (tuple): (available, size) in bytes, from statvfs. BTRFS
+              only counts space as available once btrfs-cleaner has
+              cleaned up the deleted subvolumes holding it.
+        '''
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize, stat.f_blocks * stat.f_frsize
+
+    def show(self, subvolume):
+        '''
+        Describe one subvolume.
+
+        Args:
+            * subvolume (str): path of the subvolume.
+
+        Returns:
+            * (dict): keys name, uuid, parent_uuid, received_uuid,
+              generation and readonly. Missing uuids are None.
+
+        Raises:
+            * BtrfsError:
+        '''
+        raise NotImplementedError
+
+
+def _toplevel_path(path, mounts, resolved=False):
+    '''
+    Args:
+        * path (str): path on the filesystem.
+        * mounts (list(dict)): mount table from _mounts().
+        * resolved (bool): path is already absolute with its symlinks
+          resolved, possibly on another host.
+
+    Returns:
+        * (str): path relative to the top level subvolume of its filesystem
+          as btrfs-progs prints it, '' for the top level itself.
+    '''
+    if not resolved:
+        path = os.path.realpath(path)
+    mount = _mount(path, mounts, resolved=True)
+    if mount is None:
+        raise BtrfsError('Can not find the mount holding \'{}\''.format(path))
+    relative = os.path.join(mount['root'],
+                            os.path.relpath(path, mount['mountpoint']))
+    relative = os.path.normpath(relative).strip(os.path.sep)
+    return '' if relative == '.' else relative
+
+
+class ProgsBackend(Backend):
+    '''
+    Run btrfs-progs for every operation. This is the default backend.
+    '''
+    QGROUP_PATTERN = re.compile(
+        r'^0/(?P<id>\d+)\s+(?P<referenced>\d+)\s+(?P<exclusive>\d+)')
+    DU_PATTERN = re.compile(
+        r'^\s*(?P<referenced>\d+)\s+(?P<exclusive>\d+)\s+\S+\s+(?P<path>.*)$')
+    LIST_PATTERN = re.compile(
+        r'^ID (?P<id>\d+) gen (?P<generation>\d+) top level \d+'
+        r'(?: parent_uuid (?P<parent_uuid>\S+))?'
+        r'(?: received_uuid (?P<received_uuid>\S+))?'
+        r'(?: uuid (?P<uuid>\S+))? path (?P<path>.*)$')
+    SHOW_KEYS = {'Name': 'name',
+                 'UUID': 'uuid',
+                 'Parent UUID': 'parent_uuid',
+                 'Received UUID': 'received_uuid',
+                 'Generation': 'generation',
+                 'Flags': 'readonly'}
+
+    def _args(self, args):
+        '''
+        Returns:
+            * (list(str)): the command line that runs the btrfs command
+              ARGS.
+        '''
+        return args
+
+    def _output(self, args):
+        args = self._args(args)
+        process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        output = process.communicate()
+        if process.returncode:
+            raise BtrfsError('BTRFS failed to run {}'.format(' '.join(args)),
+                             output[1])
+        return output[0]
+
+    @staticmethod
+    def _uuid(value):
+        return None if value in (None, '-') else value
+
+    def snap(self, target, snapshot, readonly=True):
+        return_code = subprocess.call(self._args(
+            self.snap_args(target, snapshot, readonly=readonly)))
+        if return_code:
+            raise BtrfsError('BTRFS failed to create a snapshot'
+                             ' of {} in \'{}\''.format(target, snapshot))
+
+    def snap_args(self, target, snapshot, readonly=True):
+        if readonly:
+            return ['btrfs', 'subvolume', 'snapshot', '-r', target, snapshot]
+        return ['btrfs', 'subvolume', 'snapshot', target, snapshot]
+
+    def delete(self, snapshot):
+        args = ['btrfs', 'subvolume', 'delete', snapshot]
+        return_code = subprocess.call(self._args(args))
+        if return_code:
+            raise BtrfsError('BTRFS failed to delete the subvolume.'
+                             ' Perhaps you need root permissions')
+
+    def delete_batch(self, snapshots, commit=None):
+        args = ['btrfs', 'subvolume', 'delete']
+        if commit is not None:
+            args.append('--commit-' + commit)
+        args.extend(snapshots)
+        return_code = subprocess.call(self._args(args))
+        if return_code:
+            raise BtrfsError('BTRFS failed to delete some of {} subvolumes.'
+                             ' Perhaps you need root permissions'.format(
+                                 len(snapshots)))
+
+    def cleaning(self, path):
+        output = self._output(['btrfs', 'subvolume', 'list', '-d', path])
+        return len(output.splitlines())
+
+    def qgroups(self, path):
+        '''
+        One btrfs qgroup show prints the qgroups of the whole filesystem.
+        '''
+        output = self._output(['btrfs', 'qgroup', 'show', '--raw', path])
+        qgroups = {}
+        for line in output.splitlines():
+            match = self.QGROUP_PATTERN.match(line)
+            if match is not None:
+                qgroups[int(match.group('id'))] = {
+                    'referenced': int(match.group('referenced')),
+                    'exclusive': int(match.group('exclusive'))}
+        return qgroups
+
+    def du(self, paths):
+        '''
+        One btrfs filesystem du measures every path.
+        '''
+        output = self._output(['btrfs', 'filesystem', 'du', '-s', '--raw']
+                              + list(paths))
+        sizes = {}
+        for line in output.splitlines():
+            match = self.DU_PATTERN.match(line)
+            if match is not None:
+                sizes[match.group('path')] = {
+                    'referenced': int(match.group('referenced')),
+                    'exclusive': int(match.group('exclusive'))}
+        return sizes
+
+    def send(self, snapshot, parent=None, clones=()):
+        args = ['btrfs', 'send']
+        if parent:
+            args.extend(['-p', parent])
+        for clone in clones:
+            args.extend(['-c', clone])
+        args.append(snapshot)
+        return subprocess.Popen(self._args(args), stdout=subprocess.PIPE)
+
+    def receive(self, path, stream):
+        args = ['btrfs', 'receive', path]
+        p2 = subprocess.Popen(self._args(args), stdin=stream,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = p2.communicate()
+        if p2.returncode:
+            raise BtrfsError('BTRFS Failed send/recieve.'
+                             ' Do you have root permissions?',
+                             output[0], output[1])
+
+    def _resolve(self, paths):
+        '''
+        Returns:
+            * (list(str)): PATHS with their symlinks resolved.
+        '''
+        return [os.path.realpath(path) for path in paths]
+
+    def _mount_table(self):
+        '''
+        Returns:
+            * (list(dict)): the mount table the paths are on, see _mounts.
+        '''
+        return _mounts()
+
+    def _parse_list(self, output):
+        '''
+        Yields:
+            * (tuple): (path relative to the top level subvolume, dict with
+              keys id, generation, uuid, parent_uuid and received_uuid) for
+              every subvolume btrfs subvolume list printed.
+        '''
+        for line in output.splitlines():
+            match = self.LIST_PATTERN.match(line)
+            if match is None:
+                continue
+            yield match.group('path'), {
+                'id': int(match.group('id')),
+                'generation': int(match.group('generation')),
+                'uuid': self._uuid(match.group('uuid')),
+                'parent_uuid': self._uuid(match.group('parent_uuid')),
+                'received_uuid': self._uuid(match.group('received_uuid'))}
+
+    def list(self, path):
+        path = self._resolve([path])[0]
+        prefix = _toplevel_path(path, self._mount_table(), resolved=True)
+        output = self._output(['btrfs', 'subvolume', 'list', '-o', '-q', '-R',
+                               '-u', path])
+        subvolumes = []
+        for relative, subvolume in self._parse_list(output):
+            parent, name = posixpath.split(relative)
+            if parent == prefix:
+                subvolume['path'] = os.path.join(path, name)
+                subvolumes.append(subvolume)
+        return subvolumes
+
+    def list_filesystem(self, paths):
+        '''
+        List the subvolumes in PATHS with a single btrfs subvolume list,
+        which prints every subvolume of the filesystem. It runs on the first
+        path, and the paths of the other subvolumes go through its mount, as
+        PATHS may be on several mounts of the filesystem.
+        '''
+        resolved = self._resolve(paths)
+        mounts = self._mount_table()
+        wanted = {}
+        for path, real in zip(paths, resolved):
+            prefix = _toplevel_path(real, mounts, resolved=True)
+            wanted.setdefault(prefix, []).append((path, real))
+        mount = _mount(resolved[0], mounts, resolved=True)
+        root = mount['root'].strip(posixpath.sep) if mount else None
+        listing = {path: [] for path in paths}
+        subvolumes = []
+        output = self._output(['btrfs', 'subvolume', 'list', '-q', '-R', '-u',
+                               resolved[0]])
+        for relative, subvolume in self._parse_list(output):
+            subvolume['path'] = None
+            if root == '':
+                subvolume['path'] = posixpath.join(mount['mountpoint'],
+                                                   relative)
+            elif root is not None and (relative + posixpath.sep).startswith(
+                    root + posixpath.sep):
+                subvolume['path'] = posixpath.normpath(posixpath.join(
+                    mount['mountpoint'], relative[len(root) + 1:]))
+            subvolumes.append(subvolume)
+            parent, name = posixpath.split(relative)
+            for path, real in wanted.get(parent, ()):
+                listing[path].append(dict(subvolume,
+                                          path=os.path.join(real, name)))
+        return listing, subvolumes
+
+    def show(self, subvolume):
+        output = self._output(['btrfs', 'subvolume', 'show', subvolume])
+        info = {}
+        for line in output.splitlines()[1:]:
+            key, _, value = line.partition(':')
+            key = self.SHOW_KEYS.get(key.strip())
+            if key is not None:
+                info[key] = value.strip()
+        return {'name': info.get('name'),
+                'uuid': self._uuid(info.get('uuid')),
+                'parent_uuid': self._uuid(info.get('parent_uuid')),
+                'received_uuid': self._uuid(info.get('received_uuid')),
+                'generation': int(info.get('generation', 0)),
+                'readonly': 'readonly' in info.get('readonly', '')}
+
+
+class IoctlBackend(ProgsBackend):
+    '''
+    Create and delete snapshots in process with BTRFS ioctls instead of
+    forking btrfs-progs for every operation. The other operations still run
+    btrfs-progs.
+
+    Args:
+        * ioctl (callable): called as ioctl(fd, request, buffer) like
+          fcntl.ioctl, the default. Tests pass a fake so they can run
+          without root or a BTRFS filesystem.
+
+    Attributes:
+        * ioctl (callable): the ioctl function in use.
+    '''
+
+    def __init__(self, ioctl=None):
+        self.ioctl = ioctl if ioctl is not None else fcntl.ioctl
+
+    def snap_args(self, target, snapshot, readonly=True):
+        return None
+
+    @staticmethod
+    def _split(path):
+        parent, name = os.path.split(os.fspath(path))
+        name = name.encode()
+        if not name or b'/' in name or len(name) > BTRFS_SUBVOL_NAME_MAX:
+            raise BtrfsError('Invalid subvolume name in \'{}\''.format(path))
+        return parent, name
+
+    def snap(self, target, snapshot, readonly=True):
+        '''
+        Create a snapshot with BTRFS_IOC_SNAP_CREATE_V2.
+
+        Args:
+            * target (str): absolute path of BTRFS subvolume to be cloned.
+            * snapshot (str): absolute path of the snapshot to be created.
+            * readonly (bool): True/False, new snapshot is readonly.
+
+        Raises:
+            * BtrfsError:
+        '''
+        parent, name = self._split(snapshot)
+        flags = BTRFS_SUBVOL_RDONLY if readonly else 0
+        try:
+            source = os.open(target, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                destination = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+                try:
+                    args = bytearray(BTRFS_VOL_ARGS_V2.pack(
+                        source, 0, flags, b'', name))
+                    self.ioctl(destination, BTRFS_IOC_SNAP_CREATE_V2, args)
+                finally:
+                    os.close(destination)
+            finally:
+                os.close(source)
+        except OSError as err:
+            raise BtrfsError('BTRFS failed to create a snapshot'
+                             ' of {} in \'{}\': {}'.format(
+                                 target, snapshot, err.strerror))
+
+    def delete(self, snapshot):
+        '''
+        Delete a snapshot with BTRFS_IOC_SNAP_DESTROY.
+
+        Args:
+            * snapshot (str): absolute path of the snapshot to be deleted.
+
+        Raises:
+            * BtrfsError:
+        '''
+        parent, name = self._split(snapshot)
+        try:
+            destination = os.open(parent, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                args = bytearray(BTRFS_VOL_ARGS.pack(0, name))
+                self.ioctl(destination, BTRFS_IOC_SNAP_DESTROY, args)
+            finally:
+                os.close(destination)
+        except OSError as err:
+            raise BtrfsError('BTRFS failed to delete the subvolume'
+                             ' \'{}\': {}. Perhaps you need root'
+                             ' permissions'.format(snapshot, err.strerror))
+
+    def sync(self, path):
+        '''
+        Commit the current transaction of the filesystem holding path with
+        BTRFS_IOC_SYNC.
+
+        Raises:
+            * BtrfsError:
+        '''
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                self.ioctl(fd, BTRFS_IOC_SYNC, 0)
+            finally:
+                os.close(fd)
+        except OSError as err:
+            raise BtrfsError('BTRFS failed to sync \'{}\': {}'.format(
+                path, err.strerror))
+
+    def delete_batch(self, snapshots, commit=None):
+        '''
+        Delete snapshots with one BTRFS_IOC_SNAP_DESTROY each and commit with
+        BTRFS_IOC_SYNC. Like btrfs-progs, every snapshot is tried before
+        failures are reported.
+        '''
+        failed = []
+        for snapshot in snapshots:
+            try:
+                self.delete(snapshot)
+                if commit == 'each':
+                    self.sync(os.path.dirname(snapshot))
+            except BtrfsError:
+                failed.append(snapshot)
+        deleted = [snapshot for snapshot in snapshots
+                   if snapshot not in failed]
+        if commit == 'after' and deleted:
+            self.sync(os.path.dirname(deleted[0]))
+        if failed:
+            raise BtrfsError('BTRFS failed to delete {}. Perhaps you need'
+                             ' root permissions'.format(', '.join(failed)))
+
+
+class Transport:
+    '''
+    Run commands on another host through VIA, a command that runs the shell
+    command line given as its last argument, like 'ssh host'. Any command
+    that passes stdin and stdout through will do, 'sh -c' runs locally.
+
+    With ssh, every command of a run shares one connection: the first
+    opens a master connection (ControlMaster) that the others multiplex
+    over, and close() ends it.
+
+    Args:
+        * via (str): the command, split like a shell would.
+
+    Attributes:
+        * via (list(str)): command line every command is appended to.
+        * commands (int): number of commands run so far.
+    '''
+
+    def __init__(self, via):
+        self.via = shlex.split(via)
+        if not self.via:
+            raise Exception('via must name a command')
+        self.commands = 0
+        self._control = None
+        self._mounts = None
+        self._lock = threading.Lock()
+        if os.path.basename(self.via[0]) == 'ssh':
+            self._control = tempfile.mkdtemp(prefix='btrsnap-ssh-')
+            self.via[1:1] = [
+                '-o', 'ControlMaster=auto',
+                '-o', 'ControlPath={}'.format(
+                    os.path.join(self._control, 'master')),
+                '-o', 'ControlPersist={}'.format(TRANSPORT_PERSIST_SECONDS)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def args(self, args):
+        '''
+        Returns:
+            * (list(str)): the command line that runs ARGS through VIA.
+        '''
+        with self._lock:
+            self.commands += 1
+        return self.via + [' '.join(shlex.quote(arg) for arg in args)]
+
+    def output(self, args):
+        '''
+        Run ARGS on the other host.
+
+        Returns:
+            * (str): its output.
+
+        Raises:
+            * BtrfsError: it failed.
+        '''
+        process = subprocess.Popen(self.args(args), stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        output = process.communicate()
+        if process.returncode:
+            raise BtrfsError('Failed to run {} through {}'.format(
+                ' '.join(args), ' '.join(self.via)), output[1])
+        return output[0]
+
+    def mounts(self):
+        '''
+        Returns:
+            * (list(dict)): the mount table of the other host, see _mounts.
+        '''
+        if self._mounts is None:
+            self._mounts = _mounts(self.output(
+                ['cat', '/proc/self/mountinfo']))
+        return self._mounts
+
+    def realpaths(self, paths):
+        '''
+        Returns:
+            * (list(str)): PATHS on the other host with their symlinks
+              resolved. They need not exist.
+        '''
+        return self.output(['realpath', '-m', '--'] + list(paths)).splitlines()
+
+    def snapshots(self, path):
+        '''
+        Returns:
+            * (list(Snapshot)): the btrsnap snapshots in PATH on the other
+              host that are valid dates, newest first.
+
+        Raises:
+            * PathError: PATH is not a directory.
+        '''
+        try:
+            output = self.output(['ls', '-1Ap', '--', path])
+        except BtrfsError:
+            raise PathError('{} is not a directory on {}'.format(
+                path, ' '.join(self.via)))
+        return _snapshots(name[:-1] for name in output.splitlines()
+                          if name.endswith('/')
+                          and TIMESTAMP_PATTERN.match(name[:-1]))
+
+    def mkdir(self, paths):
+        '''
+        Create the directories PATHS on the other host with one command.
+        '''
+        if paths:
+            self.output(['mkdir', '-p', '--'] + list(paths))
+
+    def close(self):
+        '''
+        End the shared ssh connection.
+        '''
+        if self._control is not None:
+            try:
+                subprocess.call(self.via + ['-O', 'exit'],
+                                stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+            except OSError:
+                pass
+            shutil.rmtree(self._control, ignore_errors=True)
+            self._control = None
+
+
+class RemoteBackend(ProgsBackend):
+    '''
+    Run btrfs-progs on another host through a Transport.
+
+    Args:
+        * transport (Transport): the connection to the other host.
+    '''
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def _args(self, args):
+        return self.transport.args(args)
+
+    def _resolve(self, paths):
+        return self.transport.realpaths(paths)
+
+    def _mount_table(self):
+        return self.transport.mounts()
+
+
+def _tree(root):
+    '''
+    Walk a simulated subvolume.
+
+    Nested subvolumes are returned as directories without their contents,
+    like BTRFS snapshots show them, and the subvolume marker is skipped.
+
+    Yields:
+        * (tuple): (relative path, os.DirEntry) parents before children.
+    '''
+    directories = ['']
+    while directories:
+        directory = directories.pop()
+        with os.scandir(os.path.join(root, directory)) as entries:
+            for entry in entries:
+                relative = os.path.join(directory, entry.name)
+                if relative == SIMULATED_SUBVOLUME:
+                    continue
+                yield relative, entry
+                if entry.is_dir(follow_symlinks=False) and not os.path.exists(
+                        os.path.join(entry.path, SIMULATED_SUBVOLUME)):
+                    directories.append(relative)
+
+
+def _clone_tree(source, destination):
+    '''
+    Copy the tree of subvolume source into the existing directory
+    destination, hard linking files.
+    '''
+    for relative, entry in _tree(source):
+        path = os.path.join(destination, relative)
+        if entry.is_symlink():
+            os.symlink(os.readlink(entry.path), path)
+        elif entry.is_dir():
+            os.mkdir(path)
+        else:
+            os.link(entry.path, path)
+
+
+class _ThreadedSend:
+    '''
+    A send running in a thread, with the stream readable from stdout like a
+    subprocess.Popen.
+    '''
+
+    def __init__(self, write, *args):
+        read_fd, write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.returncode = None
+        self.error = None
+        self._thread = threading.Thread(target=self._run,
+                                        args=(write, write_fd) + args)
+        self._thread.start()
+
+    def _run(self, write, write_fd, *args):
+        try:
+            with os.fdopen(write_fd, 'wb') as out:
+                write(out, *args)
+        except Exception as err:
+            self.error = err
+            self.returncode = 1
+        else:
+            self.returncode = 0
+
+    def poll(self):
+        return None if self._thread.is_alive() else self.returncode
+
+    def wait(self):
+        self._thread.join()
+        return self.returncode
+
+
+class SimulatedBackend(Backend):
+    '''
+    Model BTRFS on a plain directory tree so btrsnap can be exercised and
+    benchmarked without root or a BTRFS filesystem.
+
+    A subvolume is a directory holding a SIMULATED_SUBVOLUME file with its
+    uuid, parent_uuid, received_uuid, generation and readonly flag.
+    Snapshots hard link the files of their source the way BTRFS shares
+    extents, so files in a simulated subvolume should be replaced rather
+    than modified in place. Send streams are a JSON header followed by a
+    tar archive of the files that changed since the parent.
+
+    Args:
+        * latency (float): seconds every create, snapshot, delete and
+          receive sleeps, to model the cost of a BTRFS transaction.
+
+    Attributes:
+        * latency (float): seconds added to every operation.
+    '''
+    STREAM_VERSION = 1
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _marker(subvolume):
+        return os.path.join(subvolume, SIMULATED_SUBVOLUME)
+
+    def _read(self, subvolume):
+        try:
+            with open(self._marker(subvolume)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            raise BtrfsError('\'{}\' is not a subvolume'.format(subvolume))
+
+    def _write(self, subvolume, info):
+        marker = self._marker(subvolume)
+        with open(marker + '.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(marker + '.tmp', marker)
+
+    def create(self, subvolume):
+        '''
+        Create an empty subvolume.
+
+        Args:
+            * subvolume (str): path of the subvolume to be created.
+
+        Raises:
+            * BtrfsError:
+        '''
+        try:
+            os.mkdir(subvolume)
+        except OSError as err:
+            raise BtrfsError('Can not create subvolume \'{}\': {}'.format(
+                subvolume, err.strerror))
+        self._write(subvolume, {'uuid': str(uuid.uuid4()),
+                                'parent_uuid': None,
+                                'received_uuid': None,
+                                'generation': 1,
+                                'readonly': False})
+        self._sleep()
+
+    def snap(self, target, snapshot, readonly=True):
+        with self.lock:
+            source = self._read(target)
+            source['generation'] += 1
+            self._write(target, source)
+        try:
+            os.mkdir(snapshot)
+        except OSError as err:
+            raise BtrfsError('BTRFS failed to create a snapshot'
+                             ' of {} in \'{}\': {}'.format(
+                                 target, snapshot, err.strerror))
+        _clone_tree(target, snapshot)
+        self._write(snapshot, {'uuid': str(uuid.uuid4()),
+                               'parent_uuid': source['uuid'],
+                               'received_uuid': None,
+                               'generation': source['generation'],
+                               'readonly': readonly})
+        self._sleep()
+
+    def _remove(self, snapshot):
+        if os.path.islink(snapshot):
+            raise BtrfsError('\'{}\' is not a subvolume'.format(snapshot))
+        self._read(snapshot)
+        shutil.rmtree(snapshot)
+
+    def delete(self, snapshot):
+        self._remove(snapshot)
+        self._sleep()
+
+    def delete_batch(self, snapshots, commit=None):
+        '''
+        Delete snapshots, sleeping the latency once for the batch or, with
+        commit 'each', once per snapshot.
+        '''
+        errors = []
+        for snapshot in snapshots:
+            try:
+                self._remove(snapshot)
+            except BtrfsError as err:
+                errors.append(str(err))
+                continue
+            if commit == 'each':
+                self._sleep()
+        if commit != 'each':
+            self._sleep()
+        if errors:
+            raise BtrfsError('. '.join(errors))
+
+    def cleaning(self, path):
+        '''
+        Simulated subvolumes are cleaned up as they are deleted.
+        '''
+        return 0
+
+    def stream(self, out, snapshot, parent=None, clones=()):
+        '''
+        Write the send stream of snapshot to out.
+
+        Args:
+            * out (file): binary file object.
+            * snapshot (str): path of a readonly subvolume.
+            * parent (str): path of a readonly subvolume the receiving side
+              already has. Only the differences to it are sent.
+            * clones (list(str)): paths of readonly subvolumes the receiving
+              side must already have. They are only checked, the simulation
+              does not clone from them.
+
+        Raises:
+            * BtrfsError:
+        '''
+        info = self._check_send(snapshot, parent, clones)
+        # like BTRFS, a subvolume that was received itself is sent under its
+        # received_uuid so the stream can be relayed further
+        header = {'version': self.STREAM_VERSION,
+                  'name': os.path.basename(snapshot),
+                  'uuid': info['received_uuid'] or info['uuid'],
+                  'generation': info['generation'],
+                  'parent_uuid': None,
+                  'parent_name': None,
+                  'clones': [],
+                  'deleted': []}
+        for clone in clones:
+            clone_info = self._read(clone)
+            header['clones'].append([
+                clone_info['received_uuid'] or clone_info['uuid'],
+                os.path.basename(clone)])
+        if parent is not None:
+            parent_info = self._read(parent)
+            header['parent_uuid'] = (parent_info['received_uuid']
+                                     or parent_info['uuid'])
+            header['parent_name'] = os.path.basename(parent)
+            header['deleted'] = [
+                relative for relative, entry in _tree(parent)
+                if not os.path.lexists(os.path.join(snapshot, relative))
+                and os.path.lexists(os.path.join(snapshot,
+                                                 os.path.dirname(relative)))]
+        out.write(json.dumps(header).encode() + b'\n')
+        with tarfile.open(fileobj=out, mode='w|') as tar:
+            for relative, entry in _tree(snapshot):
+                if parent is not None and not entry.is_dir(
+                        follow_symlinks=False):
+                    try:
+                        old = os.lstat(os.path.join(parent, relative))
+                    except OSError:
+                        pass
+                    else:
+                        # snapshots share unchanged files as hard links
+                        new = entry.stat(follow_symlinks=False)
+                        if (old.st_dev, old.st_ino) == (new.st_dev,
+                                                        new.st_ino):
+                            continue
+                tar.add(entry.path, arcname=relative, recursive=False)
+
+    def _check_send(self, snapshot, parent, clones):
+        info = self._read(snapshot)
+        for subvolume in [snapshot, parent] + list(clones):
+            if subvolume is not None and not self._read(subvolume)['readonly']:
+                raise BtrfsError('Can not send \'{}\', it is not'
+                                 ' readonly'.format(subvolume))
+        return info
+
+    def send(self, snapshot, parent=None, clones=()):
+        self._check_send(snapshot, parent, clones)
+        return _ThreadedSend(self.stream, snapshot, parent, clones)
+
+    def _find_received(self, path, received_uuid, name):
+        candidates = [os.path.join(path, name)] if name else []
+        candidates.extend(subvolume['path'] for subvolume in self.list(path))
+        for candidate in candidates:
+            try:
+                info = self._read(candidate)
+            except BtrfsError:
+                continue
+            if received_uuid in (info['received_uuid'], info['uuid']):
+                return candidate, info
+        # BTRFS looks received_uuid up in the whole filesystem, the
+        # simulation only next to PATH
+        for subvolume in self._walk(os.path.dirname(path)):
+            if subvolume['received_uuid'] == received_uuid:
+                return subvolume['path'], self._read(subvolume['path'])
+        raise BtrfsError('Can not find subvolume {} in \'{}\''.format(
+            received_uuid, path))
+
+    def receive(self, path, stream):
+        try:
+            header = json.loads(stream.readline().decode())
+        except ValueError:
+            raise BtrfsError('Invalid send stream')
+        if header.get('version') != self.STREAM_VERSION:
+            raise BtrfsError('Unsupported send stream version {}'.format(
+                header.get('version')))
+        name = header['name']
+        if not name or os.path.sep in name or name in ('.', '..'):
+            raise BtrfsError('Invalid subvolume name {!r}'.format(name))
+        subvolume = os.path.join(path, name)
+        info = {'uuid': str(uuid.uuid4()),
+                'parent_uuid': None,
+                'received_uuid': None,
+                'generation': header['generation'],
+                'readonly': False}
+        parent = None
+        if header['parent_uuid'] is not None:
+            parent, parent_info = self._find_received(
+                path, header['parent_uuid'], header['parent_name'])
+            info['parent_uuid'] = parent_info['uuid']
+        for clone_uuid, clone_name in header.get('clones', []):
+            self._find_received(path, clone_uuid, clone_name)
+        try:
+            os.mkdir(subvolume)
+        except OSError as err:
+            raise BtrfsError('Can not receive \'{}\': {}'.format(
+                subvolume, err.strerror))
+        # like BTRFS, an interrupted receive leaves a writable subvolume
+        # without a received_uuid behind
+        self._write(subvolume, info)
+        if parent is not None:
+            _clone_tree(parent, subvolume)
+        for relative in header['deleted']:
+            deleted = self._inside(subvolume, relative)
+            if os.path.isdir(deleted) and not os.path.islink(deleted):
+                shutil.rmtree(deleted)
+            elif os.path.lexists(deleted):
+                os.unlink(deleted)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                for member in tar:
+                    destination = self._inside(subvolume, member.name)
+                    # hard linked files are shared with the parent
+                    if os.path.isdir(destination) and not os.path.islink(
+                            destination):
+                        if not member.isdir():
+                            shutil.rmtree(destination)
+                    elif os.path.lexists(destination):
+                        os.unlink(destination)
+                    if hasattr(tarfile, 'data_filter'):
+                        tar.extract(member, subvolume, filter='tar')
+                    else:
+                        tar.extract(member, subvolume)
+            # like btrfs receive, read the stream to the end, past the
+            # padding tarfile may leave unread
+            while stream.read(PUMP_CHUNK):
+                pass
+        except (tarfile.TarError, OSError) as err:
+            raise BtrfsError('Failed to receive \'{}\': {}'.format(
+                subvolume, err))
+        info['received_uuid'] = header['uuid']
+        info['readonly'] = True
+        self._write(subvolume, info)
+        self._sleep()
+
+    @staticmethod
+    def _inside(subvolume, relative):
+        path = os.path.normpath(os.path.join(subvolume, relative))
+        if (path == subvolume or not path.startswith(subvolume + os.path.sep)
+                or os.path.basename(path) == SIMULATED_SUBVOLUME):
+            raise BtrfsError('Invalid path {!r} in send stream'.format(
+                relative))
+        return path
+
+    def list(self, path):
+        path = os.path.realpath(path)
+        subvolumes = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                try:
+                    info = self._read(entry.path)
+                except BtrfsError:
+                    continue
+                subvolumes.append({
+                    'path': entry.path,
+                    'id': entry.inode(),
+                    'generation': info['generation'],
+                    'uuid': info['uuid'],
+                    'parent_uuid': info['parent_uuid'],
+                    'received_uuid': info['received_uuid']})
+        return subvolumes
+
+    def _walk(self, root):
+        '''
+        Yields:
+            * (dict): every subvolume below ROOT, see list. Subvolumes are
+              not looked into.
+        '''
+        pending = [os.path.realpath(root)]
+        while pending:
+            directory = pending.pop()
+            subvolumes = self.list(directory)
+            yield from subvolumes
+            inside = {subvolume['path'] for subvolume in subvolumes}
+            with os.scandir(directory) as entries:
+                pending.extend(entry.path for entry in entries
+                               if entry.is_dir(follow_symlinks=False)
+                               and entry.path not in inside)
+
+    def list_filesystem(self, paths):
+        '''
+        The simulation sees the subvolumes below the parent directory of
+        each of PATHS, where receive looks for parents.
+        '''
+        listing = {path: self.list(path) for path in paths}
+        subvolumes = {}
+        for path in paths:
+            for subvolume in self._walk(os.path.dirname(
+                    os.path.realpath(path))):
+                subvolumes[subvolume['path']] = subvolume
+        for subvolume in (subvolume for listed in listing.values()
+                          for subvolume in listed):
+            subvolumes.setdefault(subvolume['path'], subvolume)
+        return listing, list(subvolumes.values())
+
+    def qgroups(self, path):
+        '''
+        The simulation sizes the subvolumes below the parent directory of
+        PATH, like list_filesystem. Files hard linked from another
+        subvolume are shared, the others are exclusive.
+        '''
+        return {subvolume['id']: self._usage(subvolume['path'])
+                for subvolume in self._walk(os.path.dirname(
+                    os.path.realpath(path)))}
+
+    def du(self, paths):
+        return {path: self._usage(path) for path in paths}
+
+    def _usage(self, subvolume):
+        '''
+        Returns:
+            * (dict): referenced and exclusive bytes of SUBVOLUME, see
+              qgroups.
+        '''
+        self._read(subvolume)
+        referenced = exclusive = 0
+        for _, entry in _tree(subvolume):
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                referenced += stat.st_size
+                if stat.st_nlink == 1:
+                    exclusive += stat.st_size
+        return {'referenced': referenced, 'exclusive': exclusive}
+
+    def show(self, subvolume):
+        info = self._read(subvolume)
+        return {'name': os.path.basename(os.path.realpath(subvolume)),
+                'uuid': info['uuid'],
+                'parent_uuid': info['parent_uuid'],
+                'received_uuid': info['received_uuid'],
+                'generation': info['generation'],
+                'readonly': info['readonly']}
+
+
+BACKENDS = {'progs': ProgsBackend,
+            'ioctl': IoctlBackend,
+            'sim': lambda: SimulatedBackend(
+                latency=float(os.environ.get('BTRSNAP_SIM_LATENCY', 0)))}
+
+
+def get_backend(name):
+    '''
+    Args:
+        * name (str): one of BACKENDS.
+
+    Returns:
+        * (Backend): a new backend.
+    '''
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise Exception('unknown backend {!r}, choose one of {}'.format(
+            name, ', '.join(sorted(BACKENDS))))
+
+
+class RateLimiter:
+    '''
+    Bandwidth cap shared by any number of Pumps.
+
+    Args:
+        * rate (float): bytes per second.
+
+    Attributes:
+        * rate (float): bytes per second.
+    '''
+
+    def __init__(self, rate):
+        if not rate > 0:
+            raise Exception('rate must be a positive number')
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, size):
+        '''
+        Account for SIZE bytes just moved, sleeping long enough to keep
+        every caller together below the rate.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self.rate
+            delay = self._next - now
+        time.sleep(delay)
+
+
+class StreamHasher:
+    '''
+    Hash a stream in a worker thread, so hashing stays off the copy path.
+
+    The copier takes a buffer from buffer(), fills it and hands it over
+    with update(). The worker hashes the buffers in order and hands them
+    back for reuse. At most CHECKSUM_BUFFERS are in flight, so a hash that
+    falls behind slows the copier down instead of piling up memory.
+
+    Args:
+        * algorithm (str): name of a hashlib algorithm.
+        * size (int): size of the buffers.
+
+    Attributes:
+        * algorithm (str): name of the algorithm.
+        * bytes (int): bytes hashed so far.
+    '''
+
+    def __init__(self, algorithm=CHECKSUM_ALGORITHM, size=PUMP_CHUNK):
+        self.algorithm = algorithm
+        self.bytes = 0
+        self._hash = hashlib.new(algorithm)
+        self._free = queue.Queue()
+        self._full = queue.Queue()
+        for _ in range(CHECKSUM_BUFFERS):
+            self._free.put(bytearray(size))
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+
+    def buffer(self):
+        '''
+        Returns:
+            * (bytearray): a buffer to fill, once the worker is done with
+              it.
+        '''
+        return self._free.get()
+
+    def update(self, buffer, size):
+        '''
+        Hand over the first SIZE bytes of BUFFER to be hashed.
+        '''
+        self._full.put((buffer, size))
+
+    def _run(self):
+        while True:
+            buffer, size = self._full.get()
+            if buffer is None:
+                break
+            # hashlib releases the GIL while hashing large buffers
+            self._hash.update(memoryview(buffer)[:size])
+            self.bytes += size
+            self._free.put(buffer)
+
+    def hexdigest(self):
+        '''
+        Wait for the worker to hash everything handed to it.
+
+        Returns:
+            * (str): the digest of the stream.
+        '''
+        if self._thread.is_alive():
+            self._full.put((None, 0))
+            self._thread.join()
+        return self._hash.hexdigest()
+
+
+class Pump:
+    '''
+    Move a send stream to the receiver through btrsnap, counting the bytes
+    and optionally capping the bandwidth.
+
+    Data is moved from the send pipe into a new pipe for the receiver with
+    os.splice, so it never enters user space. Where splice is unavailable
+    or refused, a copy through a large buffer is used instead. With tee,
+    the stream is copied into several pipes, one for each receiver.
+
+    With CHECKSUM the stream is copied, and each buffer is hashed by a
+    StreamHasher while the next one is moved.
+
+    Args:
+        * limiter (RateLimiter): bandwidth cap, None for no cap.
+        * progress (callable): called as progress(bytes, seconds) at most
+          every PUMP_REPORT_SECONDS while pumping, and once at the end.
+        * checksum (str): hashlib algorithm to hash the stream with.
+
+    Attributes:
+        * bytes (int): bytes moved so far.
+        * seconds (float): time spent pumping.
+        * spliced (bool): os.splice moved the data.
+        * error (Exception): what stopped the pump early, or None. The
+          stream the receivers got is then incomplete.
+        * digest (str): hex digest of the whole stream once the pump
+          finished without error, or None.
+    '''
+
+    def __init__(self, limiter=None, progress=None, checksum=None):
+        self.limiter = limiter
+        self.progress = progress
+        self.checksum = checksum
+        self.bytes = 0
+        self.seconds = 0.0
+        self.spliced = hasattr(os, 'splice') and checksum is None
+        self.error = None
+        self.digest = None
+        self._thread = None
+
+    def start(self, source):
+        '''
+        Start pumping from source in a thread.
+
+        Args:
+            * source (file): readable end of the send stream.
+
+        Returns:
+            * (file): readable end of the pipe to hand to the receiver.
+        '''
+        return self.tee(source, 1)[0]
+
+    def tee(self, source, count):
+        '''
+        Start pumping from source into COUNT pipes in a thread.
+
+        Every pipe gets the whole stream. Writes block until each reader
+        has taken the data, so the slowest reader sets the pace. A pipe
+        whose reader closes it is dropped and the others carry on.
+
+        Args:
+            * source (file): readable end of the send stream.
+            * count (int): number of receivers.
+
+        Returns:
+            * (list(file)): readable ends of the pipes, one per receiver.
+        '''
+        if not count >= 1 or not isinstance(count, int):
+            raise Exception('count must be a positive integer')
+        streams = []
+        destinations = []
+        for _ in range(count):
+            read_fd, write_fd = os.pipe()
+            streams.append(os.fdopen(read_fd, 'rb'))
+            destinations.append(write_fd)
+        self._thread = threading.Thread(target=self._run,
+                                        args=(source.fileno(), destinations))
+        self._thread.start()
+        return streams
+
+    def join(self):
+        '''
+        Wait for the pump to finish.
+        '''
+        if self._thread is not None:
+            self._thread.join()
+
+    def _move(self, source, destinations, buffer):
+        if self.spliced and len(destinations) == 1:
+            try:
+                return os.splice(source, destinations[0], PUMP_CHUNK)
+            except OSError as err:
+                if err.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self.spliced = False
+        self.spliced = False
+        size = os.readv(source, [buffer])
+        for destination in list(destinations):
+            view = memoryview(buffer)[:size]
+            try:
+                while view:
+                    view = view[os.write(destination, view):]
+            except BrokenPipeError:
+                if len(destinations) == 1:
+                    raise
+                destinations.remove(destination)
+                os.close(destination)
+        return size
+
+    def _run(self, source, destinations):
+        start = reported = time.monotonic()
+        buffer = bytearray(PUMP_CHUNK)
+        hasher = None
+        if self.checksum is not None:
+            hasher = StreamHasher(self.checksum)
+        try:
+            while True:
+                if hasher is not None:
+                    buffer = hasher.buffer()
+                size = self._move(source, destinations, buffer)
+                if not size:
+                    break
+                if hasher is not None:
+                    hasher.update(buffer, size)
+                self.bytes += size
+                if self.limiter is not None:
+                    self.limiter.take(size)
+                now = time.monotonic()
+                self.seconds = now - start
+                if (self.progress is not None
+                        and now - reported >= PUMP_REPORT_SECONDS):
+                    reported = now
+                    self.progress(self.bytes, self.seconds)
+        except Exception as err:
+            # the receiver gave up, or the stream is cut short and the
+            # receive must not count, see Btrfs.receive
+            self.error = err
+        finally:
+            for destination in destinations:
+                os.close(destination)
+            if hasher is not None:
+                digest = hasher.hexdigest()
+                if self.error is None:
+                    self.digest = digest
+            self.seconds = time.monotonic() - start
+        if self.progress is not None:
+            try:
+                self.progress(self.bytes, self.seconds)
+            except Exception as err:
+                self.error = err
+
+
+def _megabytes(size, seconds):
+    '''
+    Returns:
+        * (str): SIZE bytes moved in SECONDS as megabytes and MB/s.
+    '''
+    return '{:.1f} MB, {:.1f} MB/s'.format(
+        size / MEGABYTE, size / MEGABYTE / seconds if seconds else 0.0)
+
+
+class Btrfs(Path):
+    '''
+    Wrapper class for BTRFS functions
+
+    Args:
+        * Path (str): Path on filesystem
+        * backend (Backend): carries out the operations. Defaults to a
+          ProgsBackend, which runs btrfs-progs.
+
+    Attributes:
+        * path (str): absolute path
+        * backend (Backend): backend in use.
+
+    Raises:
+        * PathError:
+    '''
+    def __init__(self, path, backend=None):
+        Path.__init__(self, path)
+        self.backend = backend if backend is not None else ProgsBackend()
+
+    def snap(self, target, timestamp, readonly=True):
+        '''
+        Create a snapshot in self.path
+
+        Args:
+            * target (str): absolute path of BTRFS subvolume to be cloned.
+            * timestamp (str): name of the snapshot to be created.
+            * readonly (bool): True/False, new snapshot is readonly.
+
+        Raises:
+            * BtrfsError:
+        '''
+        snapshot = os.path.join(self.path, timestamp)
+        self.backend.snap(target, snapshot, readonly=readonly)
+
+    def snap_args(self, target, timestamp, readonly=True):
+        '''
+        Build the command that snap() runs.
+
+        Args:
+            * target (str): absolute path of BTRFS subvolume to be cloned.
+            * timestamp (str): name of the snapshot to be created.
+            * readonly (bool): True/False, new snapshot is readonly.
+
+        Returns:
+            * (list(str)): command line, or None when the backend does not
+              run commands.
+        '''
+        snapshot = os.path.join(self.path, timestamp)
+        return self.backend.snap_args(target, snapshot, readonly=readonly)
+
+    def unsnap(self, timestamp):
+        '''
+        Delete a snapshot in self.path
+
+        Args:
+            * timestamp (str): name of the snapshot to be deleted.
+
+        Raises:
+            * BtrfsError:
+        '''
+        self.backend.delete(os.path.join(self.path, timestamp))
+
+    def send(self, snapshot, parent=None, clones=()):
+        '''
+        Send a snapshot.
+
+        Args:
+            * snapshot (str): name of snapshot to be sent.
+            * parent (str): name of parent snapshot alread on
+            receiving filesystem.
+            * clones (list(str)): names of clone source snapshots already on
+              the receiving filesystem.
+
+        Returns:
+            * (subprocess.Popen): can be used to pipe output to receive.
+        '''
+        if parent:
+            parent = os.path.join(self.path, parent)
+        clones = [os.path.join(self.path, clone) for clone in clones]
+        return self.backend.send(os.path.join(self.path, snapshot), parent,
+                                 clones)
+
+    def receive(self, p1, pump=None):
+        '''
+        Receive a snapshot.
+
+        Args:
+            * p1 (subprocess.Popen): send process
+            * pump (Pump): optional pump to move the stream through.
+
+        Raises:
+            * BtrfsError: the send, the receive or the pump failed.
+        '''
+        stream = p1.stdout if pump is None else pump.start(p1.stdout)
+        try:
+            self.backend.receive(self.path, stream)
+        finally:
+            if pump is not None:
+                stream.close()
+                pump.join()
+            p1.stdout.close()
+            return_code = p1.wait()
+        if pump is not None and pump.error is not None:
+            raise BtrfsError('Pumping the send stream failed: {}'.format(
+                pump.error))
+        if return_code:
+            raise BtrfsError('BTRFS send failed with exit status {}'.format(
+                return_code))
+
+    def list(self):
+        '''
+        Returns:
+            * (list(dict)): the subvolumes in self.path, see Backend.list.
+        '''
+        return self.backend.list(self.path)
+
+    def show(self, name):
+        '''
+        Args:
+            * name (str): name of a subvolume in self.path.
+
+        Returns:
+            * (dict): see Backend.show.
+        '''
+        return self.backend.show(os.path.join(self.path, name))
+
+
+class RemoteBtrfs(Btrfs):
+    '''
+    Btrfs for a path on another host, see Transport. The path is not
+    checked.
+
+    Args:
+        * path (str): path on the other host.
+        * transport (Transport): the connection to the other host.
+    '''
+    def __init__(self, path, transport):
+        self.path = posixpath.normpath(path)
+        self.backend = RemoteBackend(transport)
+
+
+def _receive_many(p1, receivers, pump):
+    '''
+    Receive one send stream into several paths at once.
+
+    PUMP tees the stream into one pipe per receiver and each receive runs
+    in its own thread. A receiver that fails does not stop the others.
+
+    Args:
+        * p1 (subprocess.Popen): send process.
+        * receivers (list(Btrfs)): paths to receive into.
+        * pump (Pump): pump to tee the stream with.
+
+    Returns:
+        * (list(Exception)): the error of each receiver, or None.
+
+    Raises:
+        * BtrfsError: the send or the pump failed.
+    '''
+    streams = pump.tee(p1.stdout, len(receivers))
+    errors = [None] * len(receivers)
+
+    def receive(number):
+        try:
+            receivers[number].backend.receive(receivers[number].path,
+                                              streams[number])
+        except Exception as err:
+            errors[number] = err
+        finally:
+            streams[number].close()
+
+    threads = [threading.Thread(target=receive, args=(number,))
+               for number in range(len(receivers))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pump.join()
+    p1.stdout.close()
+    return_code = p1.wait()
+    if pump.error is not None:
+        raise BtrfsError('Pumping the send stream failed: {}'.format(
+            pump.error))
+    if return_code:
+        raise BtrfsError('BTRFS send failed with exit status {}'.format(
+            return_code))
+    return errors
+
+
+def _mounts(text=None):
+    '''
+    Read the mount table of this process.
+
+    Args:
+        * text (str): contents of a mountinfo file to parse instead, for
+          example from another host.
+
+    Returns:
+        * (list(dict)): one dict per mount with keys device ('major:minor'
+          of the filesystem), root (path inside the filesystem that is
+          mounted), mountpoint, fstype and source. Longest mountpoint first.
+    '''
+    def unescape(field):
+        return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)),
+                      field)
+
+    mounts = []
+    if text is not None:
+        lines = text.splitlines()
+    else:
+        try:
+            with open('/proc/self/mountinfo') as f:
+                lines = f.readlines()
+        except OSError:
+            return mounts
+    for line in lines:
+        fields = line.split()
+        separator = fields.index('-')
+        mounts.append({'device': fields[2],
+                       'root': unescape(fields[3]),
+                       'mountpoint': unescape(fields[4]),
+                       'fstype': fields[separator + 1],
+                       'source': unescape(fields[separator + 2])})
+    mounts.sort(key=lambda mount: len(mount['mountpoint']), reverse=True)
+    return mounts
+
+
+def _mount(path, mounts, resolved=False):
+    '''
+    Returns:
+        * (dict): the entry of mounts holding path, or None. See
+          _toplevel_path for resolved.
+    '''
+    if not resolved:
+        path = os.path.realpath(path)
+    for mount in mounts:
+        mountpoint = mount['mountpoint']
+        if (path == mountpoint or mountpoint == '/'
+                or path.startswith(mountpoint + os.path.sep)):
+            return mount
+    return None
+
+
+def _filesystem(path, mounts):
+    '''
+    Identify the filesystem holding path.
+
+    Every BTRFS subvolume reports its own st_dev, so the device of the
+    mount holding path is used instead. st_dev is the fallback when the
+    mount table can not be read.
+
+    Args:
+        * path (str): path on the filesystem.
+        * mounts (list(dict)): mount table from _mounts().
+
+    Returns:
+        * (str): identifier shared by every path on the same filesystem.
+    '''
+    mount = _mount(path, mounts)
+    if mount is not None:
+        return mount['device']
+    return 'st_dev:{}'.format(os.stat(path).st_dev)
+
+
+def _run_limited(tasks, jobs):
+    '''
+    Run tasks on up to JOBS threads.
+
+    A task only starts when every resource it holds has fewer tasks running
+    than the limit of that resource. Waiting tasks do not occupy a thread,
+    so a busy resource never starves the others.
+
+    Args:
+        * tasks (list(tuple)): (func, resources) where func takes no
+          arguments and resources is a list of (key, limit) tuples.
+        * jobs (int): number of threads.
+
+    Returns:
+        * (list(tuple)): (result, error, seconds) for each task, in order.
+          error is the exception raised by func or None.
+    '''
+    if not jobs >= 1 or not isinstance(jobs, int):
+        raise Exception('jobs must be a positive integer')
+    results = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    running = {}
+    condition = threading.Condition()
+
+    def runnable(number):
+        return all(running.get(key, 0) < limit
+                   for key, limit in tasks[number][1])
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if not pending:
+                        return
+                    number = next((n for n in pending if runnable(n)), None)
+                    if number is not None:
+                        break
+                    condition.wait()
+                pending.remove(number)
+                func, resources = tasks[number]
+                for key, limit in resources:
+                    running[key] = running.get(key, 0) + 1
+            start = time.monotonic()
+            try:
+                results[number] = (func(), None, time.monotonic() - start)
+            except Exception as err:
+                results[number] = (None, err, time.monotonic() - start)
+            with condition:
+                for key, limit in resources:
+                    running[key] -= 1
+                condition.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(jobs, len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def snap(path, readonly=True, index=None, resolution='day', backend=None):
+    '''
+    Creates a snapshot inside PATH with format YYYY-MM-DD-####
+    of the subvolume pointed to by the symlink inside PATH.
+
+    Args:
+        * path (str): path on filesystem
+        * readonly (bool): create readonly snapshot?
+        * index (SnapshotIndex): optional index to read PATH from.
+        * resolution (str): timestamp format, see SnapPath.timestamp.
+        * backend: Btrfs backend, see get_backend.
+    '''
+    _snap(SnapPath(path, index=index), readonly, resolution, backend)
+
+
+def _snap(snappath, readonly, resolution, backend):
+    '''
+    Create the next snapshot in a SnapPath.
+
+    Returns:
+        * (Snapshot): the snapshot created.
+    '''
+    btrfs = Btrfs(snappath.path, backend=backend)
+    timestamp = snappath.timestamp(resolution=resolution)
+    btrfs.snap(snappath.target, timestamp, readonly=readonly)
+    return timestamp
+
+
+def _dirty_bytes():
+    '''
+    Returns:
+        * (int): bytes of dirty page cache waiting to be written back, from
+          /proc/meminfo. 0 when it can not be read.
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('Dirty:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+class DeletionQueue(Path):
+    '''
+    Snapshots waiting to be deleted, kept in a queue file (.btrsnap-queue)
+    inside PATH so they can be deleted slowly by drain() instead of all at
+    once. The queue also records the last drain runs to report throughput.
+
+    Every change locks the queue file and rewrites it in place, so several
+    btrsnap processes can share a queue.
+
+    Args:
+        * path (str): directory holding the queue file.
+
+    Attributes:
+        * path (str): absolute path
+        * file (str): absolute path of the queue file.
+
+    Raises:
+        * PathError:
+    '''
+
+    def __init__(self, path):
+        Path.__init__(self, path)
+        self.file = os.path.join(self.path, QUEUE_FILE)
+
+    @staticmethod
+    def _empty():
+        return {'version': QUEUE_VERSION, 'snapshots': [], 'runs': []}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Lock the queue file and yield its data, writing it back afterwards.
+        '''
+        fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                data = json.load(f)
+            except ValueError:
+                data = None
+            if (not isinstance(data, dict)
+                    or data.get('version') != QUEUE_VERSION):
+                data = self._empty()
+            yield data
+            f.seek(0)
+            f.truncate()
+            json.dump(data, f, separators=(',', ':'))
+
+    def read(self):
+        '''
+        Returns:
+            * (dict): queue data with keys snapshots, a list of dicts with
+              keys path and queued (epoch seconds), and runs, a list of
+              dicts with keys started, elapsed, waited and deleted.
+        '''
+        try:
+            with open(self.file) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if not isinstance(data, dict) or data.get('version') != QUEUE_VERSION:
+            data = self._empty()
+        return data
+
+    def add(self, snapshots):
+        '''
+        Queue snapshots for deletion. Snapshots already queued are skipped.
+
+        Args:
+            * snapshots (list(str)): absolute paths of the snapshots.
+
+        Returns:
+            * (int): number of snapshots added.
+        '''
+        now = time.time()
+        with self._locked() as data:
+            queued = set(snapshot['path'] for snapshot in data['snapshots'])
+            added = [snapshot for snapshot in snapshots
+                     if snapshot not in queued]
+            data['snapshots'].extend({'path': snapshot, 'queued': now}
+                                     for snapshot in added)
+        return len(added)
+
+    def _update(self, run, gone):
+        with self._locked() as data:
+            if gone:
+                data['snapshots'] = [snapshot for snapshot
+                                     in data['snapshots']
+                                     if snapshot['path'] not in gone]
+            runs = [previous for previous in data['runs']
+                    if previous['started'] != run['started']]
+            data['runs'] = (runs + [dict(run)])[-QUEUE_RUNS:]
+            return [snapshot['path'] for snapshot in data['snapshots']]
+
+    def drain(self, backend=None, rate=None, batch_size=None, commit=None,
+              max_dirty=None, max_cleaner=None, limit=None,
+              interval=QUEUE_POLL_SECONDS):
+        '''
+        Delete queued snapshots, oldest queued first.
+
+        Deletions are paced to RATE snapshots per minute and sent in
+        batches of snapshots on the same filesystem. Before every batch the
+        dirty page cache and the number of deleted subvolumes btrfs-cleaner
+        has yet to clean are checked; while either is over its threshold
+        draining waits INTERVAL seconds at a time. Snapshots that no longer
+        exist are dropped from the queue.
+
+        Args:
+            * backend: Btrfs backend, see get_backend.
+            * rate (float): snapshots per minute, None for no limit.
+            * batch_size (int): most snapshots deleted at once, default
+              DELETE_BATCH_SIZE.
+            * commit (str): see COMMIT_MODES.
+            * max_dirty (int): bytes of dirty page cache to wait below.
+            * max_cleaner (int): number of subvolumes waiting for
+              btrfs-cleaner to wait below.
+            * limit (int): stop after deleting LIMIT snapshots.
+            * interval (float): seconds between threshold checks.
+
+        Returns:
+            * (dict): the drain run, with keys started (epoch seconds),
+              elapsed and waited (seconds) and deleted.
+
+        Raises:
+            * BtrfsError: a batch failed. Its snapshots stay queued.
+        '''
+        if batch_size is None:
+            batch_size = DELETE_BATCH_SIZE
+        if not batch_size >= 1 or not isinstance(batch_size, int):
+            raise Exception('batch_size must be a positive integer')
+        if rate is not None and not rate > 0:
+            raise Exception('rate must be a positive number')
+        if backend is None:
+            backend = ProgsBackend()
+        mounts = _mounts()
+        filesystems = {}
+        run = {'started': time.time(), 'elapsed': 0.0, 'waited': 0.0,
+               'deleted': 0}
+        start = last = time.monotonic()
+        # a token bucket holding up to one batch, refilled at RATE
+        tokens = 1.0
+        pending = self._update(run, ())
+        while pending and (limit is None or run['deleted'] < limit):
+            if ((max_dirty is not None and _dirty_bytes() > max_dirty)
+                    or (max_cleaner is not None and backend.cleaning(
+                        os.path.dirname(pending[0])) > max_cleaner)):
+                time.sleep(interval)
+                run['waited'] += interval
+                continue
+            count = batch_size
+            if rate is not None:
+                now = time.monotonic()
+                tokens = min(batch_size, tokens + (now - last) * rate / 60)
+                last = now
+                if tokens < 1:
+                    time.sleep((1 - tokens) * 60 / rate)
+                    continue
+                count = int(tokens)
+            if limit is not None:
+                count = min(count, limit - run['deleted'])
+
+            batch = []
+            gone = []
+            filesystem = None
+            for snapshot in pending:
+                if not os.path.lexists(snapshot):
+                    gone.append(snapshot)
+                    continue
+                parent = os.path.dirname(snapshot)
+                if parent not in filesystems:
+                    filesystems[parent] = _filesystem(parent, mounts)
+                if filesystem is None:
+                    filesystem = filesystems[parent]
+                if filesystems[parent] == filesystem:
+                    batch.append(snapshot)
+                    if len(batch) == count:
+                        break
+            error = None
+            if batch:
+                try:
+                    backend.delete_batch(batch, commit=commit)
+                except BtrfsError as err:
+                    error = err
+            deleted = [snapshot for snapshot in batch
+                       if not os.path.lexists(snapshot)]
+            if batch and not deleted and error is None:
+                error = 'the snapshots still exist'
+            tokens -= len(batch)
+            run['deleted'] += len(deleted)
+            run['elapsed'] = time.monotonic() - start
+            pending = self._update(run, set(gone + deleted))
+            if error is not None:
+                raise BtrfsError('Stopped draining \'{}\' after {}'
+                                 ' snapshot(s): {}'.format(
+                                     self.path, run['deleted'], error))
+        run['elapsed'] = time.monotonic() - start
+        self._update(run, ())
+        return run
+
+
+def parse_age(text):
+    '''
+    Args:
+        * text (str): a number followed by a unit of AGE_UNITS, like '36h'
+          or '90d'. A month is 30 days and a year 365 days.
+
+    Returns:
+        * (datetime.timedelta): the age.
+
+    Raises:
+        * ValueError: text is not an age.
+    '''
+    match = re.match(r'^(\d+)([{}])$'.format(''.join(AGE_UNITS)),
+                     text.strip())
+    if match is None:
+        raise ValueError('{!r} is not an age like 36h, 90d, 6w, 3m or'
+                         ' 1y'.format(text))
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+class RetentionPolicy:
+    '''
+    Decide which snapshots to keep: the KEEP newest, plus the newest
+    snapshot of each of the most recent hours, days, ISO weeks, months and
+    years that have snapshots, up to the number given for each bucket.
+    Snapshots older than MAX_AGE are deleted even when a bucket would keep
+    them, but the KEEP newest are always kept. Without buckets, every
+    snapshot younger than MAX_AGE is kept.
+
+    YYYY-MM-DD-#### snapshots have no time of day: the hourly bucket
+    skips them while the other buckets still apply, and their age is
+    counted from the end of their day so MAX_AGE never deletes them early.
+
+    Args:
+        * keep (int): number of newest snapshots always kept.
+        * hourly, daily, weekly, monthly, yearly (int): number of periods
+          of each length to keep a snapshot for.
+        * max_age (datetime.timedelta): age beyond which snapshots are
+          deleted, None for no limit.
+
+    Attributes:
+        * keep (int): see Args.
+        * buckets (dict): number of periods to keep for each of
+          RETENTION_BUCKETS.
+        * max_age (datetime.timedelta): see Args.
+    '''
+
+    def __init__(self, keep=1, hourly=0, daily=0, weekly=0, monthly=0,
+                 yearly=0, max_age=None):
+        self.keep = keep
+        self.buckets = {'hourly': hourly, 'daily': daily, 'weekly': weekly,
+                        'monthly': monthly, 'yearly': yearly}
+        self.max_age = max_age
+        for name, number in [('keep', keep)] + list(self.buckets.items()):
+            if not number >= 0 or not isinstance(number, int):
+                raise Exception('{} must be a positive integer or'
+                                ' 0'.format(name))
+        if max_age is not None and not max_age > datetime.timedelta(0):
+            raise Exception('max_age must be positive')
+
+    @staticmethod
+    def _periods(snapshot):
+        '''
+        Returns:
+            * (tuple): the hour, day, ISO week, month and year of SNAPSHOT,
+              in the order of RETENTION_BUCKETS.
+        '''
+        when = snapshot.datetime
+        day = when.toordinal()
+        # monday of the ISO week
+        return ((day, when.hour), day, day - when.weekday(),
+                (when.year, when.month), when.year)
+
+    @staticmethod
+    def _newest(snapshot):
+        '''
+        Returns:
+            * (datetime.datetime): the latest time SNAPSHOT can have been
+              taken, the end of its day for YYYY-MM-DD-#### snapshots.
+        '''
+        if snapshot.resolution == 'day':
+            return snapshot.datetime + datetime.timedelta(days=1)
+        return snapshot.datetime
+
+    def plan(self, snapshots, now=None):
+        '''
+        Decide the fate of every snapshot in one pass, newest first.
+
+        Args:
+            * snapshots (list(Snapshot)): snapshots newest first, as
+              SnapshotsMixin.snapshots returns them.
+            * now (datetime.datetime): time to measure ages from, default
+              the current time.
+
+        Returns:
+            * (list(tuple)): (snapshot, reasons) in the order of SNAPSHOTS.
+              reasons lists 'keep', the buckets and 'max-age' that keep the
+              snapshot, it is empty for snapshots to delete.
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        oldest = now - self.max_age if self.max_age is not None else None
+        wanted = [(position, name, self.buckets[name])
+                  for position, name in enumerate(RETENTION_BUCKETS)
+                  if self.buckets[name]]
+        last = [None] * len(RETENTION_BUCKETS)
+        kept = [0] * len(RETENTION_BUCKETS)
+        plan = []
+        for number, snapshot in enumerate(snapshots):
+            reasons = ['keep'] if number < self.keep else []
+            if not wanted:
+                if oldest is not None and self._newest(snapshot) >= oldest:
+                    reasons.append('max-age')
+            elif oldest is None or self._newest(snapshot) >= oldest:
+                periods = self._periods(snapshot)
+                for position, name, limit in wanted:
+                    if name == 'hourly' and snapshot.resolution == 'day':
+                        continue
+                    period = periods[position]
+                    if period != last[position] and kept[position] < limit:
+                        kept[position] += 1
+                        reasons.append(name)
+                    last[position] = period
+            plan.append((snapshot, reasons))
+        return plan
+
+    def __str__(self):
+        parts = ['keep {}'.format(self.keep)]
+        parts.extend('{} {}'.format(name, self.buckets[name])
+                     for name in RETENTION_BUCKETS if self.buckets[name])
+        if self.max_age is not None:
+            parts.append('max age {}'.format(self.max_age))
+        return ', '.join(parts)
+
+
+def _expired(snappath, keep, queued=False, policy=None, dry_run=False):
+    '''
+    Find the snapshots of snappath beyond the KEEP most recent, or those
+    POLICY does not keep.
+
+    Args:
+        * queued (bool): word the message for snapshots that are queued
+          rather than deleted.
+        * policy (RetentionPolicy): decides instead of KEEP.
+        * dry_run (bool): word the message as a plan and list every
+          snapshot with the buckets keeping it.
+
+    Returns:
+        * (tuple): (paths, msg) absolute paths of the snapshots to delete
+          and the message reporting it.
+    '''
+    snapshots = snappath.snapshots()
+    if dry_run and policy is None:
+        policy = RetentionPolicy(keep=keep)
+    if policy is not None:
+        plan = policy.plan(snapshots)
+        expired = [snapshot for snapshot, reasons in plan if not reasons]
+        msg = '{} {} snapshot(s) from "{}"{}. {} kept ({})'.format(
+            'Would ' + ('queue' if queued else 'delete') if dry_run
+            else 'Queued' if queued else 'Deleted',
+            len(expired), snappath.path,
+            ' for deletion' if queued else '',
+            len(plan) - len(expired), policy)
+        if dry_run:
+            msg = '\n'.join([msg] + [
+                '\t{}: {}'.format(snapshot, ', '.join(reasons) or 'delete')
+                for snapshot, reasons in plan])
+        return [os.path.join(snappath.path, snapshot.name)
+                for snapshot in expired], msg
+
+    if not keep >= 0 or not isinstance(keep, int):
+        raise Exception('keep must be a positive integer')
+    if len(snapshots) > keep:
+        snaps_to_delete = snapshots[keep:]
+        msg = '{} {} snapshot(s) from "{}"{}. {} kept'.format(
+            'Queued' if queued else 'Deleted', len(snaps_to_delete),
+            snappath.path, ' for deletion' if queued else '', keep)
+        return [os.path.join(snappath.path, snapshot.name)
+                for snapshot in snaps_to_delete], msg
+    msg = ('There are less than {} snapshot(s) in "{}"...'
+           ' not deleting any'.format(keep, snappath.path))
+    return [], msg
+
+
+def _delete_batches(snapshots, backend, batch_size, commit):
+    '''
+    Delete snapshots, all on one filesystem, BATCH_SIZE at a time.
+    '''
+    if batch_size is None:
+        batch_size = DELETE_BATCH_SIZE
+    if not batch_size >= 1 or not isinstance(batch_size, int):
+        raise Exception('batch_size must be a positive integer')
+    if commit is not None and commit not in COMMIT_MODES:
+        raise Exception('commit must be one of {}'.format(
+            ', '.join(COMMIT_MODES)))
+    if backend is None:
+        backend = ProgsBackend()
+    for start in range(0, len(snapshots), batch_size):
+        backend.delete_batch(snapshots[start:start + batch_size],
+                             commit=commit)
+
+
+class FreeTarget:
+    '''
+    Free space delete --free deletes snapshots until it reaches.
+
+    Args:
+        * text (str): bytes with an optional suffix of SIZE_UNITS, like
+          '20G', or a percentage of the filesystem, like '10%'.
+
+    Attributes:
+        * bytes (int): free bytes wanted, None for a percentage.
+        * percent (float): free percentage wanted, None for bytes.
+
+    Raises:
+        * ValueError: text is not a size or percentage.
+    '''
+
+    def __init__(self, text):
+        match = re.match(r'^(\d+(?:\.\d+)?)([{}%]?)$'.format(
+            ''.join(SIZE_UNITS)), text.strip().upper())
+        if match is None:
+            raise ValueError('{!r} is not a size like 500M or 20G or a'
+                             ' percentage like 10%'.format(text))
+        number = float(match.group(1))
+        unit = match.group(2)
+        self.bytes = None
+        self.percent = None
+        if unit == '%':
+            if not 0 < number < 100:
+                raise ValueError('the percentage must be between 0 and'
+                                 ' 100')
+            self.percent = number
+        else:
+            self.bytes = int(number * SIZE_UNITS.get(unit, 1))
+
+    def needed(self, size):
+        '''
+        Args:
+            * size (int): bytes of the filesystem.
+
+        Returns:
+            * (int): free bytes wanted on it.
+        '''
+        if self.percent is not None:
+            return int(size * self.percent / 100)
+        return self.bytes
+
+    def __str__(self):
+        if self.percent is not None:
+            return '{:g}%'.format(self.percent)
+        return _size(self.bytes)
+
+
+def _size(number):
+    '''
+    Returns:
+        * (str): NUMBER bytes with the largest fitting suffix of SIZE_UNITS.
+    '''
+    for unit, factor in sorted(SIZE_UNITS.items(), key=lambda item: item[1],
+                               reverse=True):
+        if number >= factor:
+            return '{:.1f}{}'.format(number / factor, unit)
+    return '{}B'.format(number)
+
+
+def _delete_until_free(snapshots, target, backend, batch_size,
+                       interval=QUEUE_POLL_SECONDS):
+    '''
+    Delete snapshots, all on one filesystem, in the order given until
+    TARGET is free.
+
+    BTRFS frees the space of deleted subvolumes in the background, so
+    statvfs alone would keep asking for more deletions than needed. After
+    each batch is committed the free space is polled until it reaches
+    TARGET or btrfs-cleaner has no deleted subvolumes left. The next batch
+    is sized from the space freed per snapshot so far, starting with
+    FREE_FIRST_BATCH snapshots and doubling while nothing was freed.
+
+    Args:
+        * snapshots (list(str)): paths of the snapshots, oldest first.
+        * target (FreeTarget): free space to reach.
+        * backend: Btrfs backend, see get_backend.
+        * batch_size (int): most snapshots deleted at once.
+        * interval (float): seconds between free space checks.
+
+    Returns:
+        * (dict): deleted (list of the paths deleted), free and needed
+          (bytes), waited (seconds spent waiting for btrfs-cleaner).
+    '''
+    path = os.path.dirname(snapshots[0])
+    free, size = backend.free_space(path)
+    needed = target.needed(size)
+    first = free
+    result = {'deleted': [], 'free': free, 'needed': needed, 'waited': 0.0}
+    count = FREE_FIRST_BATCH
+    while free < needed and len(result['deleted']) < len(snapshots):
+        done = len(result['deleted'])
+        batch = snapshots[done:done + min(count, batch_size)]
+        backend.delete_batch(batch, commit='after')
+        result['deleted'].extend(batch)
+        while True:
+            cleaning = backend.cleaning(path)
+            free = backend.free_space(path)[0]
+            if free >= needed or not cleaning:
+                break
+            time.sleep(interval)
+            result['waited'] += interval
+        if free > first:
+            count = math.ceil((needed - free) * len(result['deleted'])
+                              / (free - first))
+        else:
+            count *= 2
+        count = max(count, 1)
+    result['free'] = free
+    return result
+
+
+def _check_free(free, queue, by_size):
+    if free is not None and queue:
+        raise Exception('free can not be combined with queue')
+    if free is None and by_size:
+        raise Exception('by_size needs free')
+
+
+def _exclusive(paths, backend):
+    '''
+    Read the exclusive sizes of the subvolumes in PATHS, all on one
+    filesystem, with one listing and one qgroup query.
+
+    Returns:
+        * (dict): path of each subvolume, inside one of PATHS as given, to
+          the bytes deleting it alone would free.
+    '''
+    listing, _ = backend.list_filesystem(paths)
+    qgroups = backend.qgroups(paths[0])
+    return {os.path.join(path, os.path.basename(subvolume['path'])):
+            qgroups.get(subvolume['id'], {}).get('exclusive', 0)
+            for path, subvolumes in listing.items()
+            for subvolume in subvolumes}
+
+
+def _free_plan(order, exclusive, target, backend, name):
+    '''
+    Choose the first snapshots of ORDER whose exclusive sizes add up to the
+    space TARGET is missing. Shared data is freed once every snapshot
+    sharing it is gone, so the estimate is a lower bound. EXCLUSIVE is None
+    when the sizes are unknown, then the plan only lists ORDER.
+
+    Returns:
+        * msg (str): the plan, with the estimated reclaim of every
+          snapshot.
+    '''
+    free, size = backend.free_space(os.path.dirname(order[0]))
+    needed = target.needed(size)
+    if exclusive is None:
+        msg = ['Would delete up to {} snapshot(s) on "{}" in this order until'
+               ' {} is free, {} free now. Exclusive sizes need quotas'.format(
+                   len(order), name, _size(needed), _size(free))]
+        msg.extend('\t{}'.format(snapshot) for snapshot in order)
+        return msg
+    chosen = 0
+    estimate = 0
+    for snapshot in order:
+        if free + estimate >= needed:
+            break
+        estimate += exclusive.get(snapshot, 0)
+        chosen += 1
+    msg = ['Would delete {} of {} snapshot(s) on "{}" to free an estimated'
+           ' {}: {} free of {} wanted{}'.format(
+               chosen, len(order), name, _size(estimate), _size(free),
+               _size(needed), '' if free + estimate >= needed
+               else '. Not enough snapshots to delete')]
+    for number, snapshot in enumerate(order):
+        msg.append('\t{}: {}{} exclusive'.format(
+            snapshot, 'delete, ' if number < chosen else '',
+            _size(exclusive.get(snapshot, 0))))
+    return msg
+
+
+def _free(snappaths, keep, target, backend, batch_size, policy=None,
+          by_size=False, dry_run=False):
+    '''
+    Delete snapshots of SNAPPATHS until TARGET is free on each filesystem,
+    the oldest first across SNAPPATHS, or those holding the most exclusive
+    data first with BY_SIZE. The KEEP newest snapshots of each SnapPath,
+    or those POLICY keeps, are never deleted.
+
+    Returns:
+        * msg (str): results, or the plan with DRY_RUN.
+    '''
+    if policy is None and (not keep >= 0 or not isinstance(keep, int)):
+        raise Exception('keep must be a positive integer')
+    if batch_size is None:
+        batch_size = DELETE_BATCH_SIZE
+    if not batch_size >= 1 or not isinstance(batch_size, int):
+        raise Exception('batch_size must be a positive integer')
+    if backend is None:
+        backend = ProgsBackend()
+    mounts = _mounts()
+    filesystems = {}
+    names = {}
+    msg = []
+    for snappath in snappaths:
+        snapshots = snappath.snapshots()
+        if policy is None:
+            expired = snapshots[keep:]
+        else:
+            expired = [snapshot for snapshot, reasons
+                       in policy.plan(snapshots) if not reasons]
+        if not expired:
+            msg.append('Every snapshot in "{}" is kept ({})... not deleting'
+                       ' any'.format(snappath.path, policy or
+                                     'keep {}'.format(keep)))
+            continue
+        filesystem = _filesystem(snappath.path, mounts)
+        if filesystem not in filesystems:
+            mount = _mount(snappath.path, mounts)
+            names[filesystem] = (snappath.path if mount is None
+                                 else mount['mountpoint'])
+            filesystems[filesystem] = ([], [])
+        filesystems[filesystem][0].append(snappath.path)
+        filesystems[filesystem][1].extend(
+            (snapshot.key, os.path.join(snappath.path, snapshot.name))
+            for snapshot in expired)
+    for filesystem, (paths, candidates) in filesystems.items():
+        candidates.sort()
+        order = [path for _, path in candidates]
+        exclusive = None
+        if by_size:
+            exclusive = _exclusive(paths, backend)
+            # stable, so the oldest of equal sizes go first
+            order.sort(key=lambda path: exclusive.get(path, 0),
+                       reverse=True)
+        elif dry_run:
+            try:
+                exclusive = _exclusive(paths, backend)
+            except BtrfsError:
+                # no quotas, the age-ordered plan goes without sizes
+                pass
+        if dry_run:
+            msg.extend(_free_plan(order, exclusive, target, backend,
+                                  names[filesystem]))
+            continue
+        result = _delete_until_free(order, target, backend, batch_size)
+        counts = collections.Counter(os.path.dirname(snapshot)
+                                     for snapshot in result['deleted'])
+        for parent, count in sorted(counts.items()):
+            msg.append('Deleted {} snapshot(s) from "{}"'.format(count,
+                                                                 parent))
+        msg.append('{} free of {} wanted on "{}" after deleting {} of {}'
+                   ' snapshot(s), waited {:.1f}s for btrfs-cleaner{}'.format(
+                       _size(result['free']), _size(result['needed']),
+                       names[filesystem], len(result['deleted']),
+                       len(candidates), result['waited'],
+                       '' if result['free'] >= result['needed']
+                       else '. Not enough snapshots to delete'))
+    return '\n'.join(msg)
+
+
+def unsnap(path, keep=5, index=None, backend=None, batch_size=None,
+           commit=None, queue=False, policy=None, dry_run=False, free=None,
+           by_size=False):
+    '''
+    Delete all but most recent KEEP(default 5) snapshots inside PATH, or
+    the snapshots POLICY does not keep.
+
+    Args:
+        * path (str): path on filesystem
+        * keep (int): number of snapshots to keep
+        * index (SnapshotIndex): optional index to read PATH from.
+        * backend: Btrfs backend, see get_backend.
+        * batch_size (int): snapshots deleted per batch, default
+          DELETE_BATCH_SIZE.
+        * commit (str): wait for the deletions to be committed, 'after'
+          each batch or after 'each' snapshot. See COMMIT_MODES.
+        * queue (bool): add the snapshots to the DeletionQueue in PATH
+          instead of deleting them.
+        * policy (RetentionPolicy): decides which snapshots to keep
+          instead of KEEP.
+        * dry_run (bool): only show which snapshots would be kept, and
+          why.
+        * free (FreeTarget): instead, delete the oldest snapshots KEEP or
+          POLICY do not keep until this much space is free, committing
+          every batch. With DRY_RUN, show the exclusive size of each from
+          qgroups and which would be deleted.
+        * by_size (bool): with FREE, delete the snapshots holding the most
+          exclusive data first instead of the oldest. Needs qgroups.
+
+    Returns:
+        * msg (str): results
+    '''
+    snappath = ReceivePath(path, index=index)
+    _check_free(free, queue, by_size)
+    if free is not None:
+        return _free([snappath], keep, free, backend, batch_size,
+                     policy=policy, by_size=by_size, dry_run=dry_run)
+    snapshots, msg = _expired(snappath, keep, queued=queue, policy=policy,
+                              dry_run=dry_run)
+    if dry_run:
+        return msg
+    if queue:
+        # oldest first, so drain deletes the oldest snapshots first
+        DeletionQueue(snappath.path).add(snapshots[::-1])
+    else:
+        _delete_batches(snapshots, backend, batch_size, commit)
+    return msg
+
+
+def unsnap_deep(path, keep=5, index=False, backend=None, batch_size=None,
+                commit=None, queue=False, policy=None, dry_run=False,
+                free=None, by_size=False):
+    '''
+    Delete all but KEEP (default 5) snapshots from each directory
+    inside of path, or the snapshots POLICY does not keep.
+
+    Snapshots on the same filesystem are deleted together, in batches that
+    span directories.
+
+    Args:
+        * path (str): path on filesystem
+        * keep (int): number of snapshots to keep
+        * index (bool or SnapshotIndex): read and update the snapshot
+          index in PATH, or use the one given as it is.
+        * backend: Btrfs backend, see get_backend.
+        * batch_size (int): snapshots deleted per batch, default
+          DELETE_BATCH_SIZE.
+        * commit (str): wait for the deletions to be committed, 'after'
+          each batch or after 'each' snapshot. See COMMIT_MODES.
+        * queue (bool): add the snapshots to the DeletionQueue in PATH
+          instead of deleting them.
+        * policy (RetentionPolicy): see unsnap.
+        * dry_run (bool): see unsnap.
+        * free (FreeTarget): see unsnap. Snapshots on the same filesystem
+          are deleted oldest first, whichever directory holds them.
+        * by_size (bool): see unsnap. Sizes are compared across the
+          directories on a filesystem.
+
+    Returns:
+        * msg (str): results
+    '''
+    _check_free(free, queue, by_size)
+    msg = []
+    index = _index(index)
+    receive_deep = ReceiveDeep(path, index=index)
+    receive_paths = receive_deep.receive_paths()
+    if len(receive_paths) == 0:
+        msg = 'No subdirectories found in \'{}\''.format(receive_deep.path)
+        return msg
+    if free is not None:
+        msg = _free(receive_paths, keep, free, backend, batch_size,
+                    policy=policy, by_size=by_size, dry_run=dry_run)
+        if index is not None:
+            index.save()
+        return msg
+    mounts = _mounts()
+    filesystems = {}
+    for receive_path in receive_paths:
+        snapshots, message = _expired(receive_path, keep, queued=queue,
+                                      policy=policy, dry_run=dry_run)
+        msg.append(message)
+        if snapshots and not dry_run:
+            filesystem = _filesystem(receive_path.path, mounts)
+            filesystems.setdefault(filesystem, []).extend(
+                snapshots[::-1] if queue else snapshots)
+    if queue:
+        DeletionQueue(receive_deep.path).add(
+            [snapshot for snapshots in filesystems.values()
+             for snapshot in snapshots])
+    else:
+        for snapshots in filesystems.values():
+            _delete_batches(snapshots, backend, batch_size, commit)
+    if index is not None:
+        index.save()
+    return '\n'.join(msg)
+
+
+def drain(path, backend=None, rate=None, batch_size=None, commit=None,
+          max_dirty=None, max_cleaner=None, limit=None):
+    '''
+    Delete the snapshots queued in PATH by delete --queue.
+
+    Args:
+        * path (str): directory holding the queue.
+        * backend: Btrfs backend, see get_backend.
+        * rate (float): snapshots per minute, None for no limit.
+        * batch_size (int): most snapshots deleted at once.
+        * commit (str): see COMMIT_MODES.
+        * max_dirty (int): wait while the dirty page cache holds more
+          bytes than this.
+        * max_cleaner (int): wait while more deleted subvolumes than this
+          are waiting for btrfs-cleaner.
+        * limit (int): stop after deleting LIMIT snapshots.
+
+    Returns:
+        * msg (str): results
+    '''
+    queue = DeletionQueue(path)
+    run = queue.drain(backend=backend, rate=rate, batch_size=batch_size,
+                      commit=commit, max_dirty=max_dirty,
+                      max_cleaner=max_cleaner, limit=limit)
+    remaining = len(queue.read()['snapshots'])
+    return ('Deleted {} snapshot(s) from the queue in \'{}\' in {:.1f}s'
+            ' ({:.1f}/min), waited {:.1f}s for the backlog. {} still'
+            ' queued'.format(run['deleted'], queue.path, run['elapsed'],
+                             _per_minute(run), run['waited'], remaining))
+
+
+def _per_minute(run):
+    if not run['elapsed']:
+        return 0.0
+    return run['deleted'] * 60 / run['elapsed']
+
+
+def queue_status(path):
+    '''
+    Show the deletion queue in PATH.
+
+    Args:
+        * path (str): directory holding the queue.
+
+    Returns:
+        * msg (str): queue depth, age and the throughput of recent drains.
+    '''
+    queue = DeletionQueue(path)
+    data = queue.read()
+    snapshots = data['snapshots']
+    msg = ['{} snapshot(s) queued for deletion in \'{}\''.format(
+        len(snapshots), queue.path)]
+    if snapshots:
+        oldest = min(snapshot['queued'] for snapshot in snapshots)
+        msg.append('Oldest queued {:.0f}s ago'.format(time.time() - oldest))
+    for run in data['runs']:
+        msg.append('Drain started {}: deleted {} in {:.1f}s ({:.1f}/min),'
+                   ' waited {:.1f}s'.format(
+                       datetime.datetime.fromtimestamp(
+                           run['started']).isoformat(sep=' ',
+                                                     timespec='seconds'),
+                       run['deleted'], run['elapsed'], _per_minute(run),
+                       run['waited']))
+    if data['runs']:
+        deleted = sum(run['deleted'] for run in data['runs'])
+        elapsed = sum(run['elapsed'] for run in data['runs'])
+        msg.append('{} snapshot(s) deleted by the last {} drain(s),'
+                   ' {:.1f}/min'.format(deleted, len(data['runs']),
+                                        _per_minute({'deleted': deleted,
+                                                     'elapsed': elapsed})))
+    return '\n'.join(msg)
+
+
+def _burst_processes(commands):
+    '''
+    Start every command without waiting in between, then wait for all.
+
+    Returns:
+        * (tuple): (started, failed) the monotonic start time of each
+          command and the numbers of the commands that failed.
+    '''
+    started = []
+    processes = []
+    try:
+        for args in commands:
+            started.append(time.monotonic())
+            processes.append(subprocess.Popen(args))
+    except OSError:
+        for process in processes:
+            process.wait()
+        raise
+    failed = [number for number, process in enumerate(processes)
+              if process.wait()]
+    return started, failed
+
+
+def _burst_threads(backend, snapshots, readonly):
+    '''
+    Release one backend.snap call per thread at the same moment.
+
+    Args:
+        * snapshots (list(tuple)): (target, snapshot) absolute paths.
+
+    Returns:
+        * (tuple): (started, failed) the monotonic start time of each
+          snapshot and the numbers of the snapshots that failed.
+    '''
+    barrier = threading.Barrier(len(snapshots))
+    started = [None] * len(snapshots)
+    failed = []
+
+    def fire(number, target, snapshot):
+        barrier.wait()
+        started[number] = time.monotonic()
+        try:
+            backend.snap(target, snapshot, readonly=readonly)
+        except Exception:
+            failed.append(number)
+
+    threads = [threading.Thread(target=fire, args=(number, target, snapshot))
+               for number, (target, snapshot) in enumerate(snapshots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    started.sort()
+    return started, sorted(failed)
+
+
+def _snap_consistent(snap_paths, readonly, resolution, backend):
+    '''
+    Snapshot every SnapPath in one burst under a single timestamp.
+
+    Targets, the shared timestamp, destination paths and command lines are
+    all resolved before the first snapshot is started. The snapshots are
+    then started back to back without waiting for each other. When the
+    backend does not run commands, one thread per snapshot waits on a
+    barrier and all of them are released at once.
+
+    Args:
+        * snap_paths (list(SnapPath)): paths to snapshot.
+        * readonly (bool): Create readonly snapshots?
+        * resolution (str): timestamp format, see SnapPath.timestamp.
+        * backend: Btrfs backend, see get_backend.
+
+    Returns:
+        * (tuple): (timestamp, spread, window) where spread is the number of
+          seconds between starting the first and the last snapshot and
+          window the number of seconds until all of them had finished.
+
+    Raises:
+        * BtrfsError: some of the snapshots failed.
+    '''
+    # the newest of the next timestamps is newer than every snapshot in
+    # every path, so it is valid for all of them
+    timestamp = max((snap_path.timestamp(resolution=resolution)
+                     for snap_path in snap_paths), key=SNAPSHOT_SORT_KEY)
+    snapshots = []
+    commands = []
+    for snap_path in snap_paths:
+        snapshot = os.path.join(snap_path.path, timestamp.name)
+        if os.path.lexists(snapshot):
+            raise Exception('\'{}\' already exists'.format(snapshot))
+        snapshots.append(snapshot)
+        commands.append(Btrfs(snap_path.path, backend=backend).snap_args(
+            snap_path.target, timestamp, readonly=readonly))
+
+    if None not in commands:
+        started, failed = _burst_processes(commands)
+    else:
+        started, failed = _burst_threads(backend, [
+            (snap_path.target, snapshot)
+            for snap_path, snapshot in zip(snap_paths, snapshots)], readonly)
+    finished = time.monotonic()
+    failed = [snap_paths[number].path for number in failed]
+
+    spread = started[-1] - started[0]
+    window = finished - started[0]
+    if failed:
+        raise BtrfsError('BTRFS failed to create snapshot {} in {}.'
+                         ' Started within {:.3f}s'.format(
+                             timestamp, ', '.join(failed), spread))
+    return timestamp, spread, window
+
+
+def snapdeep(path, readonly=True, index=False, resolution='day', jobs=None,
+             per_filesystem=1, consistent=False, backend=None):
+    '''
+    Create a snapshot in each subdirectory in PATH.
+
+    With JOBS, snapshots are taken in parallel on up to JOBS threads. The
+    targets are grouped by filesystem and at most PER_FILESYSTEM snapshots
+    run at once on each filesystem, so snapshots on different filesystems
+    proceed concurrently without piling transactions onto one of them.
+
+    Args:
+        * path (str): path on filesystem
+        * readonly (bool): Create readonly snapshots?
+        * index (bool or SnapshotIndex): read and update the snapshot
+          index in PATH, or use the one given as it is.
+        * resolution (str): timestamp format, see SnapPath.timestamp.
+        * jobs (int): number of snapshots to take in parallel.
+        * per_filesystem (int): maximum number of snapshots taken at once
+          on one filesystem when running in parallel.
+        * consistent (bool): take every snapshot in one burst under the
+          same timestamp to keep the skew between them low. Can not be
+          combined with JOBS.
+        * backend: Btrfs backend, see get_backend.
+
+    Returns:
+        * msg (str): results, with the wall time of each snapshot when
+          running in parallel.
+    '''
+    index = _index(index)
+    snapdeep = SnapDeep(path, index=index)
+    snap_paths = snapdeep.snap_paths()
+    if len(snap_paths) == 0:
+        msg = 'No snapshot directories found in \'{}\''.format(snapdeep.path)
+        return msg
+    if consistent:
+        if jobs is not None:
+            raise Exception('consistent snapshots can not be combined with'
+                            ' jobs')
+        timestamp, spread, window = _snap_consistent(snap_paths, readonly,
+                                                     resolution, backend)
+        if index is not None:
+            index.save()
+        return ('Created snapshot {} in {} path(s). Started within {:.3f}s,'
+                ' finished within {:.3f}s'.format(
+                    timestamp, len(snap_paths), spread, window))
+    if jobs is None:
+        for snap_path in snap_paths:
+            snap(snap_path.path, readonly=readonly, index=index,
+                 resolution=resolution, backend=backend)
+        if index is not None:
+            index.save()
+        return
+
+    if not per_filesystem >= 1 or not isinstance(per_filesystem, int):
+        raise Exception('per_filesystem must be a positive integer')
+    mounts = _mounts()
+    filesystems = set()
+    tasks = []
+    for snap_path in snap_paths:
+        filesystem = _filesystem(snap_path.target, mounts)
+        filesystems.add(filesystem)
+        tasks.append((functools.partial(_snap, snap_path, readonly,
+                                        resolution, backend),
+                      [(filesystem, per_filesystem)]))
+    start = time.monotonic()
+    results = _run_limited(tasks, jobs)
+    elapsed = time.monotonic() - start
+    if index is not None:
+        index.save()
+
+    msg = []
+    failed = 0
+    for snap_path, (timestamp, error, seconds) in zip(snap_paths, results):
+        if error is None:
+            msg.append('\'{}\' {} in {:.3f}s'.format(
+                snap_path.path, timestamp, seconds))
+        else:
+            failed += 1
+            msg.append('\'{}\' failed after {:.3f}s: {}'.format(
+                snap_path.path, seconds, error))
+    msg.append('Created {} snapshot(s) on {} filesystem(s) in {:.3f}s'
+               ' using {} job(s). {} failed'.format(
+                   len(tasks) - failed, len(filesystems), elapsed, jobs,
+                   failed))
+    return '\n'.join(msg)
+
+
+class SizeCache(Path):
+    '''
+    Referenced and exclusive sizes of the snapshots on each filesystem,
+    kept in a sidecar file (SIZE_FILE) in the PATH given to list with
+    sizes.
+
+    The sizes of a filesystem are reused for as long as the ids and
+    generations of the snapshots listed on it stay the same, so they are
+    measured again after a snapshot is taken, received or deleted.
+    Snapshots are readonly, so their referenced size can not change in
+    between. Their exclusive size also grows as the source subvolume is
+    written to, which shows up on the next measurement.
+
+    Args:
+        * path (str): the directory given to list.
+
+    Attributes:
+        * path (str): absolute path
+        * file (str): absolute path of the sidecar file.
+
+    Raises:
+        * PathError:
+    '''
+
+    def __init__(self, path):
+        Path.__init__(self, path)
+        self.file = os.path.join(self.path, SIZE_FILE)
+
+    def read(self):
+        '''
+        Returns:
+            * (dict): data with key filesystems, which maps the identifier
+              of each filesystem, see _filesystem, to a dict with keys
+              fingerprint and sizes. sizes maps subvolume ids (str) to
+              [referenced, exclusive].
+        '''
+        try:
+            with open(self.file) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if not isinstance(data, dict) or data.get('version') != SIZE_VERSION:
+            data = {'version': SIZE_VERSION, 'filesystems': {}}
+        return data
+
+    def write(self, data):
+        '''
+        Replace the sidecar file contents with DATA, see read.
+        '''
+        fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.truncate()
+            json.dump(data, f, separators=(',', ':'))
+
+
+def _measure(paths, backend, cached):
+    '''
+    Size the snapshots in PATHS, all on one filesystem, with one qgroup
+    query, or one du pass over them when quotas are disabled. Nothing is
+    measured while the listing matches CACHED.
+
+    Args:
+        * paths (list(str)): SNAPPATHs on the filesystem.
+        * cached (dict): the entry of the filesystem in SizeCache, or None.
+
+    Returns:
+        * (tuple): (sizes, entry). sizes maps the path of each snapshot,
+          inside one of PATHS as given, to (referenced, exclusive). entry
+          is the new SizeCache entry, or None when CACHED still holds.
+    '''
+    listing, _ = backend.list_filesystem(paths)
+    subvolumes = {os.path.join(path, os.path.basename(subvolume['path'])):
+                  subvolume for path, listed in listing.items()
+                  for subvolume in listed
+                  if TIMESTAMP_PATTERN.match(os.path.basename(
+                      subvolume['path']))}
+    fingerprint = hashlib.sha1(' '.join(sorted(
+        '{}:{}'.format(subvolume['id'], subvolume['generation'])
+        for subvolume in subvolumes.values())).encode()).hexdigest()
+    entry = None
+    if cached is None or cached['fingerprint'] != fingerprint:
+        try:
+            sizes = {str(qgroup): [size['referenced'], size['exclusive']]
+                     for qgroup, size in backend.qgroups(paths[0]).items()}
+        except (BtrfsError, NotImplementedError):
+            measured = backend.du([subvolume['path'] for subvolume
+                                   in subvolumes.values()])
+            sizes = {str(subvolume['id']):
+                     [measured[subvolume['path']]['referenced'],
+                      measured[subvolume['path']]['exclusive']]
+                     for subvolume in subvolumes.values()
+                     if subvolume['path'] in measured}
+        cached = entry = {'fingerprint': fingerprint, 'sizes': sizes}
+    return {path: tuple(cached['sizes'][str(subvolume['id'])])
+            for path, subvolume in subvolumes.items()
+            if str(subvolume['id']) in cached['sizes']}, entry
+
+
+def _snapshot_sizes(path, snappaths, backend):
+    '''
+    Size the snapshots of SNAPPATHS, measuring the filesystems in parallel
+    and caching the sizes in the SizeCache of PATH.
+
+    Returns:
+        * (dict): path of each snapshot to (referenced, exclusive) bytes.
+          Snapshots that could not be measured are missing.
+    '''
+    if backend is None:
+        backend = ProgsBackend()
+    cache = SizeCache(path)
+    data = cache.read()
+    mounts = _mounts()
+    filesystems = {}
+    for snappath in snappaths:
+        filesystems.setdefault(_filesystem(snappath.path, mounts),
+                               []).append(snappath.path)
+    tasks = [(functools.partial(_measure, paths, backend,
+                                data['filesystems'].get(filesystem)), [])
+             for filesystem, paths in filesystems.items()]
+    sizes = {}
+    changed = False
+    for filesystem, (result, error, _) in zip(
+            filesystems, _run_limited(tasks, max(len(tasks), 1))):
+        if error is not None:
+            raise error
+        measured, entry = result
+        sizes.update(measured)
+        if entry is not None:
+            data['filesystems'][filesystem] = entry
+            changed = True
+    if changed:
+        cache.write(data)
+    return sizes
+
+
+def _size_columns(name, size):
+    '''
+    Returns:
+        * (str): NAME followed by the (referenced, exclusive) bytes of
+          SIZE, or dashes when SIZE is None, see SIZE_COLUMNS.
+    '''
+    if size is None:
+        return SIZE_COLUMNS.format(name, '-', '-')
+    return SIZE_COLUMNS.format(name, _size(size[0]), _size(size[1]))
+
+
+def show_snaps(path, sizes=False, backend=None):
+    '''
+    List snapshots inside PATH.
+
+    Args:
+        * path (str): path on filesystem.
+        * sizes (bool): add the referenced and exclusive size of every
+          snapshot and the total exclusive size, see SizeCache.
+        * backend: Btrfs backend, see get_backend.
+
+    Returns:
+        * msg (str): results
+    '''
+    receive_path = ReceivePath(path)
+    snapshots = receive_path.snapshots()
+    msg = []
+    if sizes:
+        measured = _snapshot_sizes(receive_path.path, [receive_path],
+                                   backend)
+        msg.append(SIZE_COLUMNS.format('Snapshot', 'Referenced',
+                                       'Exclusive'))
+    for snapshot in snapshots:
+        if sizes:
+            msg.append(_size_columns(snapshot.name, measured.get(
+                os.path.join(receive_path.path, snapshot.name))))
+        else:
+            msg.append(snapshot.name)
+    msg.append('\n"{}" contains {} snapshot(s)'.format(
+        receive_path.path, len(snapshots)))
+    if sizes:
+        msg[-1] += ', {} exclusive'.format(_size(sum(
+            size[1] for size in measured.values())))
+    return '\n'.join(msg)
+
+
+def show_snaps_deep(path, index=False, sizes=False, backend=None):
+    '''
+    Recursively list snapshots inside PATH.
+
+    Args:
+        * path (str): Path on filesystem.
+        * index (bool or SnapshotIndex): read and update the snapshot
+          index in PATH, or use the one given as it is.
+        * sizes (bool): add the referenced and exclusive size of every
+          snapshot and the exclusive totals of every directory, see
+          SizeCache. The sizes are cached in PATH.
+        * backend: Btrfs backend, see get_backend.
+
+    Returns:
+        * msg (str): results
+    '''
+    msg = []
+    overall_snapshot_count = 0
+    overall_path_count = 0
+    overall_exclusive = 0
+    index = _index(index)
+    receive_deep = ReceiveDeep(path, index=index)
+    receive_paths = receive_deep.receive_paths()
+    if sizes:
+        measured = _snapshot_sizes(receive_deep.path, receive_paths, backend)
+    for p in receive_paths:
+        snapshots = p.snapshots()
+        msg.append('\n\'{}\'/'.format(p.path))
+        if snapshots:
+            newest = snapshots[0]
+            oldest = snapshots[-1]
+            msg.append('\t{} snapshots: Newest = {}, Oldest = {}'.format(
+                len(snapshots), newest.date, oldest.date))
+            if sizes:
+                snapshot_sizes = [measured.get(os.path.join(
+                    p.path, snapshot.name)) for snapshot in snapshots]
+                exclusive = sum(size[1] for size in snapshot_sizes
+                                if size is not None)
+                overall_exclusive += exclusive
+                msg[-1] += ', {} exclusive'.format(_size(exclusive))
+                msg.append('\t\t' + SIZE_COLUMNS.format(
+                    'Snapshot', 'Referenced', 'Exclusive'))
+            for number, snapshot in enumerate(snapshots):
+                if sizes:
+                    msg.append('\t\t' + _size_columns(
+                        snapshot.name, snapshot_sizes[number]))
+                else:
+                    msg.append('\t\t{}'.format(snapshot))
+                overall_snapshot_count += 1
+        else:
+            msg.append('\t\tNo snapshots')
+        overall_path_count += 1
+    msg.append('\n{:{s}^{n}}'.format(' Summary ', s='-', n=60))
+    msg.append('\'{}\' contains {} snapshots in {} subdirectories'.format(
+        path, overall_snapshot_count, overall_path_count))
+    if sizes:
+        msg[-1] += ', {} exclusive'.format(_size(overall_exclusive))
+    if index is not None:
+        index.save()
+
+    return '\n'.join(msg)
+
+
+class ReceiveScan:
+    '''
+    The subvolumes of a set of receive paths, listed with a single
+    Backend.list_filesystem per destination filesystem instead of one
+    listing per path.
+
+    Only subvolumes with a received_uuid count as received snapshots. A
+    subvolume with a snapshot name and no received_uuid was left behind by
+    an interrupted receive, or was never received at all.
+
+    The other subvolumes of each filesystem are indexed by received_uuid
+    as well, so a snapshot received anywhere on it is found by find.
+
+    Args:
+        * paths (list(str)): receive paths. Local paths that do not exist
+          are empty.
+        * backend (Backend): backend of local paths, defaults to a
+          ProgsBackend.
+        * transport (Transport): the paths are on another host.
+
+    Attributes:
+        * subvolumes (dict): each path to a dict of the subvolumes
+          directly inside it by name, see Backend.list.
+        * filesystems (dict): each path to the identifier of its
+          filesystem, None when it does not exist.
+        * received (dict): each filesystem to a dict of its subvolumes by
+          received_uuid.
+        * scans (int): number of list_filesystem calls made.
+    '''
+    def __init__(self, paths, backend=None, transport=None):
+        self.transport = transport
+        self.subvolumes = {}
+        self.filesystems = {}
+        self.received = {}
+        self.scans = 0
+        if transport is not None:
+            backend = RemoteBackend(transport)
+            paths = [self._key(path) for path in paths]
+            resolved = transport.realpaths(paths) if paths else []
+            mounts = transport.mounts()
+            filesystems = [_mount(real, mounts, resolved=True)
+                           for real in resolved]
+            filesystems = [mount and mount['device'] for mount in filesystems]
+        else:
+            backend = backend if backend is not None else ProgsBackend()
+            paths = [self._key(path) for path in paths]
+            mounts = _mounts()
+            filesystems = [_filesystem(path, mounts)
+                           if os.path.isdir(path) else None
+                           for path in paths]
+        groups = {}
+        for path, filesystem in zip(paths, filesystems):
+            self.subvolumes[path] = {}
+            self.filesystems[path] = filesystem
+            if filesystem is not None:
+                groups.setdefault(filesystem, []).append(path)
+        for filesystem, group in groups.items():
+            listing, subvolumes = backend.list_filesystem(group)
+            self.scans += 1
+            for path in group:
+                for subvolume in listing[path]:
+                    name = posixpath.basename(subvolume['path'])
+                    self.subvolumes[path][name] = subvolume
+            self.received[filesystem] = {
+                subvolume['received_uuid']: subvolume
+                for subvolume in subvolumes
+                if subvolume['received_uuid'] is not None}
+
+    def _key(self, path):
+        if self.transport is not None:
+            return posixpath.normpath(path)
+        return os.path.abspath(path)
+
+    def list(self, path):
+        '''
+        Returns:
+            * (list(dict)): the subvolumes directly inside PATH, see
+              Backend.list.
+        '''
+        return list(self.subvolumes[self._key(path)].values())
+
+    def snapshots(self, path):
+        '''
+        Returns:
+            * (list(Snapshot)): the snapshots received in PATH, newest
+              first.
+        '''
+        subvolumes = self.subvolumes[self._key(path)]
+        return _snapshots(name for name, subvolume in subvolumes.items()
+                          if subvolume['received_uuid'] is not None
+                          and TIMESTAMP_PATTERN.match(name))
+
+    def find(self, path, received_uuid):
+        '''
+        Returns:
+            * (dict): a subvolume with RECEIVED_UUID on the filesystem of
+              PATH, wherever it is, or None.
+        '''
+        return self.received.get(self.filesystems[self._key(path)],
+                                 {}).get(received_uuid)
+
+    def unreceived(self, path):
+        '''
+        Returns:
+            * (list(str)): names of the snapshots in PATH without a
+              received_uuid, sorted. Names that are not valid dates are
+              skipped.
+        '''
+        subvolumes = self.subvolumes[self._key(path)]
+        return sorted(snapshot.name for snapshot in _snapshots(
+            name for name, subvolume in subvolumes.items()
+            if subvolume['received_uuid'] is None
+            and TIMESTAMP_PATTERN.match(name)))
+
+    def forget(self, path, names):
+        '''
+        Drop NAMES, which were deleted, from the subvolumes of PATH.
+        '''
+        subvolumes = self.subvolumes[self._key(path)]
+        received = self.received.get(self.filesystems[self._key(path)], {})
+        for name in names:
+            subvolume = subvolumes.pop(name, None)
+            if (subvolume is not None and subvolume['received_uuid']
+                    and subvolume['received_uuid'] in received):
+                del received[subvolume['received_uuid']]
+
+
+def _plan_sends(send_snapshots, receive_snapshots, clones=CLONE_SOURCES,
+                available=()):
+    '''
+    Plan how to send the snapshots the receiving side is missing.
+
+    Missing snapshots are sent oldest first. Each one is sent incrementally
+    from the nearest older snapshot both sides have, counting the ones sent
+    before it, or from the nearest newer one when there is no older one.
+    The next nearest snapshots both sides have, up to CLONES of them, are
+    passed as clone sources.
+
+    Args:
+        * send_snapshots (list(Snapshot)): snapshots of the sending side.
+        * receive_snapshots (list(Snapshot)): snapshots of the receiving
+          side.
+        * clones (int): most clone sources per snapshot.
+        * available (iterable(Snapshot)): snapshots of the sending side
+          that the receiving filesystem has elsewhere. They can be parents
+          and clone sources but are still missing.
+
+    Returns:
+        * (list(tuple)): (snapshot, parent, clones) in sending order. parent
+          is None for a full send.
+    '''
+    if not clones >= 0 or not isinstance(clones, int):
+        raise Exception('clones must be a positive integer or 0')
+    receive_set = set(receive_snapshots)
+    usable = receive_set.union(available)
+    common = sorted((snapshot for snapshot in send_snapshots
+                     if snapshot in usable), key=SNAPSHOT_SORT_KEY)
+    missing = sorted((snapshot for snapshot in send_snapshots
+                      if snapshot not in receive_set), key=SNAPSHOT_SORT_KEY)
+    keys = [snapshot.key for snapshot in common]
+    plan = []
+    for snapshot in missing:
+        position = bisect.bisect_left(keys, snapshot.key)
+        if snapshot in usable:
+            # available elsewhere, but not a parent of itself
+            del common[position]
+            del keys[position]
+        # nearest first, alternating older and newer, older ones first
+        nearest = []
+        older, newer = position - 1, position
+        while len(nearest) <= clones and (older >= 0 or newer < len(common)):
+            if older >= 0:
+                nearest.append(common[older])
+                older -= 1
+            if newer < len(common) and len(nearest) <= clones:
+                nearest.append(common[newer])
+                newer += 1
+        parent = nearest[0] if nearest else None
+        plan.append((snapshot, parent, nearest[1:]))
+        common.insert(position, snapshot)
+        keys.insert(position, snapshot.key)
+    return plan
+
+
+def _clean_partial(receive_btr, subvolumes=None):
+    '''
+    Delete the snapshots in receive_btr.path left behind by interrupted
+    resumable receives: those still writable, without a received_uuid and
+    staged in its spool. Other writable snapshots without a received_uuid,
+    like snapshots taken writable or received ones set writable, are left
+    alone.
+
+    Args:
+        * receive_btr (Btrfs): the receive path.
+        * subvolumes (list(dict)): the subvolumes in it when already
+          listed, see Backend.list.
+
+    Returns:
+        * (tuple): (partial, skipped) names of the deleted snapshots and of
+          those left alone.
+    '''
+    if subvolumes is None:
+        subvolumes = receive_btr.list()
+    stage = os.path.join(receive_btr.path, SPOOL_DIR)
+    staged = set()
+    if os.path.isdir(stage):
+        staged = {entry['name']
+                  for entry in ExportPath(stage).read()['snapshots']}
+    partial = []
+    skipped = []
+    for subvolume in subvolumes:
+        name = os.path.basename(subvolume['path'])
+        if (subvolume['received_uuid'] is None
+                and TIMESTAMP_PATTERN.match(name)
+                and not receive_btr.show(name)['readonly']):
+            if name in staged:
+                receive_btr.unsnap(name)
+                partial.append(name)
+            else:
+                skipped.append(name)
+    return partial, skipped
+
+
+def _spools(send_path, destinations, names):
+    '''
+    Open the spools of a resumable send, dropping spooled snapshots that
+    are no longer planned.
+
+    Args:
+        * send_path (str): the sending SNAPPATH.
+        * destinations (list(str)): the receive paths.
+        * names (list(str)): names of the snapshots to send.
+
+    Returns:
+        * (tuple): (spool, stages), the ExportPath of the sending side and
+          one ExportPath for each receive path.
+    '''
+    exports = []
+    for path in [send_path] + destinations:
+        path = os.path.join(path, SPOOL_DIR)
+        os.makedirs(path, exist_ok=True)
+        export = ExportPath(path)
+        for entry in export.read()['snapshots']:
+            if entry['name'] not in names:
+                export.discard(entry['name'])
+        exports.append(export)
+    return exports[0], exports[1:]
+
+
+def _record_checksum(send_manifest, receive_manifest, step, pump):
+    '''
+    Record the checksum PUMP took of the stream of STEP, a (snapshot,
+    parent, clones) tuple from _plan_sends, on both sides.
+
+    Returns:
+        * (int): 1 when recorded, 0 when the pump has no digest.
+    '''
+    if pump.digest is None:
+        return 0
+    snapshot, parent, clone_sources = step
+    stream = {'algorithm': pump.checksum,
+              'digest': pump.digest,
+              'bytes': pump.bytes,
+              'parent': parent.name if parent is not None else None,
+              'clones': [clone.name for clone in clone_sources]}
+    send_manifest.record(snapshot.name, stream)
+    receive_manifest.record(snapshot.name, stream, replace=True)
+    return 1
+
+
+def _plan_lines(plan):
+    '''
+    Returns:
+        * (list(str)): one line per snapshot of PLAN, see _plan_sends.
+    '''
+    lines = []
+    for snapshot, parent, clone_sources in plan:
+        if parent is None:
+            lines.append('\t{}: full'.format(snapshot))
+        else:
+            lines.append('\t{}: from {}{}'.format(
+                snapshot, parent,
+                ', clones {}'.format(', '.join(
+                    clone.name for clone in clone_sources))
+                if clone_sources else ''))
+    return lines
+
+
+def sendreceive(send_path, receive_path, index=None, backend=None,
+                dry_run=False, clones=CLONE_SOURCES, pump=False, bwlimit=None,
+                progress=None, resumable=False, via=None, scan=False,
+                checksum=None):
+    '''
+    Send snapshots from one BTRFS PATH to another.
+
+    Every missing snapshot is sent as an increment from the nearest
+    snapshot both sides have, see _plan_sends.
+
+    With several receive paths, each one is planned on its own. Those that
+    need a snapshot from the same parent and clone sources get it from a
+    single send, teed into all of their receives at once. The others get a
+    send of their own. A receive path that fails is reported and skipped
+    for the rest of the run, without stopping the others.
+
+    RESUMABLE sends spool every stream into checksummed chunk files in
+    SPOOL_DIR of the sending side first, copy the chunks to SPOOL_DIR of
+    each receiving side and receive from there. After a failure, the next
+    run reuses the spooled and copied chunks that are intact, so only the
+    missing ones are sent and copied again. Snapshots left behind by an
+    interrupted receive are deleted before planning.
+
+    With SCAN, the receive paths are listed with one btrfs subvolume list
+    per filesystem, see ReceiveScan, and only snapshots with a
+    received_uuid count as present. Snapshots named like a missing one but
+    never fully received are reported and not sent again to that path,
+    unless RESUMABLE deletes them. Snapshots are matched by UUID as well:
+    a renamed one still counts as present, and one received anywhere else
+    on the receiving filesystem can be a parent or clone source.
+
+    With CHECKSUM every stream is hashed on its way through the Pump and
+    the digest and size are recorded in a ChecksumManifest on both sides,
+    for verify.
+
+    Args:
+        * send_path: path to snapshot to send
+        * receive_path (str or list(str)): path(s) to receive snapshots in.
+        * index (SnapshotIndex): optional index to read both paths from.
+        * backend: Btrfs backend, see get_backend.
+        * dry_run (bool): only show the plan.
+        * clones (int): most clone sources passed with each snapshot.
+        * pump (bool): move the streams through a Pump and report the
+          bytes sent. Implied by bwlimit and progress.
+        * bwlimit (float): bandwidth cap in bytes per second.
+        * progress (callable): called as progress(snapshot, bytes, seconds)
+          while a snapshot is being sent, see Pump.
+        * resumable (bool): send through spooled chunks that survive a
+          failure.
+        * via (str or Transport): receive on another host through this
+          command, see Transport. receive_path is on that host.
+        * scan (bool): plan from the subvolumes the receive paths really
+          received.
+        * checksum (str): hashlib algorithm to checksum the streams with,
+          see CHECKSUM_ALGORITHM. Implies pump.
+
+    Returns:
+        * (str): results
+
+    Raises:
+        * BtrfsError: with the results, when a receive path failed.
+    '''
+    if isinstance(via, str):
+        with Transport(via) as transport:
+            return sendreceive(send_path, receive_path, index=index,
+                               backend=backend, dry_run=dry_run,
+                               clones=clones, pump=pump, bwlimit=bwlimit,
+                               progress=progress, resumable=resumable,
+                               via=transport, scan=scan, checksum=checksum)
+    limiter = RateLimiter(bwlimit) if bwlimit is not None else None
+    return _sendreceive(send_path, receive_path, index, backend,
+                        dry_run=dry_run, clones=clones, pump=pump,
+                        limiter=limiter, progress=progress,
+                        resumable=resumable, transport=via, scan=scan,
+                        checksum=checksum)[1]
+
+
+def _sendreceive(send_path, receive_path, index, backend, dry_run=False,
+                 clones=CLONE_SOURCES, pump=False, limiter=None,
+                 progress=None, resumable=False, transport=None, scan=None,
+                 checksum=None):
+    '''
+    Args:
+        * scan (bool or ReceiveScan): plan from a ReceiveScan, a new one
+          when True.
+        * checksum (str): hashlib algorithm to checksum the streams with.
+
+    Returns:
+        * (tuple): (number_sent, msg, bytes) for sendreceive. number_sent
+          counts every receive path a snapshot went to. bytes is None when
+          the streams were not pumped.
+    '''
+    if resumable and transport is not None:
+        raise Exception('resumable sends need local receive paths')
+    if checksum is not None and transport is not None:
+        raise Exception('checksummed sends need local receive paths')
+    send = SnapPath(send_path, index=index)
+    send_snapshots = send.snapshots()
+    receive_paths = ([receive_path] if isinstance(receive_path, str)
+                     else list(receive_path))
+    if scan is True:
+        scan = ReceiveScan(receive_paths, backend=backend,
+                           transport=transport)
+    if scan:
+        # the uuid a receiving side records as received_uuid
+        sent_as = {os.path.basename(subvolume['path']):
+                   subvolume['received_uuid'] or subvolume['uuid']
+                   for subvolume in Btrfs(send.path, backend=backend).list()}
+    destinations = []
+    plans = []
+    removed = 0
+    notes = []
+    for path in receive_paths:
+        skipped = []
+        if transport is not None:
+            destinations.append(posixpath.normpath(path))
+            try:
+                receive_snapshots = (scan.snapshots(path) if scan
+                                     else transport.snapshots(path))
+            except PathError:
+                if not dry_run:
+                    raise
+                receive_snapshots = []
+        elif dry_run and not os.path.isdir(path):
+            # sendreceive_deep would create it
+            destinations.append(os.path.abspath(path))
+            receive_snapshots = []
+        else:
+            receive = ReceivePath(path, index=index)
+            if resumable and not dry_run:
+                receive_btr = Btrfs(receive.path, backend=backend)
+                partial, skipped = _clean_partial(
+                    receive_btr, scan.list(path) if scan else None)
+                if scan:
+                    scan.forget(path, partial)
+                removed += len(partial)
+            destinations.append(receive.path)
+            receive_snapshots = (scan.snapshots(path) if scan
+                                 else receive.snapshots())
+        candidates = send_snapshots
+        if skipped and not scan:
+            # not received, so neither sent again nor used as parents,
+            # the way scan treats them
+            skipped = set(skipped).intersection(
+                snapshot.name for snapshot in send_snapshots)
+            candidates = [snapshot for snapshot in send_snapshots
+                          if snapshot.name not in skipped]
+            receive_snapshots = [snapshot for snapshot in receive_snapshots
+                                 if snapshot.name not in skipped]
+            if skipped:
+                notes.append('Skipped {} snapshot(s) in \'{}\' that were'
+                             ' not fully received: {}'.format(
+                                 len(skipped), destinations[-1],
+                                 ', '.join(sorted(skipped))))
+        available = []
+        if scan:
+            unreceived = set(scan.unreceived(path)).intersection(
+                snapshot.name for snapshot in send_snapshots)
+            candidates = [snapshot for snapshot in send_snapshots
+                          if snapshot.name not in unreceived]
+            if unreceived:
+                notes.append('Skipped {} snapshot(s) in \'{}\' that were'
+                             ' not fully received: {}'.format(
+                                 len(unreceived), destinations[-1],
+                                 ', '.join(sorted(unreceived))))
+            # renamed snapshots still count, and those received anywhere
+            # else on the filesystem can be parents
+            here = {subvolume['received_uuid']
+                    for subvolume in scan.list(path)
+                    if subvolume['received_uuid'] is not None}
+            receive_snapshots = receive_snapshots + [
+                snapshot for snapshot in candidates
+                if sent_as.get(snapshot.name) in here]
+            available = [snapshot for snapshot in candidates
+                         if snapshot.name in sent_as
+                         and scan.find(path, sent_as[snapshot.name])]
+        plan = _plan_sends(candidates, receive_snapshots, clones, available)
+        plans.append(plan)
+        elsewhere = set(available).difference(receive_snapshots)
+        matched = {source.name for snapshot, parent, clone_sources in plan
+                   for source in [parent] + clone_sources
+                   if source in elsewhere}
+        if matched:
+            notes.append('Matched {} parent(s) and clone source(s) for \'{}\''
+                         ' by UUID elsewhere on its filesystem: {}'.format(
+                             len(matched), destinations[-1],
+                             ', '.join(sorted(matched))))
+    # receive paths needing a snapshot from the same parent and clone
+    # sources share one stream
+    streams = {}
+    for number, plan in enumerate(plans):
+        for snapshot, parent, clone_sources in plan:
+            streams.setdefault((snapshot, parent, tuple(clone_sources)),
+                               []).append(number)
+    # plans send oldest first, so this keeps the order of every plan
+    steps = sorted(streams, key=lambda step: step[0].key)
+
+    if dry_run:
+        msg = []
+        for path, plan in zip(destinations, plans):
+            if not plan:
+                msg.append('No new snapshots to copy from \'{}\' to'
+                           ' \'{}\''.format(send.path, path))
+                continue
+            msg.append('Would copy {} snapshot(s) from \'{}\' to'
+                       ' \'{}\''.format(len(plan), send.path, path))
+            msg.extend(_plan_lines(plan))
+        if len(destinations) > 1 and steps:
+            msg.append('Would send {} stream(s) for {} snapshot(s)'.format(
+                len(steps), sum(len(plan) for plan in plans)))
+        return 0, '\n'.join(msg + notes), None
+
+    pumped = (pump or limiter is not None or progress is not None
+              or checksum is not None)
+    size = 0
+    seconds = 0.0
+    sent = [0] * len(destinations)
+    failed = {}
+    streamed = 0
+    recorded = 0
+    send_btr = Btrfs(send.path, backend=backend)
+    if transport is not None:
+        receivers = [RemoteBtrfs(path, transport) for path in destinations]
+    else:
+        receivers = [Btrfs(path, backend=backend) for path in destinations]
+    if checksum is not None:
+        send_manifest = ChecksumManifest(send.path)
+        receive_manifests = [ChecksumManifest(path) for path in destinations]
+    if resumable:
+        spool, stages = _spools(send.path, destinations,
+                                [step[0].name for step in steps])
+        spooled = copied = reused = 0
+    for step in steps:
+        snapshot, parent, clone_sources = step
+        numbers = [number for number in streams[step]
+                   if number not in failed]
+        if not numbers:
+            continue
+        report = None
+        if progress is not None:
+            report = functools.partial(
+                progress, os.path.join(send.path, snapshot.name))
+        if resumable:
+            entry = spool.entry(snapshot.name)
+            if (entry is None or spool.check(entry)
+                    or entry['parent'] != (parent.name if parent is not None
+                                           else None)
+                    or entry['clones'] != [clone.name
+                                           for clone in clone_sources]):
+                entry = _export_send(send_btr, spool, snapshot, parent,
+                                     clone_sources, codec='none',
+                                     chunk_size=SPOOL_CHUNK_SIZE)
+                spooled += len(entry['chunks'])
+            streamed += 1
+            for number in numbers:
+                stream_pump = None
+                if pumped:
+                    stream_pump = Pump(limiter=limiter, progress=report,
+                                       checksum=checksum)
+                try:
+                    counts = spool.copy(entry, stages[number])
+                    _receive_export(receivers[number], stages[number],
+                                    entry, pump=stream_pump)
+                except (BtrfsError, OSError) as err:
+                    if len(destinations) == 1:
+                        raise
+                    failed[number] = err
+                    continue
+                copied += counts[0]
+                reused += counts[1]
+                stages[number].discard(snapshot.name)
+                sent[number] += 1
+                if checksum is not None:
+                    recorded += _record_checksum(
+                        send_manifest, receive_manifests[number], step,
+                        stream_pump)
+                if stream_pump is not None:
+                    size += stream_pump.bytes
+                    seconds += stream_pump.seconds
+            if not any(number in failed for number in numbers):
+                spool.discard(snapshot.name)
+            continue
+        stream_pump = None
+        if pumped or len(destinations) > 1:
+            stream_pump = Pump(limiter=limiter, progress=report,
+                               checksum=checksum)
+        p1 = send_btr.send(snapshot, parent, clone_sources)
+        if len(destinations) == 1:
+            receivers[0].receive(p1, pump=stream_pump)
+            errors = [None]
+        else:
+            errors = _receive_many(
+                p1, [receivers[number] for number in numbers], stream_pump)
+        streamed += 1
+        if stream_pump is not None:
+            size += stream_pump.bytes
+            seconds += stream_pump.seconds
+        for number, error in zip(numbers, errors):
+            if error is None:
+                sent[number] += 1
+                if checksum is not None:
+                    recorded += _record_checksum(
+                        send_manifest, receive_manifests[number], step,
+                        stream_pump)
+            else:
+                failed[number] = error
+
+    msg = []
+    for number, path in enumerate(destinations):
+        if number in failed:
+            msg.append('\'{}\' failed after {} snapshot(s): {}'.format(
+                path, sent[number], failed[number]))
+        elif plans[number]:
+            msg.append('{} snapshots copied from \'{}\' to \'{}\''.format(
+                sent[number], send.path, path))
+        else:
+            msg.append('No new snapshots to copy from \'{}\' to'
+                       ' \'{}\''.format(send.path, path))
+    if len(destinations) > 1 and streamed:
+        msg.append('{} stream(s) sent for {} snapshot(s)'.format(
+            streamed, sum(sent)))
+    if pumped and streamed:
+        msg[-1] += ' ({})'.format(_megabytes(size, seconds))
+    if resumable and (streamed or removed):
+        msg.append('Spooled {} chunk(s), copied {} and reused {}. Deleted {}'
+                   ' partial receive(s)'.format(spooled, copied, reused,
+                                                removed))
+    if checksum is not None and streamed:
+        msg.append('Recorded {} checksums of {} received stream(s)'.format(
+            checksum, recorded))
+    msg.extend(notes)
+    if failed:
+        raise BtrfsError('\n'.join(msg))
+    return sum(sent), '\n'.join(msg), size if pumped else None
+
+
+def sendreceive_deep(send_path, receive_path, index=False, backend=None,
+                     jobs=None, per_source=1, per_destination=1,
+                     dry_run=False, clones=CLONE_SOURCES, pump=False,
+                     bwlimit=None, progress=None, resumable=False,
+                     via=None, scan=False, checksum=None):
+    '''
+    Send all snapshots in subdirectories of send_path to receive_path.
+
+    With JOBS, up to JOBS subdirectories are sent in parallel. At most
+    PER_SOURCE sends read from one source filesystem and at most
+    PER_DESTINATION receives write to one destination filesystem at once,
+    so a slow subdirectory only holds up the ones sharing its filesystems.
+
+    With several receive paths, each subdirectory is sent to all of them
+    with shared streams, see sendreceive.
+
+    Args:
+        * send_path (str): absolute path holding one or more snapshot
+                         directories.
+        * receive_path (str or list(str)): absolute path(s) to receive
+          snapshot directories in.
+        * index (bool or SnapshotIndex): read and update the snapshot
+          indexes in send_path and receive_path, or use the one given as it
+          is.
+        * backend: Btrfs backend, see get_backend.
+        * jobs (int): number of subdirectories to send in parallel.
+        * per_source (int): maximum number of sends at once from one
+          source filesystem when running in parallel.
+        * per_destination (int): maximum number of receives at once into
+          one destination filesystem when running in parallel.
+        * dry_run (bool): only show what would be sent.
+        * clones (int): most clone sources passed with each snapshot.
+        * pump (bool): move the streams through a Pump and report the
+          bytes sent. Implied by bwlimit and progress.
+        * bwlimit (float): bandwidth cap in bytes per second, shared by
+          all parallel sends.
+        * progress (callable): see sendreceive.
+        * resumable (bool): see sendreceive.
+        * via (str or Transport): see sendreceive. One connection serves
+          the whole run, and remote receive paths count as a single
+          destination filesystem.
+        * scan (bool): list the receive paths of every subdirectory with
+          one ReceiveScan for the whole run, see sendreceive.
+        * checksum (str): see sendreceive.
+
+    Returns:
+        * (str): results, with the wall time of each subdirectory and a
+          summary when running in parallel.
+    '''
+    if isinstance(via, str):
+        with Transport(via) as transport:
+            return sendreceive_deep(
+                send_path, receive_path, index=index, backend=backend,
+                jobs=jobs, per_source=per_source,
+                per_destination=per_destination, dry_run=dry_run,
+                clones=clones, pump=pump, bwlimit=bwlimit, progress=progress,
+                resumable=resumable, via=transport, scan=scan,
+                checksum=checksum)
+    index = _index(index)
+    snappaths = SnapDeep(send_path, index=index)
+    snappaths = snappaths.snap_paths()
+    snappaths = [snappath.path for snappath in snappaths]
+    if isinstance(receive_path, str):
+        receive_path = [receive_path]
+    if via is not None:
+        receive_roots = [posixpath.normpath(root) for root in receive_path]
+    else:
+        receive_roots = [Path(root).path for root in receive_path]
+    receive_paths = [[os.path.join(root, s.split(os.path.sep)[-1])
+                      for root in receive_roots] for s in snappaths]
+    msg = []
+
+    if via is not None:
+        if not dry_run:
+            via.mkdir([p for paths in receive_paths for p in paths])
+    else:
+        for paths in receive_paths:
+            for p in paths:
+                if not os.path.isdir(p) and not dry_run:
+                    os.mkdir(p)
+
+    limiter = RateLimiter(bwlimit) if bwlimit is not None else None
+    if scan:
+        scan = ReceiveScan([p for paths in receive_paths for p in paths],
+                           backend=backend, transport=via)
+        scanned = 'Listed {} receive path(s) with {} scan(s)'.format(
+            sum(len(paths) for paths in receive_paths), scan.scans)
+    else:
+        scan = None
+    if jobs is None:
+        args = zip(snappaths, receive_paths)
+        for send_path, paths in args:
+            msg.append(_sendreceive(send_path, paths, index, backend,
+                                    dry_run=dry_run, clones=clones,
+                                    pump=pump, limiter=limiter,
+                                    progress=progress,
+                                    resumable=resumable,
+                                    transport=via, scan=scan,
+                                    checksum=checksum)[1])
+        if index is not None:
+            index.save()
+        if scan is not None:
+            msg.append(scanned)
+        return '\n'.join(msg)
+
+    for name, limit in (('per_source', per_source),
+                        ('per_destination', per_destination)):
+        if not limit >= 1 or not isinstance(limit, int):
+            raise Exception('{} must be a positive integer'.format(name))
+    mounts = _mounts()
+    sources = set()
+    destinations = set()
+    tasks = []
+    for send_path, paths in zip(snappaths, receive_paths):
+        source = _filesystem(send_path, mounts)
+        if via is not None:
+            task_destinations = {('via', ' '.join(via.via))}
+        else:
+            task_destinations = {_filesystem(p, mounts) for p in paths}
+        sources.add(source)
+        destinations.update(task_destinations)
+        tasks.append((functools.partial(_sendreceive, send_path,
+                                        paths, index, backend,
+                                        dry_run=dry_run, clones=clones,
+                                        pump=pump, limiter=limiter,
+                                        progress=progress,
+                                        resumable=resumable,
+                                        transport=via, scan=scan,
+                                        checksum=checksum),
+                      [(('send', source), per_source)] +
+                      [(('receive', destination), per_destination)
+                       for destination in task_destinations]))
+    start = time.monotonic()
+    results = _run_limited(tasks, jobs)
+    elapsed = time.monotonic() - start
+    if index is not None:
+        index.save()
+
+    sent = 0
+    size = None
+    failed = 0
+    seconds = []
+    for send_path, (result, error, duration) in zip(snappaths, results):
+        if error is None:
+            sent += result[0]
+            if result[2] is not None:
+                size = (size or 0) + result[2]
+            seconds.append(duration)
+            msg.append('{} in {:.3f}s'.format(result[1], duration))
+        else:
+            failed += 1
+            msg.append('\'{}\' failed after {:.3f}s: {}'.format(
+                send_path, duration, error))
+    msg.append('Sent {} snapshot(s) in {} path(s) from {} to {}'
+               ' filesystem(s) in {:.3f}s using {} job(s), {:.1f}'
+               ' snapshot(s)/min. {} failed'.format(
+                   sent, len(tasks), len(sources), len(destinations),
+                   elapsed, jobs, sent * 60 / elapsed if elapsed else 0.0,
+                   failed))
+    if size is not None:
+        msg.append('Streamed {}'.format(_megabytes(size, elapsed)))
+    if scan is not None:
+        msg.append(scanned)
+    if seconds:
+        msg.append('Per path: min {:.3f}s, median {:.3f}s, max {:.3f}s'.format(
+            min(seconds), statistics.median(seconds), max(seconds)))
+    return '\n'.join(msg)
+
+
+class _Uncompressed:
+    '''
+    The 'none' codec.
+    '''
+    eof = True
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+    def decompress(self, data, max_length=-1):
+        return data
+
+
+# name: (compressor(level), decompressor()). Compressors have compress(data)
+# and flush(), decompressors decompress(data, max_length) and eof, and keep
+# the input beyond max_length in unconsumed_tail like zlib or tell whether
+# they need more input with needs_input like lzma. Add to CODECS to plug in
+# other codecs.
+CODECS = {'none': (lambda level: _Uncompressed(), _Uncompressed),
+          'zlib': (lambda level: zlib.compressobj(
+              zlib.Z_DEFAULT_COMPRESSION if level is None else level),
+                   zlib.decompressobj),
+          'lzma': (lambda level: lzma.LZMACompressor(preset=level),
+                   lzma.LZMADecompressor)}
+
+
+def _decompress(decompressor, data):
+    '''
+    Decompress DATA in pieces of at most PUMP_CHUNK bytes, so that highly
+    compressed blocks, like the zeros of sparse files, never expand in
+    memory all at once.
+
+    Yields:
+        * (bytes): the decompressed pieces.
+    '''
+    while True:
+        piece = decompressor.decompress(data, PUMP_CHUNK)
+        if piece:
+            yield piece
+        if decompressor.eof:
+            return
+        data = getattr(decompressor, 'unconsumed_tail', b'')
+        if not data and getattr(decompressor, 'needs_input',
+                                len(piece) < PUMP_CHUNK):
+            return
+
+
+def get_codec(name):
+    '''
+    Args:
+        * name (str): one of CODECS.
+
+    Returns:
+        * (tuple): (compressor, decompressor) factories, see CODECS.
+    '''
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise Exception('unknown codec {!r}, choose one of {}'.format(
+            name, ', '.join(sorted(CODECS))))
+
+
+class ExportPath(Path):
+    '''
+    A directory of exported send streams.
+
+    Every exported snapshot is a compressed send stream split into chunk
+    files named SNAPSHOT.NNNN.CODEC. The manifest file (EXPORT_MANIFEST)
+    lists the exported snapshots in the order they were exported, with the
+    parent and clone sources each stream was sent with and its chunks and
+    their sha256 checksums.
+
+    Args:
+        * path (str): directory holding the exports.
+
+    Attributes:
+        * path (str): absolute path
+        * file (str): absolute path of the manifest.
+
+    Raises:
+        * PathError:
+    '''
+
+    def __init__(self, path):
+        Path.__init__(self, path)
+        self.file = os.path.join(self.path, EXPORT_MANIFEST)
+
+    def read(self):
+        '''
+        Returns:
+            * (dict): manifest with key snapshots, a list of dicts with keys
+              name, parent, clones, codec, bytes (size of the send stream),
+              exported (epoch seconds) and chunks, a list of dicts with keys
+              file, size and sha256.
+
+        Raises:
+            * Exception: the manifest is not readable.
+        '''
+        try:
+            with open(self.file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {'version': EXPORT_VERSION, 'snapshots': []}
+        except (OSError, ValueError) as err:
+            raise Exception('Can not read \'{}\': {}'.format(self.file, err))
+        if not isinstance(data, dict) or data.get('version') != EXPORT_VERSION:
+            raise Exception('Unsupported manifest \'{}\''.format(self.file))
+        return data
+
+    def snapshots(self):
+        '''
+        Returns:
+            * (list(Snapshot)): exported snapshots, newest first.
+        '''
+        return sorted((Snapshot(entry['name'])
+                       for entry in self.read()['snapshots']),
+                      key=SNAPSHOT_SORT_KEY, reverse=True)
+
+    def _save(self, data):
+        temporary = self.file + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(data, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.file)
+
+    def write(self, name, stream, parent=None, clones=(), codec='zlib',
+              level=None, chunk_size=EXPORT_CHUNK_SIZE):
+        '''
+        Compress a send stream into chunk files. Chunk files left behind
+        by an interrupted export of the same snapshot are removed first.
+
+        Args:
+            * name (str): name of the snapshot.
+            * stream (file): the send stream.
+            * parent (str): name of the parent it was sent from.
+            * clones (list(str)): names of its clone sources.
+            * codec (str): one of CODECS.
+            * level (int): compression level, None for the codec default.
+            * chunk_size (int): most bytes per chunk file.
+
+        Returns:
+            * (dict): the manifest entry to add, see read.
+        '''
+        if not chunk_size >= 1 or not isinstance(chunk_size, int):
+            raise Exception('chunk_size must be a positive integer')
+        compressor = get_codec(codec)[0](level)
+        chunk_pattern = re.compile(re.escape(name) + r'\.\d{4,}\.\w+$')
+        exported = set(chunk['file'] for previous in self.read()['snapshots']
+                       for chunk in previous['chunks'])
+        # leftovers of an interrupted export
+        for found in os.scandir(self.path):
+            if (re.match(chunk_pattern, found.name)
+                    and found.name not in exported):
+                os.unlink(found.path)
+        entry = {'name': name, 'parent': parent, 'clones': list(clones),
+                 'codec': codec, 'bytes': 0, 'exported': time.time(),
+                 'chunks': []}
+        out = None
+        digest = None
+
+        def close():
+            nonlocal out
+            out.close()
+            out = None
+            entry['chunks'][-1]['sha256'] = digest.hexdigest()
+
+        def emit(compressed):
+            nonlocal out, digest
+            view = memoryview(compressed)
+            while view:
+                if out is None:
+                    chunk = {'file': '{}.{:04d}.{}'.format(
+                        name, len(entry['chunks']), codec), 'size': 0}
+                    entry['chunks'].append(chunk)
+                    out = open(os.path.join(self.path, chunk['file']), 'wb')
+                    digest = hashlib.sha256()
+                chunk = entry['chunks'][-1]
+                room = chunk_size - chunk['size']
+                out.write(view[:room])
+                digest.update(view[:room])
+                chunk['size'] += len(view[:room])
+                view = view[room:]
+                if chunk['size'] == chunk_size:
+                    close()
+
+        try:
+            while True:
+                block = stream.read(PUMP_CHUNK)
+                if not block:
+                    break
+                entry['bytes'] += len(block)
+                emit(compressor.compress(block))
+            emit(compressor.flush())
+        except BaseException:
+            if out is not None:
+                out.close()
+            self.remove(entry)
+            raise
+        if out is not None:
+            close()
+        return entry
+
+    def add(self, entry):
+        '''
+        Add an entry written by write to the manifest, replacing an earlier
+        entry of the same snapshot.
+        '''
+        data = self.read()
+        files = set(chunk['file'] for chunk in entry['chunks'])
+        for previous in data['snapshots']:
+            if previous['name'] == entry['name']:
+                self.remove({'chunks': [chunk for chunk in previous['chunks']
+                                        if chunk['file'] not in files]})
+        data['snapshots'] = [previous for previous in data['snapshots']
+                             if previous['name'] != entry['name']] + [entry]
+        self._save(data)
+
+    def entry(self, name):
+        '''
+        Returns:
+            * (dict): the manifest entry of snapshot NAME, or None.
+        '''
+        for entry in self.read()['snapshots']:
+            if entry['name'] == name:
+                return entry
+        return None
+
+    def discard(self, name):
+        '''
+        Remove snapshot NAME and its chunk files.
+        '''
+        data = self.read()
+        for entry in data['snapshots']:
+            if entry['name'] == name:
+                self.remove(entry)
+        data['snapshots'] = [entry for entry in data['snapshots']
+                             if entry['name'] != name]
+        self._save(data)
+
+    def _intact(self, chunk):
+        path = os.path.join(self.path, chunk['file'])
+        try:
+            if os.path.getsize(path) != chunk['size']:
+                return False
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(functools.partial(f.read, PUMP_CHUNK), b''):
+                    digest.update(block)
+        except FileNotFoundError:
+            return False
+        return chunk.get('sha256', digest.hexdigest()) == digest.hexdigest()
+
+    def check(self, entry):
+        '''
+        Returns:
+            * (list(dict)): the chunks of ENTRY that are missing or do not
+              match their size and checksum.
+        '''
+        return [chunk for chunk in entry['chunks'] if not self._intact(chunk)]
+
+    def copy(self, entry, destination):
+        '''
+        Copy ENTRY to another ExportPath. Chunks the destination already
+        holds intact are not copied again.
+
+        Args:
+            * entry (dict): manifest entry, see read.
+            * destination (ExportPath): where to copy it.
+
+        Returns:
+            * (tuple): (copied, reused) numbers of chunks.
+        '''
+        previous = destination.entry(entry['name'])
+        if previous is None or previous['chunks'] != entry['chunks']:
+            # listed before copying, so an interrupted copy resumes
+            destination.add(entry)
+        missing = destination.check(entry)
+        for chunk in missing:
+            target = os.path.join(destination.path, chunk['file'])
+            shutil.copyfile(os.path.join(self.path, chunk['file']),
+                            target + '.tmp')
+            os.replace(target + '.tmp', target)
+        return len(missing), len(entry['chunks']) - len(missing)
+
+    def remove(self, entry):
+        '''
+        Delete the chunk files of a manifest entry.
+        '''
+        for chunk in entry['chunks']:
+            try:
+                os.unlink(os.path.join(self.path, chunk['file']))
+            except FileNotFoundError:
+                pass
+
+    def replay(self, out, entry):
+        '''
+        Write the send stream of a manifest entry to OUT.
+
+        Raises:
+            * Exception: a chunk is missing, truncated or corrupt. Every
+              chunk is checked before any of it is written to OUT.
+        '''
+        decompressor = get_codec(entry['codec'])[1]()
+        size = 0
+        for chunk in entry['chunks']:
+            path = os.path.join(self.path, chunk['file'])
+            if os.path.getsize(path) != chunk['size']:
+                raise Exception('Chunk \'{}\' should hold {} bytes'.format(
+                    path, chunk['size']))
+            if not self._intact(chunk):
+                raise Exception('Chunk \'{}\' does not match its'
+                                ' checksum'.format(path))
+            with open(path, 'rb') as f:
+                for block in iter(functools.partial(f.read, PUMP_CHUNK),
+                                  b''):
+                    for piece in _decompress(decompressor, block):
+                        size += len(piece)
+                        out.write(piece)
+        if not decompressor.eof or size != entry['bytes']:
+            raise Exception('The stream of {} is truncated'.format(
+                entry['name']))
+
+
+def _export_send(send_btr, export, snapshot, parent, clone_sources,
+                 codec='zlib', level=None, chunk_size=EXPORT_CHUNK_SIZE):
+    '''
+    Send a snapshot into an ExportPath.
+
+    Returns:
+        * (dict): the new manifest entry.
+
+    Raises:
+        * BtrfsError: the send failed. Its chunks are removed.
+    '''
+    p1 = send_btr.send(snapshot, parent, clone_sources)
+    try:
+        entry = export.write(
+            snapshot.name, p1.stdout,
+            parent=parent.name if parent is not None else None,
+            clones=[clone.name for clone in clone_sources], codec=codec,
+            level=level, chunk_size=chunk_size)
+    finally:
+        p1.stdout.close()
+        return_code = p1.wait()
+    if return_code:
+        export.remove(entry)
+        raise BtrfsError('BTRFS send of {} failed with exit status'
+                         ' {}'.format(snapshot, return_code))
+    export.add(entry)
+    return entry
+
+
+def _receive_export(receive_btr, export, entry, pump=None):
+    '''
+    Receive a snapshot from an ExportPath.
+
+    Raises:
+        * BtrfsError: the receive failed or the chunks are damaged.
+    '''
+    p1 = _ThreadedSend(export.replay, entry)
+    try:
+        receive_btr.receive(p1, pump=pump)
+    except BtrfsError:
+        if p1.error is not None:
+            raise BtrfsError('Can not receive {}: {}'.format(
+                entry['name'], p1.error))
+        raise
+
+
+def export_snaps(send_path, export_path, backend=None, codec='zlib',
+                 level=None, chunk_size=EXPORT_CHUNK_SIZE,
+                 clones=CLONE_SOURCES, dry_run=False):
+    '''
+    Export the snapshots in SEND_PATH that EXPORT_PATH is missing to
+    compressed chunk files.
+
+    The exports are planned like sendreceive, with the snapshots already
+    exported standing in for the receiving side, so every snapshot after
+    the first is exported as an increment.
+
+    Args:
+        * send_path (str): path holding the snapshots.
+        * export_path (str): directory to write the exports to.
+        * backend: Btrfs backend, see get_backend.
+        * codec (str): one of CODECS.
+        * level (int): compression level, None for the codec default.
+        * chunk_size (int): most bytes per chunk file.
+        * clones (int): most clone sources passed with each snapshot.
+        * dry_run (bool): only show the plan.
+
+    Returns:
+        * (str): results
+
+    Raises:
+        * BtrfsError: a send failed. Its chunks are removed.
+    '''
+    get_codec(codec)
+    send = SnapPath(send_path)
+    export = ExportPath(export_path)
+    plan = _plan_sends(send.snapshots(), export.snapshots(), clones)
+    if not plan:
+        return 'No new snapshots to export from \'{}\' to \'{}\''.format(
+            send.path, export.path)
+    if dry_run:
+        return '\n'.join(['Would export {} snapshot(s) from \'{}\' to'
+                          ' \'{}\''.format(len(plan), send.path,
+                                           export.path)] + _plan_lines(plan))
+
+    send_btr = Btrfs(send.path, backend=backend)
+    size = 0
+    written = 0
+    start = time.monotonic()
+    for snapshot, parent, clone_sources in plan:
+        entry = _export_send(send_btr, export, snapshot, parent,
+                             clone_sources, codec=codec, level=level,
+                             chunk_size=chunk_size)
+        size += entry['bytes']
+        written += sum(chunk['size'] for chunk in entry['chunks'])
+    return ('{} snapshots exported from \'{}\' to \'{}\' ({}, {:.1f} MB'
+            ' written)'.format(len(plan), send.path, export.path,
+                               _megabytes(size, time.monotonic() - start),
+                               written / MEGABYTE))
+
+
+def import_snaps(export_path, receive_path, backend=None, dry_run=False):
+    '''
+    Receive the exported snapshots RECEIVE_PATH is missing, in the order
+    they were exported.
+
+    Args:
+        * export_path (str): directory written by export_snaps.
+        * receive_path (str): path to receive snapshots in.
+        * backend: Btrfs backend, see get_backend.
+        * dry_run (bool): only show what would be imported.
+
+    Returns:
+        * (str): results
+
+    Raises:
+        * BtrfsError: a parent or clone source is missing from
+          RECEIVE_PATH, or a stream could not be received.
+    '''
+    export = ExportPath(export_path)
+    receive = ReceivePath(receive_path)
+    present = set(receive.snapshots())
+    entries = []
+    for entry in export.read()['snapshots']:
+        if entry['name'] in present:
+            continue
+        for needed in [entry['parent']] + entry['clones']:
+            if needed is not None and needed not in present:
+                raise BtrfsError('{} was exported from {}, which is not in'
+                                 ' \'{}\''.format(entry['name'], needed,
+                                                  receive.path))
+        entries.append(entry)
+        present.add(entry['name'])
+    if not entries:
+        return 'No new snapshots to import from \'{}\' to \'{}\''.format(
+            export.path, receive.path)
+    if dry_run:
+        return '\n'.join(['Would import {} snapshot(s) from \'{}\' to'
+                          ' \'{}\''.format(len(entries), export.path,
+                                           receive.path)] +
+                         ['\t{}: {}'.format(entry['name'],
+                                            'from ' + entry['parent']
+                                            if entry['parent'] else 'full')
+                          for entry in entries])
+
+    receive_btr = Btrfs(receive.path, backend=backend)
+    start = time.monotonic()
+    for entry in entries:
+        _receive_export(receive_btr, export, entry)
+    return '{} snapshots imported from \'{}\' to \'{}\' ({})'.format(
+        len(entries), export.path, receive.path, _megabytes(
+            sum(entry['bytes'] for entry in entries),
+            time.monotonic() - start))
+
+
+class ChecksumManifest(Path):
+    '''
+    Checksums of the send streams of the snapshots in PATH, kept in a
+    sidecar file (CHECKSUM_FILE) next to them by send with a checksum. The
+    sending side records every stream it sent and the receiving side the
+    stream each snapshot was received from, so verify can compare the two
+    without reading the snapshots again.
+
+    Every change locks the file and rewrites it in place, so parallel sends
+    can share it, and drops the records of snapshots that are gone so the
+    file does not outgrow the snapshots in PATH.
+
+    Args:
+        * path (str): the SNAPPATH or receive path.
+
+    Attributes:
+        * path (str): absolute path
+        * file (str): absolute path of the sidecar file.
+
+    Raises:
+        * PathError:
+    '''
+
+    def __init__(self, path):
+        Path.__init__(self, path)
+        self.file = os.path.join(self.path, CHECKSUM_FILE)
+
+    @staticmethod
+    def _empty():
+        return {'version': CHECKSUM_VERSION, 'snapshots': {}}
+
+    @contextlib.contextmanager
+    def _locked(self):
+        '''
+        Lock the sidecar file and yield its data, writing it back
+        afterwards.
+        '''
+        fd = os.open(self.file, os.O_RDWR | os.O_CREAT, 0o644)
+        with open(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                data = json.load(f)
+            except ValueError:
+                data = None
+            if (not isinstance(data, dict)
+                    or data.get('version') != CHECKSUM_VERSION):
+                data = self._empty()
+            yield data
+            f.seek(0)
+            f.truncate()
+            json.dump(data, f, indent=1)
+
+    def read(self):
+        '''
+        Returns:
+            * (dict): data with key snapshots, which maps the name of each
+              snapshot to a list of dicts with keys algorithm, digest,
+              bytes, parent, clones and time.
+        '''
+        try:
+            with open(self.file) as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if (not isinstance(data, dict)
+                or data.get('version') != CHECKSUM_VERSION):
+            data = self._empty()
+        return data
+
+    def record(self, name, stream, replace=False):
+        '''
+        Record the checksum of a send stream of snapshot NAME. A previous
+        record of a stream with the same parent and clone sources is
+        replaced.
+
+        Args:
+            * name (str): name of the snapshot.
+            * stream (dict): keys algorithm, digest, bytes, parent (name
+              or None) and clones (list of names).
+            * replace (bool): drop every other record of NAME, as the
+              receiving side only keeps the stream it received.
+        '''
+        stream = dict(stream, time=int(time.time()))
+        with self._locked() as data:
+            existing = set(os.listdir(self.path))
+            data['snapshots'] = {
+                snapshot: streams
+                for snapshot, streams in data['snapshots'].items()
+                if snapshot in existing}
+            streams = [] if replace else [
+                previous for previous in data['snapshots'].get(name, [])
+                if (previous['parent'], previous['clones'])
+                != (stream['parent'], stream['clones'])]
+            data['snapshots'][name] = streams + [stream]
+
+
+def verify(send_path, receive_path):
+    '''
+    Compare the stream checksums recorded by send with a checksum in
+    SEND_PATH and RECEIVE_PATH, see ChecksumManifest. No snapshot is read.
+
+    A snapshot in RECEIVE_PATH is verified when the sending side recorded
+    a stream with the same parent, clone sources, algorithm, digest and
+    size as the one it was received from. Snapshots received without a
+    checksum are reported as unverified, and records of snapshots that are
+    gone are ignored.
+
+    Args:
+        * send_path (str): the sending SNAPPATH.
+        * receive_path (str): the receive path.
+
+    Returns:
+        * (str): results
+
+    Raises:
+        * Exception: with the results, when a checksum differs.
+    '''
+    send = SnapPath(send_path)
+    receive = ReceivePath(receive_path)
+    sent = ChecksumManifest(send.path).read()['snapshots']
+    received = ChecksumManifest(receive.path).read()['snapshots']
+    fields = ('parent', 'clones', 'algorithm', 'digest', 'bytes')
+    verified = []
+    unverified = []
+    unknown = []
+    mismatched = []
+    for snapshot in sorted(receive.snapshots(), key=SNAPSHOT_SORT_KEY):
+        streams = received.get(snapshot.name)
+        if not streams:
+            unverified.append(snapshot.name)
+            continue
+        stream = streams[-1]
+        candidates = [candidate for candidate in sent.get(snapshot.name, [])
+                      if (candidate['parent'], candidate['clones'])
+                      == (stream['parent'], stream['clones'])]
+        if not candidates:
+            unknown.append(snapshot.name)
+        elif any(all(candidate[field] == stream[field] for field in fields)
+                 for candidate in candidates):
+            verified.append(snapshot.name)
+        else:
+            mismatched.append(snapshot.name)
+    msg = ['Verified {} snapshot(s) in \'{}\' against \'{}\': {}'
+           ' unverified, {} not recorded by the sender, {}'
+           ' mismatched'.format(len(verified), receive.path, send.path,
+                                len(unverified), len(unknown),
+                                len(mismatched))]
+    msg.extend('\t{}: checksum mismatch'.format(name)
+               for name in mismatched)
+    if mismatched:
+        raise Exception('\n'.join(msg))
+    return '\n'.join(msg)
+
+
+def verify_deep(send_path, receive_path):
+    '''
+    Verify every subdirectory of SEND_PATH against the subdirectory of the
+    same name in RECEIVE_PATH, see verify. Subdirectories missing from
+    RECEIVE_PATH are skipped.
+
+    Returns:
+        * (str): results
+
+    Raises:
+        * Exception: with the results, when a checksum differs.
+    '''
+    receive_root = Path(receive_path).path
+    msg = []
+    failed = False
+    for snappath in SnapDeep(send_path).snap_paths():
+        receive = os.path.join(receive_root, os.path.basename(snappath.path))
+        if not os.path.isdir(receive):
+            continue
+        try:
+            msg.append(verify(snappath.path, receive))
+        except Exception as err:
+            failed = True
+            msg.append(str(err))
+    if failed:
+        raise Exception('\n'.join(msg))
+    return '\n'.join(msg)
+
+
+class Schedule:
+    '''
+    The jobs of the daemon, read from a JSON file like::
+
+        {"socket": "/run/btrsnap.sock",
+         "jitter": 0.1,
+         "jobs": [{"name": "home", "path": "/snapshots", "recursive": true,
+                   "snap_every": 900, "keep": 4, "daily": 7,
+                   "send_to": ["/backup"], "send_every": 3600}]}
+
+    Every job snapshots PATH (each subdirectory with recursive) every
+    snap_every seconds and then deletes the snapshots its retention does
+    not keep: keep alone keeps the newest KEEP, a bucket of
+    RETENTION_BUCKETS or max_age makes a RetentionPolicy, hourly only with a
+    resolution of second or microsecond. Jobs with send_to send to each of
+    those paths every send_every seconds, with the via, scan, resumable and
+    checksum options of send.
+
+    Args:
+        * path (str): the schedule file.
+
+    Attributes:
+        * path (str): absolute path of the schedule file.
+        * socket (str): path of the control socket, default the schedule
+          file with '.sock' appended.
+        * jitter (float): see DAEMON_JITTER.
+        * jobs (list(dict)): the jobs, with every key of DAEMON_JOB_KEYS
+          and the policy (RetentionPolicy or None).
+
+    Raises:
+        * Exception: the schedule is invalid.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            raise Exception('Can not read the schedule \'{}\': {}'.format(
+                self.path, err))
+        if not isinstance(data, dict) or not isinstance(data.get('jobs'),
+                                                        list):
+            raise Exception('The schedule \'{}\' needs a list of'
+                            ' jobs'.format(self.path))
+        self.socket = os.path.abspath(data.get('socket',
+                                               self.path + '.sock'))
+        self.jitter = data.get('jitter', DAEMON_JITTER)
+        if (not isinstance(self.jitter, (int, float))
+                or not 0 <= self.jitter <= 1):
+            raise Exception('jitter must be between 0 and 1')
+        self.jobs = []
+        for number, job in enumerate(data['jobs']):
+            try:
+                self.jobs.append(self._job(job))
+            except Exception as err:
+                raise Exception('Job {} of \'{}\': {}'.format(
+                    number + 1, self.path, err))
+        names = [job['name'] for job in self.jobs]
+        for name in names:
+            if names.count(name) > 1:
+                raise Exception('Job name \'{}\' is used more than'
+                                ' once'.format(name))
+
+    @staticmethod
+    def _job(job):
+        '''
+        Returns:
+            * (dict): JOB validated, with defaults filled in.
+        '''
+        if not isinstance(job, dict) or 'path' not in job:
+            raise Exception('path is missing')
+        unknown = sorted(set(job) - set(DAEMON_JOB_KEYS))
+        if unknown:
+            raise Exception('unknown key(s) {}'.format(', '.join(unknown)))
+        job = dict({key: None for key in DAEMON_JOB_KEYS}, **job)
+        job['path'] = os.path.abspath(job['path'])
+        job['name'] = job['name'] or job['path']
+        job['recursive'] = bool(job['recursive'])
+        job['resolution'] = job['resolution'] or 'day'
+        if job['resolution'] not in RESOLUTIONS:
+            raise Exception('resolution must be one of {}'.format(
+                ', '.join(RESOLUTIONS)))
+        for key in ('snap_every', 'send_every'):
+            if job[key] is not None and (
+                    not isinstance(job[key], (int, float))
+                    or not job[key] > 0):
+                raise Exception('{} must be a positive number of'
+                                ' seconds'.format(key))
+        if isinstance(job['send_to'], str):
+            job['send_to'] = [job['send_to']]
+        if (job['send_to'] is None) != (job['send_every'] is None):
+            raise Exception('send_to and send_every go together')
+        if job['snap_every'] is None and job['send_to'] is None:
+            raise Exception('nothing to do without snap_every or send_to')
+        counts = {name: job[name] or 0 for name in RETENTION_BUCKETS}
+        if counts['hourly'] and job['resolution'] == 'day':
+            raise Exception('hourly needs a resolution of second or'
+                            ' microsecond')
+        max_age = job['max_age']
+        if max_age is not None:
+            max_age = parse_age(max_age)
+        job['policy'] = None
+        if any(counts.values()) or max_age is not None:
+            job['policy'] = RetentionPolicy(
+                keep=1 if job['keep'] is None else job['keep'],
+                max_age=max_age, **counts)
+        elif job['keep'] is not None:
+            # validated the way unsnap does
+            RetentionPolicy(keep=job['keep'])
+        return job
+
+
+class Daemon:
+    '''
+    Run the jobs of a Schedule, keeping one SnapshotIndex in memory for
+    all of them so every run only rescans the SNAPPATHs that changed.
+
+    Every job has a snap and a send task, for what it does. A task runs on
+    its own thread every interval, measured from when it was due rather
+    than when it finished, and delayed by up to JITTER of the interval so
+    jobs with the same interval do not all start at once. A task that is
+    still running when it is due again is skipped. The tasks of one job
+    wait for each other, so retention never deletes a snapshot a send of
+    the same job is using.
+
+    Args:
+        * schedule (Schedule): the jobs.
+        * backend: Btrfs backend, see get_backend.
+        * log (callable): called with a line to report, default print.
+
+    Attributes:
+        * schedule (Schedule): see Args.
+        * index (SnapshotIndex): the index shared by every run.
+        * tasks (dict): task name ('JOB/snap' or 'JOB/send') to its state,
+          see status.
+    '''
+
+    def __init__(self, schedule, backend=None, log=None):
+        self.schedule = schedule
+        self.backend = backend if backend is not None else ProgsBackend()
+        self.log = log if log is not None else functools.partial(
+            print, flush=True)
+        self.index = SnapshotIndex()
+        self.tasks = {}
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._server = None
+        now = time.monotonic()
+        for job in schedule.jobs:
+            lock = threading.Lock()
+            for kind, interval in (('snap', job['snap_every']),
+                                   ('send', job['send_every'])):
+                if interval is None:
+                    continue
+                self.tasks['{}/{}'.format(job['name'], kind)] = {
+                    'job': job, 'kind': kind, 'interval': interval,
+                    'lock': lock, 'nominal': now,
+                    'due': now + self._jitter(interval), 'running': False,
+                    'runs': 0, 'skipped': 0, 'last': None}
+
+    def _say(self, name, line):
+        self.log('{} {}: {}'.format(
+            datetime.datetime.now().isoformat(sep=' ', timespec='seconds'),
+            name, line))
+
+    def _jitter(self, interval):
+        return random.uniform(0, self.schedule.jitter * interval)
+
+    def _work(self, task):
+        '''
+        Returns:
+            * msg (str): the results of one run of TASK.
+        '''
+        job = task['job']
+        path = job['path']
+        backend = self.backend
+        if task['kind'] == 'send':
+            checksum = CHECKSUM_ALGORITHM if job['checksum'] else None
+            func = sendreceive_deep if job['recursive'] else sendreceive
+            return func(path, job['send_to'], index=self.index,
+                        backend=backend, via=job['via'],
+                        scan=bool(job['scan']),
+                        resumable=bool(job['resumable']),
+                        checksum=checksum)
+        msg = []
+        if job['recursive']:
+            msg.append(snapdeep(path, index=self.index,
+                                resolution=job['resolution'],
+                                backend=backend))
+        else:
+            msg.append(snap(path, index=self.index,
+                            resolution=job['resolution'], backend=backend))
+        if job['policy'] is not None or job['keep'] is not None:
+            func = unsnap_deep if job['recursive'] else unsnap
+            msg.append(func(path, keep=job['keep'], index=self.index,
+                            backend=backend, policy=job['policy']))
+        return '\n'.join(line for line in msg if line)
+
+    def _run(self, name, task):
+        started = time.time()
+        start = time.monotonic()
+        try:
+            with task['lock']:
+                msg = self._work(task)
+            ok = True
+        except Exception as err:
+            msg = 'Error: {}'.format(err)
+            ok = False
+        seconds = time.monotonic() - start
+        for line in msg.splitlines():
+            self._say(name, line)
+        with self._condition:
+            task['running'] = False
+            task['runs'] += 1
+            task['last'] = {'started': started, 'seconds': seconds,
+                            'ok': ok, 'msg': msg}
+            self._condition.notify_all()
+
+    def run_pending(self):
+        '''
+        Start every task that is due.
+
+        Returns:
+            * (float): seconds until the next task is due.
+        '''
+        with self._condition:
+            now = time.monotonic()
+            for name, task in sorted(self.tasks.items()):
+                if task['due'] > now:
+                    continue
+                interval = task['interval']
+                # the next run after now, on the grid of the interval
+                periods = max(1, math.ceil((now - task['nominal'])
+                                           / interval))
+                task['nominal'] += periods * interval
+                task['due'] = task['nominal'] + self._jitter(interval)
+                if task['running']:
+                    task['skipped'] += 1
+                    self._say(name, 'skipped, the last run is still'
+                              ' running')
+                    continue
+                task['running'] = True
+                thread = threading.Thread(target=self._run,
+                                          args=(name, task))
+                self._threads = [running for running in self._threads
+                                 if running.is_alive()] + [thread]
+                thread.start()
+            return max(0.0, min((task['due'] for task in self.tasks.values()),
+                                default=now + 60) - now)
+
+    def trigger(self, name):
+        '''
+        Make task NAME due now.
+
+        Raises:
+            * Exception: there is no such task.
+        '''
+        with self._condition:
+            if name not in self.tasks:
+                raise Exception('No task \'{}\', the tasks are {}'.format(
+                    name, ', '.join(sorted(self.tasks))))
+            self.tasks[name]['due'] = time.monotonic()
+            self._condition.notify_all()
+
+    def status(self):
+        '''
+        Returns:
+            * (dict): task name to a dict with keys running (bool), next
+              (seconds until it is due), runs, skipped and last (None, or a
+              dict with keys started (epoch seconds), seconds, ok and msg).
+        '''
+        with self._condition:
+            now = time.monotonic()
+            return {name: {'running': task['running'],
+                           'next': max(0.0, task['due'] - now),
+                           'runs': task['runs'],
+                           'skipped': task['skipped'],
+                           'last': task['last']}
+                    for name, task in self.tasks.items()}
+
+    def wait(self):
+        '''
+        Wait for the running tasks to finish.
+        '''
+        with self._condition:
+            threads = list(self._threads)
+        for thread in threads:
+            thread.join()
+
+    def _listen(self):
+        '''
+        Start answering the control socket, see control.
+
+        Raises:
+            * Exception: another daemon is listening on it.
+        '''
+        path = self.schedule.socket
+        if os.path.exists(path):
+            try:
+                control(path, 'status')
+            except OSError:
+                # left behind by a daemon that is gone
+                os.unlink(path)
+            else:
+                raise Exception('Another daemon is listening on'
+                                ' \'{}\''.format(path))
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode())
+                    if request.get('command') == 'status':
+                        reply = {'ok': True, 'tasks': daemon.status()}
+                    elif request.get('command') == 'run':
+                        daemon.trigger(request.get('task'))
+                        reply = {'ok': True}
+                    else:
+                        raise Exception('Unknown command {!r}'.format(
+                            request.get('command')))
+                except Exception as err:
+                    reply = {'ok': False, 'error': str(err)}
+                self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        umask = os.umask(0o177)
+        try:
+            self._server = socketserver.ThreadingUnixStreamServer(
+                path, Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+
+    def serve(self):
+        '''
+        Run the schedule until stop is called, answering the control
+        socket. Running tasks are waited for before returning.
+        '''
+        self._listen()
+        self.log('Serving {} task(s) of \'{}\' on \'{}\''.format(
+            len(self.tasks), self.schedule.path, self.schedule.socket))
+        try:
+            while True:
+                timeout = self.run_pending()
+                with self._condition:
+                    if self._stopping:
+                        break
+                    self._condition.wait(timeout)
+                    if self._stopping:
+                        break
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
+            os.unlink(self.schedule.socket)
+            self.wait()
 
-        Raises:
-            * BtrfsError:
+    def stop(self):
         '''
-        args = ['btrfs', 'receive', self.path]
-        p2 = subprocess.Popen(args, stdin=p1.stdout,
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        output = p2.communicate()
-        p1.stdout.close()
-        if p2.returncode:
-            raise BtrfsError('BTRFS Failed send/recieve.'
-                             ' Do you have root permissions?',
-                             output[0], output[1])
+        Make serve return once the running tasks are done.
+        '''
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
 
 
-def snap(path, readonly=True):
+def control(path, command, task=None):
     '''
-    Creates a snapshot inside PATH with format YYYY-MM-DD-####
-    of the subvolume pointed to by the symlink inside PATH.
+    Ask the daemon listening on the control socket PATH.
 
     Args:
-        * path (str): path on filesystem
-        * readonly (bool): create readonly snapshot?
-    '''
-    snappath = SnapPath(path)
-    btrfs = Btrfs(snappath.path)
-    btrfs.snap(snappath.target, snappath.timestamp(), readonly=readonly)
+        * path (str): the control socket, see Schedule.
+        * command (str): 'status' or 'run'.
+        * task (str): with 'run', the task to make due now.
 
+    Returns:
+        * (dict): the reply, with keys ok, and tasks (see Daemon.status)
+          or error.
 
-def unsnap(path, keep=5):
+    Raises:
+        * OSError: no daemon is listening.
     '''
-    Delete all but most recent KEEP(default 5) snapshots inside PATH
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(json.dumps({'command': command,
+                                   'task': task}).encode() + b'\n')
+        with client.makefile('rb') as reply:
+            return json.loads(reply.readline().decode())
 
-    Args:
-        * path (str): path on filesystem
-        * keep (int): number of snapshots to keep
 
-    Returns:
-        * msg (str): results
+def _ask(path, command, task=None):
     '''
-    snappath = ReceivePath(path)
-    btrfs = Btrfs(snappath.path)
-    snapshots = snappath.snapshots()
+    Send COMMAND to the daemon of the schedule PATH, see control.
 
-    if not keep >= 0 or not isinstance(keep, int):
-        raise Exception('keep must be a positive integer')
-    if len(snapshots) > keep:
-        snaps_to_delete = snapshots[keep:]
-        for snapshot in snaps_to_delete:
-            btrfs.unsnap(snapshot)
-        msg = 'Deleted {} snapshot(s) from "{}". {} kept'.format(
-            len(snaps_to_delete), snappath.path, keep)
-    else:
-        msg = ('There are less than {} snapshot(s) in "{}"...'
-               ' not deleting any'.format(keep, snappath.path))
-    return msg
+    Raises:
+        * Exception: no daemon is listening or the command failed.
+    '''
+    socket_path = Schedule(path).socket
+    try:
+        reply = control(socket_path, command, task)
+    except OSError as err:
+        raise Exception('No daemon is listening on \'{}\': {}'.format(
+            socket_path, err.strerror or err))
+    if not reply['ok']:
+        raise Exception(reply['error'])
+    return reply
 
 
-def unsnap_deep(path, keep=5):
+def daemon_status(path):
     '''
-    Delete all but KEEP (default 5) snapshots from each directory
-    inside of path
-
-    Args:
-        * path (str): path on filesystem
-        * keep (int): number of snapshots to keep
+    Show the tasks of the daemon listening on the control socket of the
+    schedule PATH.
 
     Returns:
         * msg (str): results
     '''
+    reply = _ask(path, 'status')
     msg = []
-    receive_deep = ReceiveDeep(path)
-    receive_paths = receive_deep.receive_paths()
-    receive_paths = [path.path for path in receive_paths]
-    if len(receive_paths) == 0:
-        msg = 'No subdirectories found in \'{}\''.format(receive_deep.path)
-        return msg
-    for path in receive_paths:
-        msg.append(unsnap(path, keep))
+    for name, task in sorted(reply['tasks'].items()):
+        line = '{}: {}, {} run(s), {} skipped'.format(
+            name, 'running' if task['running']
+            else 'next in {:.0f}s'.format(task['next']),
+            task['runs'], task['skipped'])
+        last = task['last']
+        if last is not None:
+            line += '. Last {} at {} in {:.1f}s'.format(
+                'ok' if last['ok'] else 'FAILED',
+                datetime.datetime.fromtimestamp(last['started']).isoformat(
+                    sep=' ', timespec='seconds'), last['seconds'])
+        msg.append(line)
     return '\n'.join(msg)
 
 
-def snapdeep(path, readonly=True):
+def daemon_run(path, task):
     '''
-    Create a snapshot in each subdirectory in PATH.
-
-    Args:
-        * path (str): path on filesystem
-        * readonly (bool): Create readonly snapshots?
+    Make TASK of the daemon listening on the control socket of the schedule
+    PATH due now.
 
     Returns:
         * msg (str): results
     '''
-    snapdeep = SnapDeep(path)
-    snap_paths = snapdeep.snap_paths()
-    if len(snap_paths) == 0:
-        msg = 'No snapshot directories found in \'{}\''.format(snapdeep.path)
-        return msg
-    for snap_path in snap_paths:
-        snap(snap_path.path, readonly=readonly)
+    _ask(path, 'run', task)
+    return 'Started \'{}\''.format(task)
 
 
-def show_snaps(path):
+def simulate(argv=None):
     '''
-    List snapshots inside PATH.
-
-    Args:
-        * path (str): path on filesystem.
+    Stand-in for the btrfs command backed by SimulatedBackend.
 
-    Returns:
-        * msg (str): results
+    Supports the commands btrsnap runs: subvolume create, snapshot, delete,
+    list and show, qgroup show, filesystem du, send and receive. Install
+    it as 'btrfs' early in PATH to run btrsnap with the progs backend
+    against plain directories. The latency is read from the
+    BTRSNAP_SIM_LATENCY environment variable.
     '''
-    receive_path = ReceivePath(path)
-    snapshots = receive_path.snapshots()
-    msg = []
-    for snapshot in snapshots:
-        msg.append(snapshot)
-    msg.append('\n"{}" contains {} snapshot(s)'.format(
-        receive_path.path, len(snapshots)))
-    return '\n'.join(msg)
 
+    import argparse
 
-def show_snaps_deep(path):
-    '''
-    Recursively list snapshots inside PATH.
+    backend = SimulatedBackend(
+        latency=float(os.environ.get('BTRSNAP_SIM_LATENCY', 0)))
 
-    Args:
-        * path (str): Path on filesystem.
+    def run_create(args):
+        backend.create(os.path.abspath(args.path))
 
-    Returns:
-        * msg (str): results
-    '''
-    msg = []
-    overall_snapshot_count = 0
-    overall_path_count = 0
-    receive_deep = ReceiveDeep(path)
-    receive_paths = receive_deep.receive_paths()
-    for p in receive_paths:
-        snapshots = p.snapshots()
-        msg.append('\n\'{}\'/'.format(p.path))
-        if snapshots:
-            newest = snapshots[0]
-            oldest = snapshots[-1]
-            msg.append('\t{} snapshots: Newest = {}, Oldest = {}'.format(
-                len(snapshots), newest[:-5], oldest[:-5]))
-            for snapshot in snapshots:
-                msg.append('\t\t{}'.format(snapshot))
-                overall_snapshot_count += 1
+    def run_snapshot(args):
+        destination = os.path.abspath(args.destination)
+        if os.path.isdir(destination):
+            destination = os.path.join(
+                destination, os.path.basename(os.path.abspath(args.source)))
+        backend.snap(os.path.abspath(args.source), destination,
+                     readonly=args.readonly)
+        print('Create a snapshot of \'{}\' in \'{}\''.format(
+            args.source, destination))
+
+    def run_delete(args):
+        paths = [os.path.abspath(path) for path in args.path]
+        for path in paths:
+            print('Delete subvolume \'{}\''.format(path))
+        backend.delete_batch(paths, commit=args.commit)
+
+    def run_list(args):
+        if args.d:
+            return
+        path = os.path.realpath(args.path)
+        # Without -o btrfs lists the whole filesystem. The simulation lists
+        # everything below the parent of PATH instead, see list_filesystem.
+        if args.o:
+            subvolumes = backend.list(path)
         else:
-            msg.append('\t\tNo snapshots')
-        overall_path_count += 1
-    msg.append('\n{:{s}^{n}}'.format(' Summary ', s='-', n=60))
-    msg.append('\'{}\' contains {} snapshots in {} subdirectories'.format(
-        path, overall_snapshot_count, overall_path_count))
+            path = os.path.dirname(path)
+            subvolumes = backend._walk(path)
+        prefix = _toplevel_path(path, _mounts())
+        for subvolume in subvolumes:
+            print('ID {} gen {} top level 5 parent_uuid {} received_uuid {}'
+                  ' uuid {} path {}'.format(
+                      subvolume['id'], subvolume['generation'],
+                      subvolume['parent_uuid'] or '-',
+                      subvolume['received_uuid'] or '-', subvolume['uuid'],
+                      os.path.join(prefix, os.path.relpath(
+                          subvolume['path'], path))))
 
-    return '\n'.join(msg)
+    def run_show(args):
+        path = os.path.realpath(args.path)
+        info = backend.show(path)
+        print(_toplevel_path(path, _mounts()) or '/')
+        print('\tName: \t\t\t{}'.format(info['name']))
+        print('\tUUID: \t\t\t{}'.format(info['uuid']))
+        print('\tParent UUID: \t\t{}'.format(info['parent_uuid'] or '-'))
+        print('\tReceived UUID: \t\t{}'.format(info['received_uuid'] or '-'))
+        print('\tGeneration: \t\t{}'.format(info['generation']))
+        print('\tFlags: \t\t\t{}'.format(
+            'readonly' if info['readonly'] else '-'))
 
+    def run_qgroup_show(args):
+        print('qgroupid         rfer         excl ')
+        print('--------         ----         ---- ')
+        for qgroup, sizes in sorted(backend.qgroups(args.path).items()):
+            print('0/{:<10} {:>12} {:>12} '.format(
+                qgroup, sizes['referenced'], sizes['exclusive']))
 
-def sendreceive(send_path, receive_path):
-    '''
-    Send snapshots from one BTRFS PATH to another.
+    def run_du(args):
+        print('     Total   Exclusive  Set shared  Filename')
+        for path, sizes in backend.du(args.path).items():
+            print('{:>10}  {:>10}  {:>10}  {}'.format(
+                sizes['referenced'], sizes['exclusive'],
+                sizes['referenced'] - sizes['exclusive'], path))
 
-    Args:
-        * send_path: path to snapshot to send
-        * receive_path: path to receive snapshot in.
+    def run_send(args):
+        parent = os.path.abspath(args.parent) if args.parent else None
+        backend.stream(sys.stdout.buffer, os.path.abspath(args.subvolume),
+                       parent, [os.path.abspath(clone)
+                                for clone in args.clones])
 
-    Returns:
-        * (str): results
-    '''
-    send = SnapPath(send_path)
-    receive = ReceivePath(receive_path)
-    send_btr = Btrfs(send.path)
-    receive_btr = Btrfs(receive.path)
-
-    send_set = set(send.snapshots())
-    receive_set = set(receive.snapshots())
-    diff = send_set - receive_set
-    diff = list(diff)
-    diff.sort()
-    union = send_set & receive_set
-    union = list(union)
-    union.sort()
-
-    number_sent = len(diff)
-
-    if diff:
-        if union and union[-1] < diff[0]:
-            parent, snapshot = union[-1], diff[0]
-            p1 = send_btr.send(snapshot, parent)
-            receive_btr.receive(p1)
-        else:
-            parent, snapshot = None, diff[0]
-            p1 = send_btr.send(snapshot, parent)
-            receive_btr.receive(p1)
-        while diff:
-            if len(diff) >= 2:
-                parent, snapshot = diff.pop(0), diff[0]
-                p1 = send_btr.send(snapshot, parent)
-                receive_btr.receive(p1)
-            else:
-                diff.pop(0)
-        msg = '{} snapshots copied from \'{}\' to \'{}\''.format(
-            number_sent, send.path, receive.path)
-    else:
-        msg = 'No new snapshots to copy from \'{}\' to \'{}\''.format(
-            send.path, receive.path)
-    return msg
+    def run_receive(args):
+        backend.receive(os.path.abspath(args.path), sys.stdin.buffer)
 
+    parser = argparse.ArgumentParser(
+        prog='btrfs', description='Simulated btrfs for btrsnap.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    subvolume = commands.add_parser(
+        'subvolume', aliases=['sub', 'subvol']).add_subparsers(
+            dest='subcommand')
+    subvolume.required = True
 
-def sendreceive_deep(send_path, receive_path):
-    '''
-    Send all snapshots in subdirectories of send_path to receive_path.
+    create = subvolume.add_parser('create')
+    create.add_argument('path')
+    create.set_defaults(func=run_create)
 
-    Args:
-        * send_path (str): absolute path holding one or more snapshot
-                         directories.
-        * receive_path (str): absolute path to receive snapshot directories in.
+    snapshot = subvolume.add_parser('snapshot', aliases=['snap'])
+    snapshot.add_argument('-r', dest='readonly', action='store_true')
+    snapshot.add_argument('source')
+    snapshot.add_argument('destination')
+    snapshot.set_defaults(func=run_snapshot)
 
-    Returns:
-        * (str): results.
-    '''
-    snappaths = SnapDeep(send_path)
-    snappaths = snappaths.snap_paths()
-    snappaths = [snappath.path for snappath in snappaths]
-    receive_path = Path(receive_path)
-    receive_path = receive_path.path
-    receive_paths = [os.path.join(receive_path, s.split(os.path.sep)[-1]) for
-                     s in snappaths]
-    msg = []
+    delete = subvolume.add_parser('delete', aliases=['del'])
+    delete.add_argument('-c', '--commit-after', dest='commit',
+                        action='store_const', const='after')
+    delete.add_argument('-C', '--commit-each', dest='commit',
+                        action='store_const', const='each')
+    delete.add_argument('path', nargs='+')
+    delete.set_defaults(func=run_delete)
 
-    for p in receive_paths:
-        if not os.path.isdir(p):
-            os.mkdir(p)
+    subvolume_list = subvolume.add_parser('list')
+    for flag in ('-o', '-q', '-R', '-u', '-d'):
+        subvolume_list.add_argument(flag, action='store_true')
+    subvolume_list.add_argument('path')
+    subvolume_list.set_defaults(func=run_list)
 
-    args = zip(snappaths, receive_paths)
-    for send_path, receive_path in args:
-        msg.append(sendreceive(send_path, receive_path))
-    return '\n'.join(msg)
+    show = subvolume.add_parser('show')
+    show.add_argument('path')
+    show.set_defaults(func=run_show)
+
+    qgroup = commands.add_parser('qgroup').add_subparsers(dest='subcommand')
+    qgroup.required = True
+    qgroup_show = qgroup.add_parser('show')
+    qgroup_show.add_argument('--raw', action='store_true')
+    qgroup_show.add_argument('path')
+    qgroup_show.set_defaults(func=run_qgroup_show)
+
+    filesystem = commands.add_parser(
+        'filesystem', aliases=['fi']).add_subparsers(dest='subcommand')
+    filesystem.required = True
+    du = filesystem.add_parser('du')
+    du.add_argument('-s', action='store_true')
+    du.add_argument('--raw', action='store_true')
+    du.add_argument('path', nargs='+')
+    du.set_defaults(func=run_du)
+
+    send = commands.add_parser('send')
+    send.add_argument('-p', dest='parent')
+    send.add_argument('-c', dest='clones', action='append', default=[])
+    send.add_argument('subvolume')
+    send.set_defaults(func=run_send)
+
+    receive = commands.add_parser('receive')
+    receive.add_argument('path')
+    receive.set_defaults(func=run_receive)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    except (BtrfsError, OSError) as err:
+        print('ERROR:', err, file=sys.stderr)
+        sys.exit(1)
 
 
 def main():
@@ -566,42 +5952,190 @@ def main():
         except Exception as err:
             print('Error:', err)
 
+    def retention(args):
+        '''
+        Returns the RetentionPolicy of the bucket and --max-age options, or
+        None when none was given. -k, --keep defaults to 1 with a policy.
+        '''
+        counts = {name: getattr(args, name) or 0
+                  for name in RETENTION_BUCKETS}
+        if not any(counts.values()) and args.max_age is None:
+            return None
+        return RetentionPolicy(keep=args.keep[0] if args.keep else 1,
+                               max_age=args.max_age, **counts)
+
     def run_snap(args):
+        backend = get_backend(args.backend)
         keep = None
+        policy = None
         if args.delete:
             keep = 5
             if args.keep:
                 keep = args.keep[0]
+            try:
+                policy = retention(args)
+            except Exception as err:
+                print('Error:', err)
+                return
+            if (policy is not None and policy.buckets['hourly']
+                    and args.resolution == 'day'):
+                print('Error: --hourly needs snapshots named with a time of'
+                      ' day, take them with -t second')
+                return
         if not args.recursive:
-            caller(snap, args.snap_path[0])
+            caller(snap, args.snap_path[0], resolution=args.resolution,
+                   backend=backend)
             if not keep is None:
-                caller(unsnap, args.snap_path[0], keep=keep)
+                caller(unsnap, args.snap_path[0], keep=keep, backend=backend,
+                       batch_size=args.batch, commit=args.commit,
+                       queue=args.queue, policy=policy)
         if args.recursive:
-            caller(snapdeep, args.snap_path[0])
+            caller(snapdeep, args.snap_path[0], index=args.index,
+                   resolution=args.resolution, jobs=args.jobs,
+                   per_filesystem=args.per_fs, consistent=args.consistent,
+                   backend=backend)
             if not keep is None:
-                caller(unsnap_deep, args.snap_path[0], keep=keep)
+                caller(unsnap_deep, args.snap_path[0], keep=keep,
+                       index=args.index, backend=backend,
+                       batch_size=args.batch, commit=args.commit,
+                       queue=args.queue, policy=policy)
 
     def run_list(args):
+        backend = get_backend(args.backend)
         if not args.recursive:
-            caller(show_snaps, args.snap_path[0])
+            caller(show_snaps, args.snap_path[0], sizes=args.sizes,
+                   backend=backend)
         else:
-            caller(show_snaps_deep, args.snap_path[0])
+            caller(show_snaps_deep, args.snap_path[0], index=args.index,
+                   sizes=args.sizes, backend=backend)
+
+    def print_progress(snapshot, size, seconds):
+        print('\'{}\' {}'.format(snapshot, _megabytes(size, seconds)),
+              file=sys.stderr)
 
     def run_send(args):
+        backend = get_backend(args.backend)
+        bwlimit = None
+        if args.bwlimit is not None:
+            bwlimit = args.bwlimit * MEGABYTE
+        progress = print_progress if args.progress else None
         if not args.recursive:
-            caller(sendreceive, args.send_path[0], args.receive_path[0])
+            caller(sendreceive, args.send_path[0], args.receive_path,
+                   backend=backend, dry_run=args.dry_run, clones=args.clones,
+                   pump=args.pump, bwlimit=bwlimit, progress=progress,
+                   resumable=args.resumable, via=args.via, scan=args.scan,
+                   checksum=args.checksum)
 
         if args.recursive:
-            caller(sendreceive_deep, args.send_path[0], args.receive_path[0])
+            caller(sendreceive_deep, args.send_path[0], args.receive_path,
+                   index=args.index, backend=backend, jobs=args.jobs,
+                   per_source=args.per_source,
+                   per_destination=args.per_dest, dry_run=args.dry_run,
+                   clones=args.clones, pump=args.pump, bwlimit=bwlimit,
+                   progress=progress, resumable=args.resumable,
+                   via=args.via, scan=args.scan, checksum=args.checksum)
 
     def run_delete(args):
+        backend = get_backend(args.backend)
         keep = 5
         if args.keep:
             keep = args.keep[0]
+        try:
+            policy = retention(args)
+        except Exception as err:
+            print('Error:', err)
+            return
+        if args.recursive:
+            caller(unsnap_deep, args.snap_path[0], keep=keep,
+                   index=args.index, backend=backend, batch_size=args.batch,
+                   commit=args.commit, queue=args.queue, policy=policy,
+                   dry_run=args.dry_run, free=args.free, by_size=args.by_size)
+        else:
+            caller(unsnap, args.snap_path[0], keep=keep, backend=backend,
+                   batch_size=args.batch, commit=args.commit,
+                   queue=args.queue, policy=policy, dry_run=args.dry_run,
+                   free=args.free, by_size=args.by_size)
+
+    def run_drain(args):
+        max_dirty = None
+        if args.max_dirty is not None:
+            max_dirty = args.max_dirty * 1024 * 1024
+        caller(drain, args.snap_path[0], backend=get_backend(args.backend),
+               rate=args.rate, batch_size=args.batch, commit=args.commit,
+               max_dirty=max_dirty, max_cleaner=args.max_cleaner,
+               limit=args.limit)
+
+    def run_status(args):
+        caller(queue_status, args.snap_path[0])
+
+    def run_export(args):
+        chunk_size = EXPORT_CHUNK_SIZE
+        if args.chunk_size is not None:
+            chunk_size = int(args.chunk_size * MEGABYTE)
+        caller(export_snaps, args.send_path[0], args.export_path[0],
+               backend=get_backend(args.backend), codec=args.codec,
+               level=args.level, chunk_size=chunk_size, clones=args.clones,
+               dry_run=args.dry_run)
+
+    def run_import(args):
+        caller(import_snaps, args.export_path[0], args.receive_path[0],
+               backend=get_backend(args.backend), dry_run=args.dry_run)
+
+    def run_verify(args):
         if args.recursive:
-            caller(unsnap_deep, args.snap_path[0], keep=keep)
+            caller(verify_deep, args.send_path[0], args.receive_path[0])
         else:
-            caller(unsnap, args.snap_path[0], keep=keep)
+            caller(verify, args.send_path[0], args.receive_path[0])
+
+    def run_daemon(args):
+        if args.status:
+            caller(daemon_status, args.schedule[0])
+            return
+        if args.run:
+            caller(daemon_run, args.schedule[0], args.run)
+            return
+        import signal
+        try:
+            daemon = Daemon(Schedule(args.schedule[0]),
+                            backend=get_backend(args.backend))
+        except Exception as err:
+            print('Error:', err)
+            return
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+        try:
+            caller(daemon.serve)
+        except KeyboardInterrupt:
+            pass
+
+    def add_retention(subparser, prefix=''):
+        def sentence(text):
+            return prefix + text if prefix else text[0].upper() + text[1:]
+
+        for name, period in zip(RETENTION_BUCKETS, ('hours', 'days',
+                                                    'ISO weeks', 'months',
+                                                    'years')):
+            subparser.add_argument('--' + name,
+                                   type=int,
+                                   metavar='N',
+                                   help=sentence('keep the newest snapshot of'
+                                                 ' each of the last N {} with'
+                                                 ' snapshots.'.format(period))
+                                   + (' Skips YYYY-MM-DD-#### snapshots,'
+                                      ' take them with -t second or'
+                                      ' microsecond.'
+                                      if name == 'hourly' else '')
+                                   )
+        subparser.add_argument('--max-age',
+                               type=parse_age,
+                               metavar='AGE',
+                               help=sentence('delete snapshots older than'
+                                             ' AGE, like 36h, 90d, 6w, 3m or'
+                                             ' 1y, even if a bucket keeps'
+                                             ' them, and without buckets'
+                                             ' keep all younger ones. The -k'
+                                             ' newest are always kept, 1'
+                                             ' unless given with a policy.')
+                               )
 
     def no_sub(args):
         parser.parse_args('--help')
@@ -634,6 +6168,14 @@ def main():
     parser.add_argument('--version', action='version',
                         version='%(prog)s 1.1.1'
                         )
+    parser.add_argument('-b', '--backend',
+                        choices=sorted(BACKENDS),
+                        default='progs',
+                        help='How BTRFS is driven: progs runs btrfs-progs'
+                        ' (the default), ioctl creates and deletes'
+                        ' snapshots with BTRFS ioctls in process, sim'
+                        ' simulates BTRFS on plain directories.'
+                        )
     subparsers = parser.add_subparsers(title='sub-commands')
 
     subparser_snap = subparsers.add_parser('snap',
@@ -668,6 +6210,70 @@ def main():
                                 help='A directory on a BTRFS file system with'
                                 ' a symlink pointing to a BTRFS subvolume'
                                 )
+    subparser_snap.add_argument('-i', '--index',
+                                action='store_true',
+                                help='With -r, use and update the snapshot'
+                                ' index file in PATH to skip'
+                                ' unchanged subdirectories.'
+                                )
+    subparser_snap.add_argument('-t', '--resolution',
+                                choices=RESOLUTIONS,
+                                default='day',
+                                help='Timestamp format of new snapshots:'
+                                ' YYYY-MM-DD-#### (day, the default),'
+                                ' YYYY-MM-DD-HHMMSS (second) or'
+                                ' YYYY-MM-DD-HHMMSS.ffffff (microsecond).'
+                                )
+    subparser_snap.add_argument('-j', '--jobs',
+                                type=int,
+                                metavar='N',
+                                help='With -r, take up to N snapshots in'
+                                ' parallel and report the time taken by'
+                                ' each.'
+                                )
+    subparser_snap.add_argument('--per-fs',
+                                type=int,
+                                default=1,
+                                metavar='N',
+                                help='With -j, take at most N snapshots at'
+                                ' once on each filesystem. (Default, N=1)'
+                                )
+    subparser_snap.add_argument('-c', '--consistent',
+                                action='store_true',
+                                help='With -r, take all snapshots in one'
+                                ' burst with the same timestamp and report'
+                                ' the skew between them.'
+                                )
+    subparser_snap.add_argument('--batch',
+                                type=int,
+                                default=DELETE_BATCH_SIZE,
+                                metavar='N',
+                                help='With -d, delete up to N snapshots per'
+                                ' btrfs subvolume delete. (Default, N={})'
+                                .format(DELETE_BATCH_SIZE)
+                                )
+    snap_commit = subparser_snap.add_mutually_exclusive_group()
+    snap_commit.add_argument('--commit-after',
+                             dest='commit',
+                             action='store_const',
+                             const='after',
+                             help='With -d, wait for the deletions to be'
+                             ' committed after each batch.'
+                             )
+    snap_commit.add_argument('--commit-each',
+                             dest='commit',
+                             action='store_const',
+                             const='each',
+                             help='With -d, wait for the deletion of each'
+                             ' snapshot to be committed.'
+                             )
+    subparser_snap.add_argument('--queue',
+                                action='store_true',
+                                help='With -d, queue the snapshots to be'
+                                ' deleted later by drain instead of'
+                                ' deleting them.'
+                                )
+    add_retention(subparser_snap, prefix='With -d, ')
     subparser_snap.set_defaults(func=run_snap)
 
     subparser_list = subparsers.add_parser('list',
@@ -686,6 +6292,21 @@ def main():
                                 help='Instead, show summary statistics for all'
                                 ' subdirectories in PATH.'
                                 )
+    subparser_list.add_argument('-i', '--index',
+                                action='store_true',
+                                help='With -r, use and update the snapshot'
+                                ' index file in PATH to skip'
+                                ' unchanged subdirectories.'
+                                )
+    subparser_list.add_argument('-s', '--sizes',
+                                action='store_true',
+                                help='Show the referenced and exclusive size'
+                                ' of every snapshot and the exclusive'
+                                ' totals, from one qgroup query or btrfs'
+                                ' filesystem du per filesystem. The sizes'
+                                ' are cached in PATH until snapshots are'
+                                ' added or deleted.'
+                                )
     subparser_list.set_defaults(func=run_list)
 
     subparser_delete = subparsers.add_parser('delete',
@@ -711,12 +6332,155 @@ def main():
                                   ' that contains snapshots created by'
                                   ' btrsnap.'
                                   )
+    subparser_delete.add_argument('-i', '--index',
+                                  action='store_true',
+                                  help='With -r, use and update the snapshot'
+                                  ' index file in PATH to skip'
+                                  ' unchanged subdirectories.'
+                                  )
+    subparser_delete.add_argument('--batch',
+                                  type=int,
+                                  default=DELETE_BATCH_SIZE,
+                                  metavar='N',
+                                  help='Delete up to N snapshots per btrfs'
+                                  ' subvolume delete. With -r, batches span'
+                                  ' subdirectories on the same filesystem.'
+                                  ' (Default, N={})'.format(DELETE_BATCH_SIZE)
+                                  )
+    delete_commit = subparser_delete.add_mutually_exclusive_group()
+    delete_commit.add_argument('-c', '--commit-after',
+                               dest='commit',
+                               action='store_const',
+                               const='after',
+                               help='Wait for the deletions to be committed'
+                               ' after each batch.'
+                               )
+    delete_commit.add_argument('-C', '--commit-each',
+                               dest='commit',
+                               action='store_const',
+                               const='each',
+                               help='Wait for the deletion of each snapshot'
+                               ' to be committed.'
+                               )
+    subparser_delete.add_argument('-q', '--queue',
+                                  action='store_true',
+                                  help='Queue the snapshots in PATH to be'
+                                  ' deleted later by drain instead of'
+                                  ' deleting them.'
+                                  )
+    subparser_delete.add_argument('-n', '--dry-run',
+                                  action='store_true',
+                                  help='Show which snapshots would be kept,'
+                                  ' and why, and delete nothing. With'
+                                  ' --free, show the space deleting each'
+                                  ' would free, from qgroups when quotas'
+                                  ' are enabled.'
+                                  )
+    add_retention(subparser_delete)
+    subparser_delete.add_argument('--free',
+                                  type=FreeTarget,
+                                  metavar='TARGET',
+                                  help='Instead, delete the oldest snapshots'
+                                  ' beyond KEEP until TARGET is free, like'
+                                  ' 20G or 10%%. With -r, the oldest'
+                                  ' snapshots of all subdirectories on a'
+                                  ' filesystem go first. Every batch is'
+                                  ' committed and btrfs-cleaner is given'
+                                  ' time to free the space before more are'
+                                  ' deleted.'
+                                  )
+    subparser_delete.add_argument('--by-size',
+                                  action='store_true',
+                                  help='With --free, delete the snapshots'
+                                  ' holding the most exclusive data first,'
+                                  ' from qgroups, to delete as few as'
+                                  ' possible. Needs quotas enabled.'
+                                  )
     subparser_delete.set_defaults(func=run_delete)
 
+    subparser_drain = subparsers.add_parser('drain',
+                                            description='Delete the'
+                                            ' snapshots queued in PATH by'
+                                            ' delete --queue, slowly enough'
+                                            ' to keep btrfs-cleaner from'
+                                            ' saturating the disks.',
+                                            help='Delete queued snapshots'
+                                            )
+    subparser_drain.add_argument('snap_path',
+                                 nargs=1,
+                                 metavar='PATH',
+                                 help='The PATH given to delete --queue.'
+                                 )
+    subparser_drain.add_argument('--rate',
+                                 type=float,
+                                 metavar='N',
+                                 help='Delete at most N snapshots per'
+                                 ' minute.'
+                                 )
+    subparser_drain.add_argument('--max-dirty',
+                                 type=int,
+                                 metavar='MiB',
+                                 help='Wait while more than MiB of dirty'
+                                 ' pages are waiting to be written.'
+                                 )
+    subparser_drain.add_argument('--max-cleaner',
+                                 type=int,
+                                 metavar='N',
+                                 help='Wait while more than N deleted'
+                                 ' subvolumes are waiting for'
+                                 ' btrfs-cleaner.'
+                                 )
+    subparser_drain.add_argument('--limit',
+                                 type=int,
+                                 metavar='N',
+                                 help='Stop after deleting N snapshots.'
+                                 )
+    subparser_drain.add_argument('--batch',
+                                 type=int,
+                                 default=DELETE_BATCH_SIZE,
+                                 metavar='N',
+                                 help='Delete up to N snapshots per btrfs'
+                                 ' subvolume delete. (Default, N={})'
+                                 .format(DELETE_BATCH_SIZE)
+                                 )
+    drain_commit = subparser_drain.add_mutually_exclusive_group()
+    drain_commit.add_argument('-c', '--commit-after',
+                              dest='commit',
+                              action='store_const',
+                              const='after',
+                              help='Wait for the deletions to be committed'
+                              ' after each batch.'
+                              )
+    drain_commit.add_argument('-C', '--commit-each',
+                              dest='commit',
+                              action='store_const',
+                              const='each',
+                              help='Wait for the deletion of each snapshot'
+                              ' to be committed.'
+                              )
+    subparser_drain.set_defaults(func=run_drain)
+
+    subparser_status = subparsers.add_parser('status',
+                                             description='Show the number'
+                                             ' of snapshots queued for'
+                                             ' deletion in PATH and the'
+                                             ' throughput of recent drains.',
+                                             help='Show the deletion queue'
+                                             )
+    subparser_status.add_argument('snap_path',
+                                  nargs=1,
+                                  metavar='PATH',
+                                  help='The PATH given to delete --queue.'
+                                  )
+    subparser_status.set_defaults(func=run_status)
+
     subparser_send = subparsers.add_parser('send',
                                            description='Send all snapshots'
-                                           ' from SendPATH to ReceivePATH if'
-                                           ' not present.',
+                                           ' from SendPATH to each'
+                                           ' ReceivePATH if not present. One'
+                                           ' send stream feeds every'
+                                           ' ReceivePATH that needs the same'
+                                           ' increment.',
                                            help='Use BTRFS send/receive to'
                                            ' smartly send snapshots from one'
                                            ' BTRFS filesystem to another.'
@@ -734,12 +6498,249 @@ def main():
                                 help='A directory on a BTRFS filesystem that'
                                 ' contains snapshots created by btrsnap.')
     subparser_send.add_argument('receive_path',
-                                nargs=1,
+                                nargs='+',
                                 metavar='ReceivePATH',
                                 help='A directory on a BTRFS filesystem that'
-                                ' will receive snapshots.')
+                                ' will receive snapshots. May be given more'
+                                ' than once.')
+    subparser_send.add_argument('-i', '--index',
+                                action='store_true',
+                                help='With -r, use and update the snapshot'
+                                ' index files in SendPATH and ReceivePATH to'
+                                ' skip unchanged subdirectories.'
+                                )
+    subparser_send.add_argument('-j', '--jobs',
+                                type=int,
+                                metavar='N',
+                                help='With -r, send up to N subdirectories'
+                                ' in parallel and report the time taken by'
+                                ' each.'
+                                )
+    subparser_send.add_argument('--per-source',
+                                type=int,
+                                default=1,
+                                metavar='N',
+                                help='With -j, run at most N sends at once'
+                                ' from each source filesystem.'
+                                ' (Default, N=1)'
+                                )
+    subparser_send.add_argument('--per-dest',
+                                type=int,
+                                default=1,
+                                metavar='N',
+                                help='With -j, run at most N receives at'
+                                ' once into each destination filesystem.'
+                                ' (Default, N=1)'
+                                )
+    subparser_send.add_argument('-n', '--dry-run',
+                                action='store_true',
+                                help='Show which parent and clone sources'
+                                ' each missing snapshot would be sent with'
+                                ' and send nothing.'
+                                )
+    subparser_send.add_argument('--clones',
+                                type=int,
+                                default=CLONE_SOURCES,
+                                metavar='N',
+                                help='Pass up to N more snapshots present on'
+                                ' both sides as clone sources (-c) with each'
+                                ' snapshot. (Default, N={})'
+                                .format(CLONE_SOURCES)
+                                )
+    subparser_send.add_argument('--pump',
+                                action='store_true',
+                                help='Move the streams through btrsnap and'
+                                ' report the MB sent and MB/s.'
+                                )
+    subparser_send.add_argument('--bwlimit',
+                                type=float,
+                                metavar='MB',
+                                help='Send at most MB megabytes per second,'
+                                ' in total over all parallel sends.'
+                                ' Implies --pump.'
+                                )
+    subparser_send.add_argument('--progress',
+                                action='store_true',
+                                help='Print the MB sent and MB/s of each'
+                                ' snapshot to stderr every second.'
+                                ' Implies --pump.'
+                                )
+    subparser_send.add_argument('--resumable',
+                                action='store_true',
+                                help='Spool the streams into checksummed'
+                                ' chunks in {} of SendPATH and ReceivePATH,'
+                                ' so a failed send resumes with the missing'
+                                ' chunks. Deletes snapshots left behind by'
+                                ' interrupted receives first.'
+                                .format(SPOOL_DIR)
+                                )
+    subparser_send.add_argument('--via',
+                                metavar='COMMAND',
+                                help='ReceivePATH is on another host. Run'
+                                ' every command there through COMMAND, which'
+                                ' runs the shell command line given as its'
+                                ' last argument, e.g. "ssh user@host". One'
+                                ' ssh connection is shared by the whole run.'
+                                )
+    subparser_send.add_argument('--scan',
+                                action='store_true',
+                                help='List the ReceivePATHs with one btrfs'
+                                ' subvolume list per filesystem and count'
+                                ' only snapshots that were fully received.'
+                                ' Snapshots left by interrupted receives are'
+                                ' reported and skipped, or deleted and sent'
+                                ' again with --resumable. Snapshots are also'
+                                ' matched by UUID, so renamed ones count and'
+                                ' any received elsewhere on the filesystem'
+                                ' can be a parent.'
+                                )
+    subparser_send.add_argument('--checksum',
+                                action='store_const',
+                                const=CHECKSUM_ALGORITHM,
+                                help='Hash every stream on its way to the'
+                                ' receiver and record the {} digest and'
+                                ' size in {} of SendPATH and ReceivePATH,'
+                                ' for verify. Implies --pump.'
+                                .format(CHECKSUM_ALGORITHM, CHECKSUM_FILE)
+                                )
     subparser_send.set_defaults(func=run_send)
 
+    subparser_export = subparsers.add_parser('export',
+                                             description='Write the'
+                                             ' snapshots in SendPATH that'
+                                             ' ExportPATH is missing as'
+                                             ' compressed send streams split'
+                                             ' into chunk files, with a'
+                                             ' manifest for import.',
+                                             help='Export snapshots to files'
+                                             )
+    subparser_export.add_argument('send_path',
+                                  nargs=1,
+                                  metavar='SendPATH',
+                                  help='A directory on a BTRFS filesystem'
+                                  ' that contains snapshots created by'
+                                  ' btrsnap.')
+    subparser_export.add_argument('export_path',
+                                  nargs=1,
+                                  metavar='ExportPATH',
+                                  help='A directory to write the chunk files'
+                                  ' and manifest to.')
+    subparser_export.add_argument('--codec',
+                                  choices=sorted(CODECS),
+                                  default='zlib',
+                                  help='Compression of the chunk files.'
+                                  ' (Default, zlib)'
+                                  )
+    subparser_export.add_argument('--level',
+                                  type=int,
+                                  metavar='N',
+                                  help='Compression level of the codec.'
+                                  )
+    subparser_export.add_argument('--chunk-size',
+                                  type=float,
+                                  metavar='MB',
+                                  help='Split the streams into chunk files of'
+                                  ' at most MB megabytes. (Default, MB={})'
+                                  .format(EXPORT_CHUNK_SIZE // MEGABYTE)
+                                  )
+    subparser_export.add_argument('--clones',
+                                  type=int,
+                                  default=CLONE_SOURCES,
+                                  metavar='N',
+                                  help='Pass up to N more exported snapshots'
+                                  ' as clone sources (-c) with each'
+                                  ' snapshot. (Default, N={})'
+                                  .format(CLONE_SOURCES)
+                                  )
+    subparser_export.add_argument('-n', '--dry-run',
+                                  action='store_true',
+                                  help='Show what would be exported and'
+                                  ' export nothing.'
+                                  )
+    subparser_export.set_defaults(func=run_export)
+
+    subparser_import = subparsers.add_parser('import',
+                                             description='Receive the'
+                                             ' snapshots exported to'
+                                             ' ExportPATH that ReceivePATH is'
+                                             ' missing, in the order they'
+                                             ' were exported.',
+                                             help='Import exported snapshots'
+                                             )
+    subparser_import.add_argument('export_path',
+                                  nargs=1,
+                                  metavar='ExportPATH',
+                                  help='A directory written by export.')
+    subparser_import.add_argument('receive_path',
+                                  nargs=1,
+                                  metavar='ReceivePATH',
+                                  help='A directory on a BTRFS filesystem'
+                                  ' that will receive snapshots.')
+    subparser_import.add_argument('-n', '--dry-run',
+                                  action='store_true',
+                                  help='Show what would be imported and'
+                                  ' import nothing.'
+                                  )
+    subparser_import.set_defaults(func=run_import)
+
+    subparser_verify = subparsers.add_parser('verify',
+                                             description='Compare the'
+                                             ' stream checksums send'
+                                             ' --checksum recorded in'
+                                             ' SendPATH and ReceivePATH,'
+                                             ' without reading the'
+                                             ' snapshots.',
+                                             help='Verify received snapshots'
+                                             )
+    subparser_verify.add_argument('send_path',
+                                  nargs=1,
+                                  metavar='SendPATH',
+                                  help='A directory on a BTRFS filesystem'
+                                  ' that contains snapshots created by'
+                                  ' btrsnap.')
+    subparser_verify.add_argument('receive_path',
+                                  nargs=1,
+                                  metavar='ReceivePATH',
+                                  help='The ReceivePATH the snapshots were'
+                                  ' sent to.')
+    subparser_verify.add_argument('-r', '--recursive',
+                                  action='store_true',
+                                  help='Instead, verify each subdirectory of'
+                                  ' SendPATH against the subdirectory of the'
+                                  ' same name in ReceivePATH.'
+                                  )
+    subparser_verify.set_defaults(func=run_verify)
+
+    subparser_daemon = subparsers.add_parser('daemon',
+                                             description='Run the snapshots,'
+                                             ' deletions and sends of'
+                                             ' SCHEDULE on time, keeping'
+                                             ' the snapshot indexes in'
+                                             ' memory between runs.',
+                                             help='Run a schedule'
+                                             )
+    subparser_daemon.add_argument('schedule',
+                                  nargs=1,
+                                  metavar='SCHEDULE',
+                                  help='A JSON file with the jobs to run,'
+                                  ' see the documentation of'
+                                  ' btrsnap.Schedule.')
+    daemon_control = subparser_daemon.add_mutually_exclusive_group()
+    daemon_control.add_argument('-s', '--status',
+                                action='store_true',
+                                help='Instead, show the tasks of'
+                                ' the daemon running SCHEDULE,'
+                                ' through its control socket.'
+                                )
+    daemon_control.add_argument('--run',
+                                metavar='TASK',
+                                help='Instead, make TASK of the'
+                                ' daemon running SCHEDULE due'
+                                ' now, like JOB/snap or'
+                                ' JOB/send.'
+                                )
+    subparser_daemon.set_defaults(func=run_daemon)
+
     args = parser.parse_args()
     try:
         args.func(args)
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+'''
+Benchmarks for btrsnap.
+
+The benchmarks run on plain directories, through SimulatedBackend where
+snapshots are needed, and do not need a BTRFS filesystem or root
+permissions. Set the environment variable 'BTRSNAP_BENCH_DIR' to choose where
+the temporary directories are created (default: the system temp dir).
+
+    example:
+    python btrsnap_bench.py
+    python btrsnap_bench.py 1000 10000 100000
+'''
+import os
+import re
+import sys
+import time
+import datetime
+import shutil
+import tempfile
+
+import btrsnap
+
+
+SIZES = (1000, 10000, 100000)
+REPEAT = 5
+
+
+def legacy_snapshots(path):
+    '''
+    The original listdir/isdir implementation of SnapshotsMixin.snapshots,
+    kept here as a baseline.
+    '''
+    pattern = re.compile(r'^\d{4}-\d{2}-\d{2}-\d{4}$')
+    contents = os.listdir(path=path)
+    contents = [d for d in contents
+                if os.path.isdir(os.path.join(path, d))
+                and re.search(pattern, d)]
+    contents.sort(reverse=True)
+    return contents
+
+
+def make_snappath(parent, size):
+    '''
+    Create a directory holding SIZE snapshot-like directories, one
+    symlink and a few unrelated files.
+    '''
+    path = tempfile.mkdtemp(prefix='btrsnap_bench_', dir=parent)
+    os.symlink(path, os.path.join(path, 'target'))
+    for number in range(size):
+        day, counter = divmod(number, 9999)
+        name = '{}-{:04d}'.format(
+            datetime.date.fromordinal(730000 + day).isoformat(),
+            counter + 1)
+        os.mkdir(os.path.join(path, name))
+    for number in range(10):
+        open(os.path.join(path, 'file{}'.format(number)), 'w').close()
+    return path
+
+
+def best_of(func, *args):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_snapshots(parent, sizes):
+    print('{:>8} {:>12} {:>12} {:>8}'.format(
+        'entries', 'legacy (ms)', 'scandir (ms)', 'speedup'))
+    for size in sizes:
+        path = make_snappath(parent, size)
+        try:
+            receive_path = btrsnap.ReceivePath(path)
+            assert legacy_snapshots(path) == receive_path.snapshots()
+            legacy = best_of(legacy_snapshots, path)
+            current = best_of(receive_path.snapshots)
+            print('{:>8} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+                size, legacy * 1000, current * 1000, legacy / current))
+        finally:
+            shutil.rmtree(path)
+
+
+def bench_simulated(parent, sizes):
+    '''
+    Time btrsnap commands against SIZE existing simulated snapshots.
+    '''
+    print('{:>8} {:>12} {:>12} {:>12}'.format(
+        'entries', 'snap (ms)', 'list (ms)', 'delete (s)'))
+    backend = btrsnap.SimulatedBackend()
+    for size in sizes:
+        path = tempfile.mkdtemp(prefix='btrsnap_bench_', dir=parent)
+        try:
+            subvolume = os.path.join(path, 'subvolume')
+            snap_path = os.path.join(path, 'snapshots')
+            backend.create(subvolume)
+            os.mkdir(snap_path)
+            os.symlink(subvolume, os.path.join(snap_path, 'target'))
+            for number in range(size):
+                day, counter = divmod(number, 9999)
+                name = '{}-{:04d}'.format(
+                    datetime.date.fromordinal(730000 + day).isoformat(),
+                    counter + 1)
+                backend.snap(subvolume, os.path.join(snap_path, name))
+            start = time.perf_counter()
+            btrsnap.snap(snap_path, backend=backend)
+            snap = time.perf_counter() - start
+            start = time.perf_counter()
+            btrsnap.show_snaps(snap_path)
+            listing = time.perf_counter() - start
+            start = time.perf_counter()
+            btrsnap.unsnap(snap_path, keep=size // 2, backend=backend)
+            delete = time.perf_counter() - start
+            print('{:>8} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+                size, snap * 1000, listing * 1000, delete))
+        finally:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    parent = os.environ.get('BTRSNAP_BENCH_DIR')
+    if parent:
+        parent = os.path.expanduser(parent)
+    bench_snapshots(parent, sizes)
+    print()
+    bench_simulated(parent, sizes)
@@ -8,6 +8,13 @@ where you want the tests to run.
     example:
     BTRSNAP_TEST_DIR='~/' python tests.py
 
+Without a BTRFS filesystem, put the simulated btrfs (btrsnap-btrfs-sim) in
+PATH under the name 'btrfs' and point 'BTRSNAP_TEST_DIR' anywhere.
+
+    example:
+    ln -s $(which btrsnap-btrfs-sim) ~/bin/btrfs
+    PATH=~/bin:$PATH BTRSNAP_TEST_DIR=/tmp python btrsnap_test.py
+
 BTRFS snapshots are created using the readonly=False flag. This is to allow
 the test modules to delete readonly snapshots
 
@@ -16,8 +23,16 @@ the test modules to delete readonly snapshots
 import unittest
 import os
 import shutil
+import errno
+import sys
 import datetime
 import subprocess
+import threading
+import time
+import hashlib
+import io
+import json
+import contextlib
 
 import btrsnap
 
@@ -41,6 +56,21 @@ def get_test_dir():
     return test_dir
 
 
+def write_btrfs_stand_in(bin_dir):
+    '''
+    Write an executable 'btrfs' to bin_dir running btrsnap.simulate(), so
+    commands run through PATH reach the simulated BTRFS.
+    '''
+    path = os.path.join(bin_dir, 'btrfs')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" -c "import sys; sys.path.insert(0,'
+                ' \'{}\'); import btrsnap; btrsnap.simulate()" "$@"\n'
+                .format(sys.executable, os.path.dirname(
+                    os.path.abspath(btrsnap.__file__))))
+    os.chmod(path, 0o755)
+    return path
+
+
 class Test_Path_Class(unittest.TestCase):
 
     test_dir = get_test_dir()
@@ -110,6 +140,15 @@ class Test_ReceivePath_Class(unittest.TestCase):
         snap = btrsnap.ReceivePath(snap_dir)
         self.assertEqual(timestamps, snap.snapshots())
 
+    def test_ReceivePath_list_follows_symlinks(self):
+        snap_dir = self.snap_dir
+        os.symlink(os.path.join(snap_dir, self.timestamps[0]),
+                   os.path.join(snap_dir, '2013-01-01-0001'))
+        timestamps = sorted(self.timestamps + ['2013-01-01-0001'],
+                            reverse=True)
+        snap = btrsnap.ReceivePath(snap_dir)
+        self.assertEqual(timestamps, snap.snapshots())
+
 
 class Test_SnapPath_Class(unittest.TestCase):
 
@@ -161,6 +200,14 @@ class Test_SnapPath_Class(unittest.TestCase):
         snap = btrsnap.SnapPath(snap_dir)
         self.assertEqual(timestamps, snap.snapshots())
 
+    def test_SnapPath_snapshotsMixin_ignore_invalid_dates(self):
+        snap_dir = self.snap_dir
+        timestamps = sorted(self.timestamps, reverse=True)
+        os.mkdir(os.path.join(snap_dir, '2013-02-30-0001'))
+
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertEqual(timestamps, snap.snapshots())
+
     def test_SnapPath_snapshotsMixin_ignore_timestamp_like_folders(self):
         snap_dir = self.snap_dir
         timestamps = sorted(self.timestamps, reverse=True)
@@ -213,6 +260,42 @@ class Test_SnapPath_Class(unittest.TestCase):
         os.mkdir(os.path.join(snap_dir, second))
         self.assertEqual(third, snap.timestamp())
 
+    def test_SnapPath_timestamp_second(self):
+        snap_dir = self.snap_dir
+        snap = btrsnap.SnapPath(snap_dir)
+        timestamp = snap.timestamp(resolution='second')
+        self.assertEqual('second', timestamp.resolution)
+        self.assertEqual(datetime.date.today(), timestamp.date)
+
+    def test_SnapPath_timestamp_same_second(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        newest = today.strftime('%Y-%m-%d-235959.999999')
+        os.mkdir(os.path.join(snap_dir, newest))
+
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertEqual(today + datetime.timedelta(days=1),
+                         snap.timestamp(resolution='microsecond').date)
+        self.assertGreater(snap.timestamp(resolution='second'),
+                           btrsnap.Snapshot(newest))
+
+    def test_SnapPath_timestamp_day_after_second(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        os.mkdir(os.path.join(snap_dir, today.strftime('%Y-%m-%d-000000')))
+
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertRaises(Exception, snap.timestamp)
+
+    def test_SnapPath_timestamp_future_snapshot(self):
+        snap_dir = self.snap_dir
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        os.mkdir(os.path.join(snap_dir, tomorrow.isoformat() + '-0001'))
+
+        snap = btrsnap.SnapPath(snap_dir)
+        self.assertRaises(Exception, snap.timestamp)
+        self.assertRaises(Exception, snap.timestamp, resolution='second')
+
     def test_SnapPath_timestamp_9999_or_less(self):
         snap_dir = self.snap_dir
         today = datetime.date.today()
@@ -306,6 +389,2557 @@ class Test_ReceiveDeep_Class(unittest.TestCase):
                                   )
 
 
+class Test_Snapshot_Class(unittest.TestCase):
+
+    def test_Snapshot_parse(self):
+        snapshot = btrsnap.Snapshot('2012-02-01-0002')
+        self.assertEqual(datetime.date(2012, 2, 1), snapshot.date)
+        self.assertEqual(2, snapshot.counter)
+        self.assertEqual('2012-02-01-0002', str(snapshot))
+        self.assertEqual(os.path.join('/a', '2012-02-01-0002'),
+                         os.path.join('/a', snapshot))
+
+    def test_Snapshot_invalid(self):
+        self.assertRaises(ValueError, btrsnap.Snapshot, '2012-02-01-002')
+        self.assertRaises(ValueError, btrsnap.Snapshot, '2012-13-01-0001')
+
+    def test_Snapshot_ordering(self):
+        names = ['2012-01-01-0002',
+                 '2011-12-31-9999',
+                 '2012-01-01-0010',
+                 '2012-01-01-0001']
+        snapshots = sorted(btrsnap.Snapshot(name) for name in names)
+        self.assertEqual(sorted(names), [s.name for s in snapshots])
+        self.assertLess(btrsnap.Snapshot('2011-12-31-9999'),
+                        btrsnap.Snapshot('2012-01-01-0001'))
+
+    def test_Snapshot_equal_to_name(self):
+        snapshot = btrsnap.Snapshot('2012-01-01-0001')
+        self.assertEqual(snapshot, '2012-01-01-0001')
+        self.assertEqual(snapshot, btrsnap.Snapshot('2012-01-01-0001'))
+        self.assertIn('2012-01-01-0001', {snapshot})
+        self.assertEqual(snapshot, btrsnap.Snapshot.from_date(
+            datetime.date(2012, 1, 1), 1))
+
+    def test_Snapshot_time_of_day(self):
+        snapshot = btrsnap.Snapshot('2012-01-01-130405')
+        self.assertEqual('second', snapshot.resolution)
+        self.assertIsNone(snapshot.counter)
+        self.assertEqual(datetime.datetime(2012, 1, 1, 13, 4, 5),
+                         snapshot.datetime)
+        precise = btrsnap.Snapshot('2012-01-01-130405.000007')
+        self.assertEqual('microsecond', precise.resolution)
+        self.assertEqual(datetime.datetime(2012, 1, 1, 13, 4, 5, 7),
+                         precise.datetime)
+        self.assertEqual(precise, btrsnap.Snapshot.from_datetime(
+            precise.datetime, 'microsecond'))
+        self.assertRaises(ValueError, btrsnap.Snapshot, '2012-01-01-250000')
+
+    def test_Snapshot_mixed_ordering(self):
+        names = ['2012-01-02-0001',
+                 '2012-01-01-130405.000001',
+                 '2012-01-01-130405',
+                 '2012-01-01-9999',
+                 '2012-01-01-000000',
+                 '2012-01-01-130405.000000']
+        expected = ['2012-01-01-9999',
+                    '2012-01-01-000000',
+                    '2012-01-01-130405',
+                    '2012-01-01-130405.000000',
+                    '2012-01-01-130405.000001',
+                    '2012-01-02-0001']
+        snapshots = sorted(btrsnap.Snapshot(name) for name in names)
+        self.assertEqual(expected, [s.name for s in snapshots])
+        self.assertEqual(len(names), len(set(snapshots)))
+
+
+class Test_SnapshotIndex_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    link_dir = os.path.join(test_dir, 'link_dir')
+    timestamps = ['2012-01-01-0001',
+                  '2012-01-01-0002',
+                  '2012-02-01-0001',
+                  '2012-02-01-0002']
+
+    def setUp(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+        timestamps = self.timestamps
+
+        os.mkdir(test_dir)
+        os.mkdir(snap_dir)
+        os.mkdir(link_dir)
+        os.symlink(link_dir, os.path.join(snap_dir, 'target'))
+        for folder in timestamps:
+            os.mkdir(os.path.join(snap_dir, folder))
+        self.age(snap_dir)
+        self.age(test_dir)
+
+    def tearDown(self):
+        test_dir = self.test_dir
+        shutil.rmtree(test_dir)
+
+    def age(self, path):
+        # entries modified just before they are scanned are never trusted
+        os.utime(path, (0, 0))
+
+    def test_SnapshotIndex_snapshots(self):
+        snap_dir = self.snap_dir
+        timestamps = sorted(self.timestamps, reverse=True)
+        index = btrsnap.SnapshotIndex()
+        snap = btrsnap.SnapPath(snap_dir, index=index)
+        self.assertEqual(timestamps, snap.snapshots())
+        self.assertEqual(self.link_dir, snap.target)
+
+    def test_SnapshotIndex_warm_index_skips_scan(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        timestamps = sorted(self.timestamps, reverse=True)
+        index = btrsnap.SnapshotIndex()
+        btrsnap.SnapDeep(test_dir, index=index).snap_paths()
+        index.save()
+        self.age(test_dir)
+
+        def no_scan(*args):
+            raise AssertionError('unchanged directory was scanned')
+        index = btrsnap.SnapshotIndex()
+        index._scan = no_scan
+        snap_paths = btrsnap.SnapDeep(test_dir, index=index).snap_paths()
+        self.assertEqual([snap_dir], [p.path for p in snap_paths])
+        self.assertEqual(timestamps, snap_paths[0].snapshots())
+
+    def test_SnapshotIndex_rescan_on_mtime_change(self):
+        snap_dir = self.snap_dir
+        index = btrsnap.SnapshotIndex()
+        btrsnap.ReceivePath(snap_dir, index=index).snapshots()
+        index.save()
+
+        os.mkdir(os.path.join(snap_dir, '2013-01-01-0001'))
+        index = btrsnap.SnapshotIndex()
+        snapshots = btrsnap.ReceivePath(snap_dir, index=index).snapshots()
+        self.assertEqual('2013-01-01-0001', snapshots[0])
+
+    def test_SnapshotIndex_caches_invalid_snappath(self):
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+        os.symlink(link_dir, os.path.join(snap_dir, 'target2'))
+        self.age(snap_dir)
+        index = btrsnap.SnapshotIndex()
+        self.assertRaises(btrsnap.TargetError, btrsnap.SnapPath, snap_dir,
+                          index=index)
+        index.save()
+        index = btrsnap.SnapshotIndex()
+        self.assertRaises(btrsnap.TargetError, btrsnap.SnapPath, snap_dir,
+                          index=index)
+
+    def test_SnapshotIndex_save_keeps_parent_mtime(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        index = btrsnap.SnapshotIndex()
+        btrsnap.ReceivePath(snap_dir, index=index).snapshots()
+        index.save()
+        self.age(test_dir)
+        index = btrsnap.SnapshotIndex()
+        os.utime(snap_dir)
+        btrsnap.ReceivePath(snap_dir, index=index).snapshots()
+        index.save()
+        self.assertEqual(0, os.stat(test_dir).st_mtime)
+
+
+class Test_run_limited(unittest.TestCase):
+
+    def test_run_limited_respects_limits(self):
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        def task(key):
+            with lock:
+                running[key] += 1
+                peak[key] = max(peak[key], running[key])
+            time.sleep(0.01)
+            with lock:
+                running[key] -= 1
+            return key
+
+        keys = ['a'] * 6 + ['b'] * 6
+        tasks = [(lambda key=key: task(key), [(key, 2 if key == 'a' else 1)])
+                 for key in keys]
+        results = btrsnap._run_limited(tasks, 4)
+        self.assertEqual(keys, [result for result, error, seconds
+                                in results])
+        self.assertEqual({'a': 2, 'b': 1}, peak)
+
+    def test_run_limited_errors(self):
+        def fail():
+            raise btrsnap.BtrfsError('boom')
+        results = btrsnap._run_limited([(fail, []), (lambda: 1, [])], 2)
+        self.assertIsInstance(results[0][1], btrsnap.BtrfsError)
+        self.assertEqual((1, None), results[1][:2])
+
+    def test_filesystem_groups_mounts(self):
+        mounts = [{'device': '0:42', 'mountpoint': '/srv/data'},
+                  {'device': '0:1', 'mountpoint': '/'}]
+        self.assertEqual('0:42', btrsnap._filesystem('/srv/data/a', mounts))
+        self.assertEqual('0:1', btrsnap._filesystem('/srv/database', mounts))
+
+
+class FakeIoctl:
+    '''
+    Stands in for fcntl.ioctl. Records every call and creates or removes
+    plain directories in place of subvolumes.
+    '''
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.error = error
+
+    def __call__(self, fd, request, args):
+        if self.error:
+            raise OSError(self.error, os.strerror(self.error))
+        if request == btrsnap.BTRFS_IOC_SNAP_CREATE_V2:
+            source, transid, flags, unused, name = \
+                btrsnap.BTRFS_VOL_ARGS_V2.unpack(args)
+            name = name.rstrip(b'\0').decode()
+            self.calls.append(('create', os.fstat(source).st_ino, flags,
+                               name))
+            os.mkdir(name, dir_fd=fd)
+        elif request == btrsnap.BTRFS_IOC_SYNC:
+            self.calls.append(('sync',))
+            return 0
+        elif request == btrsnap.BTRFS_IOC_SNAP_DESTROY:
+            source, name = btrsnap.BTRFS_VOL_ARGS.unpack(args)
+            name = name.rstrip(b'\0').decode()
+            self.calls.append(('destroy', name))
+            os.rmdir(name, dir_fd=fd)
+        return 0
+
+
+class Test_IoctlBackend_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    link_dir = os.path.join(test_dir, 'link_dir')
+
+    def setUp(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+
+        os.mkdir(test_dir)
+        os.mkdir(snap_dir)
+        os.mkdir(link_dir)
+        os.symlink(link_dir, os.path.join(snap_dir, 'target'))
+
+    def tearDown(self):
+        test_dir = self.test_dir
+        shutil.rmtree(test_dir)
+
+    def test_IoctlBackend_request_codes(self):
+        self.assertEqual(0x50009417, btrsnap.BTRFS_IOC_SNAP_CREATE_V2)
+        self.assertEqual(0x5000940f, btrsnap.BTRFS_IOC_SNAP_DESTROY)
+
+    def test_IoctlBackend_snap(self):
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+        ioctl = FakeIoctl()
+        backend = btrsnap.IoctlBackend(ioctl=ioctl)
+        backend.snap(link_dir, os.path.join(snap_dir, 'test'))
+        backend.snap(link_dir, os.path.join(snap_dir, 'test2'),
+                     readonly=False)
+
+        inode = os.stat(link_dir).st_ino
+        self.assertEqual([('create', inode, btrsnap.BTRFS_SUBVOL_RDONLY,
+                           'test'),
+                          ('create', inode, 0, 'test2')], ioctl.calls)
+        self.assertTrue(os.path.isdir(os.path.join(snap_dir, 'test')))
+
+    def test_IoctlBackend_delete(self):
+        snap_dir = self.snap_dir
+        os.mkdir(os.path.join(snap_dir, 'test'))
+        ioctl = FakeIoctl()
+        backend = btrsnap.IoctlBackend(ioctl=ioctl)
+        backend.delete(os.path.join(snap_dir, 'test'))
+
+        self.assertEqual([('destroy', 'test')], ioctl.calls)
+        self.assertFalse(os.path.isdir(os.path.join(snap_dir, 'test')))
+
+    def test_IoctlBackend_delete_batch(self):
+        snap_dir = self.snap_dir
+        snapshots = [os.path.join(snap_dir, name) for name in ('a', 'b')]
+        for snapshot in snapshots:
+            os.mkdir(snapshot)
+        ioctl = FakeIoctl()
+        backend = btrsnap.IoctlBackend(ioctl=ioctl)
+        backend.delete_batch(snapshots, commit='after')
+        self.assertEqual([('destroy', 'a'), ('destroy', 'b'), ('sync',)],
+                         ioctl.calls)
+
+        for snapshot in snapshots:
+            os.mkdir(snapshot)
+        ioctl.calls = []
+        backend.delete_batch(snapshots, commit='each')
+        self.assertEqual([('destroy', 'a'), ('sync',), ('destroy', 'b'),
+                          ('sync',)], ioctl.calls)
+
+        ioctl.calls = []
+        os.mkdir(snapshots[1])
+        self.assertRaises(btrsnap.BtrfsError, backend.delete_batch,
+                          snapshots)
+        self.assertFalse(os.path.isdir(snapshots[1]))
+
+    def test_IoctlBackend_errors(self):
+        snap_dir = self.snap_dir
+        link_dir = self.link_dir
+        backend = btrsnap.IoctlBackend(ioctl=FakeIoctl(error=errno.EPERM))
+        self.assertRaises(btrsnap.BtrfsError, backend.snap, link_dir,
+                          os.path.join(snap_dir, 'test'))
+        self.assertRaises(btrsnap.BtrfsError, backend.delete,
+                          os.path.join(snap_dir, 'test'))
+        self.assertRaises(btrsnap.BtrfsError, backend.snap, link_dir,
+                          os.path.join(snap_dir, 'x' * 4040))
+
+    def test_IoctlBackend_snap_and_unsnap_functions(self):
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        first = os.path.join(snap_dir, timestamp + '-0001')
+        second = os.path.join(snap_dir, timestamp + '-0002')
+        backend = btrsnap.IoctlBackend(ioctl=FakeIoctl())
+
+        btrsnap.snap(snap_dir, backend=backend)
+        btrsnap.snap(snap_dir, backend=backend)
+        self.assertTrue(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+
+        btrsnap.unsnap(snap_dir, keep=1, backend=backend)
+        self.assertFalse(os.path.isdir(first))
+        self.assertTrue(os.path.isdir(second))
+
+    def test_IoctlBackend_snapdeep_consistent(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        timestamp = datetime.date.today().isoformat() + '-0001'
+        backend = btrsnap.IoctlBackend(ioctl=FakeIoctl())
+
+        output = btrsnap.snapdeep(test_dir, consistent=True, backend=backend)
+        self.assertIn(timestamp, output)
+        self.assertTrue(os.path.isdir(os.path.join(snap_dir, timestamp)))
+
+
+class Test_SimulatedBackend_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+    subvolume = os.path.join(test_dir, 'subvolume')
+
+    def setUp(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        subvolume = self.subvolume
+
+        os.mkdir(test_dir)
+        os.mkdir(snap_dir)
+        os.mkdir(self.receive_dir)
+        self.backend = btrsnap.SimulatedBackend()
+        self.backend.create(subvolume)
+        os.symlink(subvolume, os.path.join(snap_dir, 'target'))
+        with open(os.path.join(subvolume, 'file'), 'w') as f:
+            f.write('first')
+
+    def tearDown(self):
+        test_dir = self.test_dir
+        shutil.rmtree(test_dir)
+
+    def test_SimulatedBackend_snap(self):
+        snap_dir = self.snap_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        snapshot = os.path.join(snap_dir, 'snapshot')
+        backend.snap(subvolume, snapshot)
+
+        info = backend.show(snapshot)
+        self.assertTrue(info['readonly'])
+        self.assertEqual(backend.show(subvolume)['uuid'], info['parent_uuid'])
+        self.assertEqual(backend.show(subvolume)['generation'],
+                         info['generation'])
+        self.assertEqual(['file'], [name for name in os.listdir(snapshot)
+                                    if name != btrsnap.SIMULATED_SUBVOLUME])
+        self.assertEqual([snapshot], [subvolume['path'] for subvolume
+                                      in backend.list(snap_dir)])
+
+    def test_SimulatedBackend_nested_subvolume(self):
+        snap_dir = self.snap_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        backend.create(os.path.join(subvolume, 'nested'))
+        open(os.path.join(subvolume, 'nested', 'hidden'), 'w').close()
+        snapshot = os.path.join(snap_dir, 'snapshot')
+        backend.snap(subvolume, snapshot)
+
+        self.assertEqual([], os.listdir(os.path.join(snapshot, 'nested')))
+
+    def test_SimulatedBackend_errors(self):
+        snap_dir = self.snap_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        writable = os.path.join(snap_dir, 'writable')
+        backend.snap(subvolume, writable, readonly=False)
+
+        self.assertRaises(btrsnap.BtrfsError, backend.snap, snap_dir,
+                          os.path.join(snap_dir, 'snapshot'))
+        self.assertRaises(btrsnap.BtrfsError, backend.snap, subvolume,
+                          writable)
+        self.assertRaises(btrsnap.BtrfsError, backend.delete, snap_dir)
+        self.assertRaises(btrsnap.BtrfsError, backend.send, writable)
+
+    def test_SimulatedBackend_sendreceive(self):
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        timestamp = datetime.date.today().isoformat()
+
+        btrsnap.snap(snap_dir, backend=backend)
+        os.mkdir(os.path.join(subvolume, 'directory'))
+        with open(os.path.join(subvolume, 'file.new'), 'w') as f:
+            f.write('second')
+        os.replace(os.path.join(subvolume, 'file.new'),
+                   os.path.join(subvolume, 'file'))
+        btrsnap.snap(snap_dir, backend=backend)
+        btrsnap.sendreceive(snap_dir, receive_dir, backend=backend)
+
+        first = os.path.join(receive_dir, timestamp + '-0001')
+        second = os.path.join(receive_dir, timestamp + '-0002')
+        with open(os.path.join(first, 'file')) as f:
+            self.assertEqual('first', f.read())
+        with open(os.path.join(second, 'file')) as f:
+            self.assertEqual('second', f.read())
+        self.assertTrue(os.path.isdir(os.path.join(second, 'directory')))
+        self.assertFalse(os.path.isdir(os.path.join(first, 'directory')))
+
+        sent = backend.show(os.path.join(snap_dir, timestamp + '-0002'))
+        received = backend.show(second)
+        self.assertEqual(sent['uuid'], received['received_uuid'])
+        self.assertEqual(backend.show(first)['uuid'],
+                         received['parent_uuid'])
+        self.assertTrue(received['readonly'])
+
+        # delete on the sending side and send again
+        os.unlink(os.path.join(subvolume, 'file'))
+        btrsnap.snap(snap_dir, backend=backend)
+        btrsnap.sendreceive(snap_dir, receive_dir, backend=backend)
+        third = os.path.join(receive_dir, timestamp + '-0003')
+        self.assertFalse(os.path.exists(os.path.join(third, 'file')))
+        self.assertTrue(os.path.exists(os.path.join(second, 'file')))
+
+    def test_SimulatedBackend_sendreceive_older_snapshot(self):
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        for name in ('2014-01-01-0001', '2014-01-01-0002', '2014-01-01-0003'):
+            with open(os.path.join(subvolume, 'file.new'), 'w') as f:
+                f.write(name)
+            os.replace(os.path.join(subvolume, 'file.new'),
+                       os.path.join(subvolume, 'file'))
+            backend.snap(subvolume, os.path.join(snap_dir, name))
+        btrfs = btrsnap.Btrfs(receive_dir, backend=backend)
+        btrfs.receive(btrsnap.Btrfs(snap_dir, backend=backend).send(
+            '2014-01-01-0003'))
+
+        output = btrsnap.sendreceive(snap_dir, receive_dir, backend=backend,
+                                     dry_run=True)
+        self.assertIn('2014-01-01-0001: from 2014-01-01-0003', output)
+        self.assertIn('2014-01-01-0002: from 2014-01-01-0001, clones'
+                      ' 2014-01-01-0003', output)
+        self.assertEqual(1, len(btrsnap.ReceivePath(receive_dir).snapshots()))
+
+        btrsnap.sendreceive(snap_dir, receive_dir, backend=backend)
+        for name in ('2014-01-01-0001', '2014-01-01-0002'):
+            info = backend.show(os.path.join(receive_dir, name))
+            self.assertIsNotNone(info['parent_uuid'])
+            with open(os.path.join(receive_dir, name, 'file')) as f:
+                self.assertEqual(name, f.read())
+
+    def test_SimulatedBackend_missing_parent(self):
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        subvolume = self.subvolume
+        backend = self.backend
+        backend.snap(subvolume, os.path.join(snap_dir, 'first'))
+        backend.snap(subvolume, os.path.join(snap_dir, 'second'))
+
+        btrfs = btrsnap.Btrfs(receive_dir, backend=backend)
+        self.assertRaises(btrsnap.BtrfsError, btrfs.receive,
+                          btrsnap.Btrfs(snap_dir, backend=backend).send(
+                              'second', 'first'))
+
+    def test_SimulatedBackend_progs_stand_in(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        receive_dir = self.receive_dir
+        bin_dir = os.path.join(test_dir, 'bin')
+        os.mkdir(bin_dir)
+        write_btrfs_stand_in(bin_dir)
+        path = os.environ['PATH']
+        os.environ['PATH'] = bin_dir + os.pathsep + path
+        try:
+            backend = btrsnap.ProgsBackend()
+            btrsnap.snap(snap_dir, backend=backend)
+            btrsnap.sendreceive(snap_dir, receive_dir, backend=backend)
+            received = backend.list(receive_dir)
+            info = backend.show(received[0]['path'])
+        finally:
+            os.environ['PATH'] = path
+
+        self.assertEqual(1, len(received))
+        self.assertEqual(datetime.date.today().isoformat() + '-0001',
+                         info['name'])
+        self.assertEqual(received[0]['uuid'], info['uuid'])
+        self.assertTrue(info['readonly'])
+        self.assertIsNone(info['parent_uuid'])
+        self.assertIsNotNone(info['received_uuid'])
+
+
+class RecordingBackend(btrsnap.SimulatedBackend):
+    '''
+    SimulatedBackend remembering every batch it deletes.
+    '''
+
+    def __init__(self):
+        btrsnap.SimulatedBackend.__init__(self)
+        self.batches = []
+
+    def delete_batch(self, snapshots, commit=None):
+        self.batches.append(([os.path.basename(snapshot)
+                              for snapshot in snapshots], commit))
+        btrsnap.SimulatedBackend.delete_batch(self, snapshots, commit=commit)
+
+
+class Test_unsnap_batches(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dirs = (os.path.join(test_dir, 'one'), os.path.join(test_dir, 'two'))
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        self.backend = RecordingBackend()
+        self.backend.create(self.subvolume)
+        for snap_dir in self.snap_dirs:
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+            for counter in range(1, 4):
+                self.backend.snap(self.subvolume, os.path.join(
+                    snap_dir, '2014-01-01-{:04d}'.format(counter)))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_unsnap_batch_size(self):
+        snap_dir = self.snap_dirs[0]
+        backend = self.backend
+        btrsnap.unsnap(snap_dir, keep=0, backend=backend, batch_size=2,
+                       commit='after')
+
+        self.assertEqual([(['2014-01-01-0003', '2014-01-01-0002'], 'after'),
+                          (['2014-01-01-0001'], 'after')], backend.batches)
+        self.assertEqual([], btrsnap.ReceivePath(snap_dir).snapshots())
+
+    def test_unsnap_deep_batches_span_paths(self):
+        backend = self.backend
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend)
+
+        self.assertEqual(1, len(backend.batches))
+        self.assertEqual(4, len(backend.batches[0][0]))
+        self.assertIsNone(backend.batches[0][1])
+        self.assertEqual(2, output.count('2 snapshot(s)'))
+        for snap_dir in self.snap_dirs:
+            self.assertEqual(['2014-01-01-0003'],
+                             btrsnap.ReceivePath(snap_dir).snapshots())
+
+    def test_unsnap_invalid_batches(self):
+        snap_dir = self.snap_dirs[0]
+        backend = self.backend
+        self.assertRaises(Exception, btrsnap.unsnap, snap_dir, keep=0,
+                          backend=backend, batch_size=0)
+        self.assertRaises(Exception, btrsnap.unsnap, snap_dir, keep=0,
+                          backend=backend, commit='never')
+        self.assertEqual([], backend.batches)
+
+
+class Test_RetentionPolicy_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dir = os.path.join(test_dir, 'snapshots')
+    now = datetime.datetime(2014, 3, 5, 12, 30)
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.snap_dir)
+        self.backend = RecordingBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def history(self, step, count):
+        return [btrsnap.Snapshot.from_datetime(self.now - number * step)
+                for number in range(count)]
+
+    def test_RetentionPolicy_buckets(self):
+        # every 6 hours for 60 days, newest first
+        snapshots = self.history(datetime.timedelta(hours=6), 240)
+        policy = btrsnap.RetentionPolicy(keep=2, hourly=3, daily=7,
+                                         weekly=4, monthly=3)
+        plan = policy.plan(snapshots, now=self.now)
+
+        self.assertEqual(snapshots, [snapshot for snapshot, _ in plan])
+        kept = dict((str(snapshot), reasons) for snapshot, reasons in plan
+                    if reasons)
+        self.assertEqual(['keep', 'hourly', 'daily', 'weekly', 'monthly'],
+                         kept['2014-03-05-123000'])
+        self.assertEqual(['keep', 'hourly'], kept['2014-03-05-063000'])
+        self.assertEqual(['hourly'], kept['2014-03-05-003000'])
+        self.assertEqual(['daily'], kept['2014-03-04-183000'])
+        # the newest of each of the last 7 days
+        daily = sorted(name for name, reasons in kept.items()
+                       if 'daily' in reasons)
+        self.assertEqual(7, len(daily))
+        self.assertEqual('2014-02-27-183000', daily[0])
+        # newest of the weeks starting on the mondays 03-03, 02-24, 02-17
+        # and 02-10
+        weekly = sorted(name for name, reasons in kept.items()
+                        if 'weekly' in reasons)
+        self.assertEqual(['2014-02-16-183000', '2014-02-23-183000',
+                          '2014-03-02-183000', '2014-03-05-123000'], weekly)
+        monthly = sorted(name for name, reasons in kept.items()
+                         if 'monthly' in reasons)
+        self.assertEqual(['2014-01-31-183000', '2014-02-28-183000',
+                          '2014-03-05-123000'], monthly)
+        self.assertEqual(len(set(daily + weekly + monthly +
+                                 ['2014-03-05-063000',
+                                  '2014-03-05-003000'])), len(kept))
+
+    def test_RetentionPolicy_max_age(self):
+        snapshots = self.history(datetime.timedelta(days=1), 10)
+        policy = btrsnap.RetentionPolicy(keep=5, daily=10,
+                                         max_age=btrsnap.parse_age('2d'))
+        plan = policy.plan(snapshots, now=self.now)
+
+        self.assertEqual([['keep', 'daily'], ['keep', 'daily'],
+                          ['keep', 'daily'], ['keep'], ['keep'],
+                          [], [], [], [], []],
+                         [reasons for _, reasons in plan])
+        self.assertEqual('keep 5, daily 10, max age 2 days, 0:00:00',
+                         str(policy))
+
+        policy = btrsnap.RetentionPolicy(max_age=btrsnap.parse_age('2d'))
+        plan = policy.plan(snapshots, now=self.now)
+        self.assertEqual([['keep', 'max-age'], ['max-age'], ['max-age']] +
+                         [[]] * 7, [reasons for _, reasons in plan])
+
+    def test_RetentionPolicy_day_resolution(self):
+        # switched from -t day to -t second, the hours of the day named
+        # snapshots are unknown so only the other buckets place them
+        snapshots = [btrsnap.Snapshot(name) for name in (
+            '2014-03-05-110000', '2014-03-05-100000', '2014-03-04-0002',
+            '2014-03-04-0001', '2014-03-03-0001')]
+        policy = btrsnap.RetentionPolicy(keep=1, hourly=24, daily=7)
+        self.assertEqual([['keep', 'hourly', 'daily'], ['hourly'], ['daily'],
+                          [], ['daily']],
+                         [reasons for _, reasons
+                          in policy.plan(snapshots, now=self.now)])
+        policy = btrsnap.RetentionPolicy(keep=0, hourly=3)
+        self.assertEqual([['hourly'], ['hourly'], [], [], []],
+                         [reasons for _, reasons
+                          in policy.plan(snapshots, now=self.now)])
+
+        # taken some time on 03-04, so less than a day old at 03-05 12:30
+        snapshots = [btrsnap.Snapshot('2014-03-04-0001'),
+                     btrsnap.Snapshot('2014-03-03-0001')]
+        policy = btrsnap.RetentionPolicy(keep=0,
+                                         max_age=btrsnap.parse_age('1d'))
+        self.assertEqual([['max-age'], []],
+                         [reasons for _, reasons
+                          in policy.plan(snapshots, now=self.now)])
+
+    def test_RetentionPolicy_invalid(self):
+        self.assertRaises(Exception, btrsnap.RetentionPolicy, keep=-1)
+        self.assertRaises(Exception, btrsnap.RetentionPolicy, daily=1.5)
+        self.assertRaises(Exception, btrsnap.RetentionPolicy,
+                          max_age=datetime.timedelta(0))
+        self.assertEqual(datetime.timedelta(hours=36),
+                         btrsnap.parse_age('36h'))
+        self.assertEqual(datetime.timedelta(days=90),
+                         btrsnap.parse_age('3m'))
+        for text in ('', '3', 'd', '1.5d', '-2d', '2s'):
+            self.assertRaises(ValueError, btrsnap.parse_age, text)
+
+    def test_RetentionPolicy_unsnap(self):
+        backend = self.backend
+        for snapshot in self.history(datetime.timedelta(hours=12), 6):
+            backend.snap(self.subvolume,
+                         os.path.join(self.snap_dir, snapshot.name))
+        policy = btrsnap.RetentionPolicy(keep=1, daily=2)
+
+        output = btrsnap.unsnap(self.snap_dir, backend=backend,
+                                policy=policy, dry_run=True)
+        self.assertEqual([], backend.batches)
+        self.assertEqual(6, len(btrsnap.ReceivePath(
+            self.snap_dir).snapshots()))
+        self.assertIn('Would delete 4 snapshot(s)', output)
+        self.assertIn('2 kept (keep 1, daily 2)', output)
+        self.assertIn('\t2014-03-05-123000: keep, daily', output)
+        self.assertIn('\t2014-03-05-003000: delete', output)
+        self.assertIn('\t2014-03-04-123000: daily', output)
+
+        output = btrsnap.unsnap(self.snap_dir, backend=backend,
+                                policy=policy)
+        self.assertIn('Deleted 4 snapshot(s)', output)
+        self.assertEqual(['2014-03-05-123000', '2014-03-04-123000'],
+                         btrsnap.ReceivePath(self.snap_dir).snapshots())
+
+    def test_RetentionPolicy_unsnap_deep(self):
+        backend = self.backend
+        other = os.path.join(self.test_dir, 'other')
+        os.mkdir(other)
+        os.symlink(self.subvolume, os.path.join(other, 'target'))
+        for snap_dir in (self.snap_dir, other):
+            for snapshot in self.history(datetime.timedelta(days=3), 4):
+                backend.snap(self.subvolume,
+                             os.path.join(snap_dir, snapshot.name))
+        policy = btrsnap.RetentionPolicy(keep=0, weekly=1)
+
+        output = btrsnap.unsnap_deep(self.test_dir, keep=0, backend=backend,
+                                     policy=policy, dry_run=True)
+        self.assertEqual([], backend.batches)
+        self.assertEqual(2, output.count('Would delete 3 snapshot(s)'))
+
+        btrsnap.unsnap_deep(self.test_dir, keep=0, backend=backend,
+                            policy=policy)
+        for snap_dir in (self.snap_dir, other):
+            self.assertEqual(['2014-03-05-123000'],
+                             btrsnap.ReceivePath(snap_dir).snapshots())
+
+
+class FreeingBackend(RecordingBackend):
+    '''
+    SimulatedBackend on a filesystem of SIZE bytes where every deleted
+    snapshot frees the bytes in FREES, default 10, once btrfs-cleaner
+    gets to it. With slow, btrfs-cleaner cleans one snapshot each time it
+    is asked about.
+    '''
+
+    def __init__(self, free=0, size=1000, slow=False):
+        RecordingBackend.__init__(self)
+        self.free = free
+        self.size = size
+        self.slow = slow
+        self.frees = {}
+        self.pending = []
+
+    def delete_batch(self, snapshots, commit=None):
+        RecordingBackend.delete_batch(self, snapshots, commit=commit)
+        self.pending.extend(snapshots)
+
+    def cleaning(self, path):
+        while self.pending:
+            self.free += self.frees.get(os.path.basename(self.pending.pop(0)),
+                                        10)
+            if self.slow:
+                break
+        return len(self.pending)
+
+    def free_space(self, path):
+        return self.free, self.size
+
+
+class Test_unsnap_free(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dirs = (os.path.join(test_dir, 'one'), os.path.join(test_dir, 'two'))
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        self.backend = FreeingBackend()
+        self.backend.create(self.subvolume)
+        # one takes the even hours, two the odd ones
+        for number, snap_dir in enumerate(self.snap_dirs):
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+            for hour in range(number, 8, 2):
+                self.backend.snap(self.subvolume, os.path.join(
+                    snap_dir, '2014-01-01-{:02d}0000'.format(hour)))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def remaining(self):
+        return [btrsnap.ReceivePath(snap_dir).snapshots()
+                for snap_dir in self.snap_dirs]
+
+    def test_unsnap_deep_free_oldest_first(self):
+        backend = self.backend
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('35'))
+
+        # one snapshot first, then as many as the 10 bytes it freed predict
+        self.assertEqual([(['2014-01-01-000000'], 'after'),
+                          (['2014-01-01-010000', '2014-01-01-020000',
+                            '2014-01-01-030000'], 'after')],
+                         backend.batches)
+        self.assertEqual([['2014-01-01-060000', '2014-01-01-040000'],
+                          ['2014-01-01-070000', '2014-01-01-050000']],
+                         self.remaining())
+        self.assertIn('Deleted 2 snapshot(s) from "{}"'.format(
+            self.snap_dirs[0]), output)
+        self.assertIn('40B free of 35B wanted', output)
+        self.assertIn('after deleting 4 of 6 snapshot(s)', output)
+
+    def test_unsnap_free_keep_and_target(self):
+        backend = self.backend
+        backend.free = 100
+        output = btrsnap.unsnap(self.snap_dirs[0], keep=1, backend=backend,
+                                free=btrsnap.FreeTarget('10%'))
+        self.assertEqual([], backend.batches)
+        self.assertIn('after deleting 0 of 3 snapshot(s)', output)
+
+        output = btrsnap.unsnap(self.snap_dirs[0], keep=1, backend=backend,
+                                free=btrsnap.FreeTarget('50%'))
+        self.assertIn('Not enough snapshots to delete', output)
+        self.assertEqual([['2014-01-01-060000'], ['2014-01-01-070000',
+                                                  '2014-01-01-050000',
+                                                  '2014-01-01-030000',
+                                                  '2014-01-01-010000']],
+                         self.remaining())
+        self.assertRaises(Exception, btrsnap.unsnap, self.snap_dirs[1],
+                          backend=backend, free=btrsnap.FreeTarget('1K'),
+                          queue=True)
+        self.assertRaises(Exception, btrsnap.unsnap_deep, self.test_dir,
+                          backend=backend, by_size=True)
+
+    def test_delete_until_free_waits_for_cleaner(self):
+        backend = FreeingBackend(slow=True)
+        # the first two free nothing, their extents are shared
+        backend.frees = {'a': 0, 'b': 0}
+        snapshots = [os.path.join(self.test_dir, name)
+                     for name in 'abcdefghijklmnop']
+        for snapshot in snapshots:
+            backend.create(snapshot)
+        result = btrsnap._delete_until_free(snapshots[:8],
+                                            btrsnap.FreeTarget('15'),
+                                            backend, batch_size=100,
+                                            interval=0)
+
+        # doubles while nothing is freed, then stops as soon as 15 are
+        # free without waiting for the cleaner to finish 'e'
+        self.assertEqual([['a'], ['b', 'c'], ['d', 'e']],
+                         [batch for batch, _ in backend.batches])
+        self.assertEqual(snapshots[:5], result['deleted'])
+        self.assertEqual(20, result['free'])
+        self.assertEqual([snapshots[4]], backend.pending)
+
+        backend = FreeingBackend()
+        result = btrsnap._delete_until_free(snapshots[8:],
+                                            btrsnap.FreeTarget('45'),
+                                            backend, batch_size=2,
+                                            interval=0)
+        self.assertEqual([['i'], ['j', 'k'], ['l', 'm']],
+                         [batch for batch, _ in backend.batches])
+        self.assertEqual(50, result['free'])
+        self.assertEqual(['f', 'g', 'h', 'n', 'o', 'p'], sorted(
+            name for name in os.listdir(self.test_dir) if len(name) == 1))
+
+    def test_FreeTarget(self):
+        self.assertEqual(20 * 1024 ** 3, btrsnap.FreeTarget('20G').bytes)
+        self.assertEqual(1536, btrsnap.FreeTarget('1.5k').needed(10))
+        self.assertEqual(250, btrsnap.FreeTarget('25%').needed(1000))
+        self.assertEqual('25%', str(btrsnap.FreeTarget('25%')))
+        self.assertEqual('20.0G', str(btrsnap.FreeTarget('20G')))
+        for text in ('', 'G', '-1G', '20X', '0%', '100%', '1%%'):
+            self.assertRaises(ValueError, btrsnap.FreeTarget, text)
+
+
+class Test_unsnap_free_by_size(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dirs = (os.path.join(test_dir, 'one'), os.path.join(test_dir, 'two'))
+    # bytes only the snapshot of each hour holds
+    sizes = (10, 50, 5, 20, 40, 5, 30, 10)
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        self.backend = FreeingBackend()
+        self.backend.create(self.subvolume)
+        for snap_dir in self.snap_dirs:
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+        with open(os.path.join(self.subvolume, 'shared'), 'wb') as f:
+            f.write(b'x' * 100)
+        for hour, size in enumerate(self.sizes + (1,)):
+            # replaced, not modified, so the snapshots keep their copy
+            self.replace(size)
+            if hour == len(self.sizes):
+                break
+            name = '2014-01-01-{:02d}0000'.format(hour)
+            self.backend.snap(self.subvolume, os.path.join(
+                self.snap_dirs[hour % 2], name))
+            self.backend.frees[name] = size
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def replace(self, size):
+        data = os.path.join(self.subvolume, 'data')
+        with open(data + '.tmp', 'wb') as f:
+            f.write(b'x' * size)
+        os.replace(data + '.tmp', data)
+
+    def test_SimulatedBackend_qgroups(self):
+        backend = self.backend
+        qgroups = backend.qgroups(self.snap_dirs[0])
+        ids = dict((os.path.basename(subvolume['path']), subvolume['id'])
+                   for snap_dir in self.snap_dirs
+                   for subvolume in backend.list(snap_dir))
+        self.assertEqual(8, len(ids))
+        for hour, size in enumerate(self.sizes):
+            self.assertEqual({'referenced': 100 + size, 'exclusive': size},
+                             qgroups[ids['2014-01-01-{:02d}0000'.format(
+                                 hour)]])
+        # the same numbers through btrfs qgroup show, simulated in PATH
+        self.assertEqual(qgroups, btrsnap.ProgsBackend().qgroups(
+            self.snap_dirs[0]))
+
+    def test_unsnap_deep_free_plan(self):
+        backend = self.backend
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('85'),
+                                     by_size=True, dry_run=True)
+        self.assertEqual([], backend.batches)
+        self.assertIn('Would delete 2 of 6 snapshot(s)', output)
+        self.assertIn('an estimated 90B: 0B free of 85B wanted', output)
+        plan = [line.strip().split(': ', 1) for line in output.splitlines()
+                if line.startswith('\t')]
+        # largest first, the oldest first between equal sizes
+        self.assertEqual(['01: delete, 50B', '04: delete, 40B', '03: 20B',
+                          '00: 10B', '02: 5B', '05: 5B'],
+                         [snapshot[-6:-4] + ': ' + reclaim[:-len(' exclusive')]
+                          for snapshot, reclaim in plan])
+
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('85'),
+                                     dry_run=True)
+        self.assertIn('Would delete 4 of 6 snapshot(s)', output)
+
+        policy = btrsnap.RetentionPolicy(keep=1, hourly=3)
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('85'),
+                                     by_size=True, dry_run=True,
+                                     policy=policy)
+        self.assertIn('Would delete 2 of 2 snapshot(s)', output)
+        self.assertIn('Not enough snapshots to delete', output)
+
+    def test_unsnap_deep_free_plan_without_quotas(self):
+        backend = self.backend
+
+        def qgroups(path):
+            raise btrsnap.BtrfsError('quotas not enabled')
+        backend.qgroups = qgroups
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('85'),
+                                     dry_run=True)
+        self.assertEqual([], backend.batches)
+        self.assertIn('Would delete up to 6 snapshot(s)', output)
+        self.assertIn('until 85B is free, 0B free now', output)
+        # the oldest first
+        self.assertEqual(['00', '01', '02', '03', '04', '05'],
+                         [line[-6:-4] for line in output.splitlines()
+                          if line.startswith('\t')])
+        self.assertRaises(btrsnap.BtrfsError, btrsnap.unsnap_deep,
+                          self.test_dir, keep=1, backend=backend,
+                          free=btrsnap.FreeTarget('85'), by_size=True,
+                          dry_run=True)
+
+    def test_unsnap_deep_free_by_size(self):
+        backend = self.backend
+        output = btrsnap.unsnap_deep(self.test_dir, keep=1, backend=backend,
+                                     free=btrsnap.FreeTarget('85'),
+                                     by_size=True)
+
+        self.assertEqual([['2014-01-01-010000'], ['2014-01-01-040000']],
+                         [batch for batch, _ in backend.batches])
+        self.assertIn('90B free of 85B wanted', output)
+        self.assertIn('after deleting 2 of 6 snapshot(s)', output)
+
+
+class SizingBackend(btrsnap.SimulatedBackend):
+    '''
+    SimulatedBackend counting its size queries, optionally without quotas.
+    '''
+
+    def __init__(self, quotas=True):
+        btrsnap.SimulatedBackend.__init__(self)
+        self.quotas = quotas
+        self.queries = []
+
+    def qgroups(self, path):
+        self.queries.append('qgroups')
+        if not self.quotas:
+            raise btrsnap.BtrfsError('quotas not enabled')
+        return btrsnap.SimulatedBackend.qgroups(self, path)
+
+    def du(self, paths):
+        self.queries.append('du')
+        return btrsnap.SimulatedBackend.du(self, paths)
+
+
+class Test_list_sizes(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dirs = (os.path.join(test_dir, 'one'), os.path.join(test_dir, 'two'))
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        backend = btrsnap.SimulatedBackend()
+        backend.create(self.subvolume)
+        for snap_dir in self.snap_dirs:
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+        # one and two each hold 1000 bytes of their own and share 3000
+        with open(os.path.join(self.subvolume, 'shared'), 'wb') as f:
+            f.write(b'x' * 3000)
+        for snap_dir in self.snap_dirs:
+            self.snap(backend, snap_dir, '2014-01-01-0001', 1000)
+        self.snap(backend, self.snap_dirs[0], '2014-01-01-0002', 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def snap(self, backend, snap_dir, name, size):
+        data = os.path.join(self.subvolume, 'data')
+        with open(data + '.tmp', 'wb') as f:
+            f.write(b'x' * size)
+        os.replace(data + '.tmp', data)
+        backend.snap(self.subvolume, os.path.join(snap_dir, name))
+        os.remove(data)
+
+    def test_show_snaps_sizes(self):
+        backend = SizingBackend()
+        output = btrsnap.show_snaps(self.snap_dirs[0], sizes=True,
+                                    backend=backend)
+        lines = output.splitlines()
+        self.assertEqual(['Snapshot', 'Referenced', 'Exclusive'],
+                         lines[0].split())
+        self.assertEqual(['2014-01-01-0002', '2.9K', '0B'], lines[1].split())
+        self.assertEqual(['2014-01-01-0001', '3.9K', '1000B'],
+                         lines[2].split())
+        self.assertIn('contains 2 snapshot(s), 1000B exclusive', output)
+        self.assertEqual(['qgroups'], backend.queries)
+
+        # cached until a snapshot is added
+        self.assertEqual(output, btrsnap.show_snaps(
+            self.snap_dirs[0], sizes=True, backend=backend))
+        self.assertEqual(['qgroups'], backend.queries)
+        self.snap(backend, self.snap_dirs[0], '2014-01-01-0003', 500)
+        output = btrsnap.show_snaps(self.snap_dirs[0], sizes=True,
+                                    backend=backend)
+        self.assertEqual(['qgroups', 'qgroups'], backend.queries)
+        self.assertIn('contains 3 snapshot(s), 1.5K exclusive', output)
+        self.assertNotIn('.btrsnap', btrsnap.show_snaps(self.snap_dirs[0]))
+
+    def test_show_snaps_deep_sizes(self):
+        backend = SizingBackend(quotas=False)
+        output = btrsnap.show_snaps_deep(self.test_dir, sizes=True,
+                                         backend=backend)
+
+        self.assertEqual(['qgroups', 'du'], backend.queries)
+        self.assertIn('Oldest = 2014-01-01, 1000B exclusive', output)
+        self.assertEqual(2, output.count('1000B exclusive'))
+        self.assertIn('contains 3 snapshots in 3 subdirectories, 2.0K'
+                      ' exclusive', output)
+        self.assertEqual(2, output.count('3.9K      1000B'))
+        self.assertTrue(os.path.isfile(os.path.join(self.test_dir,
+                                                    btrsnap.SIZE_FILE)))
+
+        backend.queries = []
+        self.assertEqual(output, btrsnap.show_snaps_deep(
+            self.test_dir, sizes=True, backend=backend))
+        self.assertEqual([], backend.queries)
+        btrsnap.unsnap(self.snap_dirs[0], keep=1, backend=backend)
+        btrsnap.show_snaps_deep(self.test_dir, sizes=True, backend=backend)
+        self.assertEqual(['qgroups', 'du'], backend.queries)
+
+    def test_ProgsBackend_du(self):
+        snapshots = [os.path.join(self.snap_dirs[0], '2014-01-01-0001'),
+                     os.path.join(self.snap_dirs[1], '2014-01-01-0001')]
+        sizes = btrsnap.ProgsBackend().du(snapshots)
+        self.assertEqual(btrsnap.SimulatedBackend().du(snapshots), sizes)
+        self.assertEqual({'referenced': 4000, 'exclusive': 1000},
+                         sizes[snapshots[1]])
+
+
+class CleaningBackend(RecordingBackend):
+    '''
+    RecordingBackend reporting a btrfs-cleaner backlog that shrinks by one
+    every time it is checked.
+    '''
+
+    def __init__(self, backlog):
+        RecordingBackend.__init__(self)
+        self.backlog = backlog
+
+    def cleaning(self, path):
+        self.backlog = max(0, self.backlog - 1)
+        return self.backlog
+
+
+class Test_DeletionQueue_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.snap_dir)
+        self.backend = RecordingBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        for counter in range(1, 6):
+            self.backend.snap(self.subvolume, os.path.join(
+                self.snap_dir, '2014-01-01-{:04d}'.format(counter)))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def queued(self):
+        return [os.path.basename(snapshot['path']) for snapshot
+                in btrsnap.DeletionQueue(self.snap_dir).read()['snapshots']]
+
+    def test_DeletionQueue_unsnap_queue(self):
+        snap_dir = self.snap_dir
+        output = btrsnap.unsnap(snap_dir, keep=2, queue=True)
+        btrsnap.unsnap(snap_dir, keep=2, queue=True)
+
+        self.assertIn('Queued 3 snapshot(s)', output)
+        self.assertEqual(5, len(btrsnap.ReceivePath(snap_dir).snapshots()))
+        self.assertEqual(['2014-01-01-0001', '2014-01-01-0002',
+                          '2014-01-01-0003'], self.queued())
+        self.assertIn('3 snapshot(s) queued', btrsnap.queue_status(snap_dir))
+
+    def test_DeletionQueue_drain(self):
+        snap_dir = self.snap_dir
+        backend = self.backend
+        btrsnap.unsnap(snap_dir, keep=1, queue=True)
+        queue = btrsnap.DeletionQueue(snap_dir)
+
+        run = queue.drain(backend=backend, batch_size=2, limit=3)
+        self.assertEqual(3, run['deleted'])
+        self.assertEqual([['2014-01-01-0001', '2014-01-01-0002'],
+                          ['2014-01-01-0003']],
+                         [batch for batch, commit in backend.batches])
+        self.assertEqual(['2014-01-01-0004'], self.queued())
+
+        output = btrsnap.drain(snap_dir, backend=backend)
+        self.assertIn('Deleted 1 snapshot(s)', output)
+        self.assertEqual([], self.queued())
+        self.assertEqual(['2014-01-01-0005'],
+                         btrsnap.ReceivePath(snap_dir).snapshots())
+        self.assertEqual(2, len(queue.read()['runs']))
+        self.assertIn('4 snapshot(s) deleted by the last 2 drain(s)',
+                      btrsnap.queue_status(snap_dir))
+
+    def test_DeletionQueue_drain_skips_missing(self):
+        snap_dir = self.snap_dir
+        backend = self.backend
+        btrsnap.unsnap(snap_dir, keep=3, queue=True)
+        backend.delete(os.path.join(snap_dir, '2014-01-01-0001'))
+
+        run = btrsnap.DeletionQueue(snap_dir).drain(backend=backend)
+        self.assertEqual(1, run['deleted'])
+        self.assertEqual([(['2014-01-01-0002'], None)], backend.batches)
+        self.assertEqual([], self.queued())
+
+    def test_DeletionQueue_drain_rate(self):
+        snap_dir = self.snap_dir
+        btrsnap.unsnap(snap_dir, keep=2, queue=True)
+
+        run = btrsnap.DeletionQueue(snap_dir).drain(backend=self.backend,
+                                                    rate=600)
+        # the first snapshot goes at once, the next two 0.1s apart
+        self.assertEqual(3, run['deleted'])
+        self.assertGreaterEqual(run['elapsed'], 0.15)
+
+    def test_DeletionQueue_drain_waits_for_cleaner(self):
+        snap_dir = self.snap_dir
+        backend = CleaningBackend(backlog=3)
+        btrsnap.unsnap(snap_dir, keep=4, queue=True)
+
+        run = btrsnap.DeletionQueue(snap_dir).drain(
+            backend=backend, max_cleaner=0, interval=0.01)
+        self.assertEqual(1, run['deleted'])
+        self.assertAlmostEqual(0.02, run['waited'])
+
+    def test_DeletionQueue_invalid(self):
+        queue = btrsnap.DeletionQueue(self.snap_dir)
+        self.assertRaises(Exception, queue.drain, rate=0)
+        self.assertRaises(Exception, queue.drain, batch_size=0)
+        self.assertRaises(btrsnap.PathError, btrsnap.DeletionQueue,
+                          os.path.join(self.snap_dir, 'missing'))
+
+
+class ConcurrencyBackend(btrsnap.SimulatedBackend):
+    '''
+    SimulatedBackend counting the most receives running at once.
+    '''
+
+    def __init__(self):
+        btrsnap.SimulatedBackend.__init__(self)
+        self.active = 0
+        self.most = 0
+
+    def receive(self, path, stream):
+        with self.lock:
+            self.active += 1
+            self.most = max(self.most, self.active)
+        try:
+            time.sleep(0.05)
+            btrsnap.SimulatedBackend.receive(self, path, stream)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+class Test_sendreceive_deep_parallel(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    send_dir = os.path.join(test_dir, 'send')
+    receive_dir = os.path.join(test_dir, 'receive')
+    names = ('one', 'two', 'three')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.send_dir)
+        os.mkdir(self.receive_dir)
+        self.backend = ConcurrencyBackend()
+        self.backend.create(self.subvolume)
+        for name in self.names:
+            snap_dir = os.path.join(self.send_dir, name)
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+            for counter in range(1, 3):
+                self.backend.snap(self.subvolume, os.path.join(
+                    snap_dir, '2014-01-01-{:04d}'.format(counter)))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_sendreceive_deep_per_destination(self):
+        backend = self.backend
+        output = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                          backend=backend, jobs=3,
+                                          per_source=3)
+
+        self.assertEqual(1, backend.most)
+        self.assertIn('Sent 6 snapshot(s) in 3 path(s) from 1 to 1'
+                      ' filesystem(s)', output)
+        self.assertIn('0 failed', output)
+        for name in self.names:
+            self.assertEqual(2, len(btrsnap.ReceivePath(os.path.join(
+                self.receive_dir, name)).snapshots()))
+
+    def test_sendreceive_deep_parallel(self):
+        backend = self.backend
+        output = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                          backend=backend, jobs=3,
+                                          per_source=3, per_destination=3)
+
+        self.assertGreater(backend.most, 1)
+        self.assertIn('Per path: min', output)
+
+    def test_sendreceive_deep_parallel_failure(self):
+        os.mkdir(os.path.join(self.receive_dir, 'two'))
+        open(os.path.join(self.receive_dir, 'two', '2014-01-01-0001'),
+             'w').close()
+        output = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                          backend=self.backend, jobs=2)
+
+        self.assertIn('Sent 4 snapshot(s)', output)
+        self.assertIn('1 failed', output)
+        self.assertIn('two\' failed after', output)
+
+    def test_sendreceive_deep_dry_run(self):
+        output = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                          backend=self.backend, dry_run=True)
+
+        self.assertEqual(3, output.count('Would copy 2 snapshot(s)'))
+        self.assertEqual([], os.listdir(self.receive_dir))
+
+    def test_sendreceive_deep_invalid_limits(self):
+        self.assertRaises(Exception, btrsnap.sendreceive_deep,
+                          self.send_dir, self.receive_dir,
+                          backend=self.backend, jobs=2, per_destination=0)
+
+
+class Test_plan_sends(unittest.TestCase):
+
+    def snapshots(self, *counters):
+        return [btrsnap.Snapshot('2014-01-01-{:04d}'.format(counter))
+                for counter in counters]
+
+    def plan(self, send, receive, clones=btrsnap.CLONE_SOURCES):
+        return [(snapshot.name, parent and parent.name,
+                 [clone.name for clone in clone_sources])
+                for snapshot, parent, clone_sources in btrsnap._plan_sends(
+                    self.snapshots(*send), self.snapshots(*receive), clones)]
+
+    def test_plan_sends_older_parent(self):
+        self.assertEqual([('2014-01-01-0003', '2014-01-01-0002',
+                           ['2014-01-01-0001']),
+                          ('2014-01-01-0004', '2014-01-01-0003',
+                           ['2014-01-01-0002', '2014-01-01-0001'])],
+                         self.plan([4, 3, 2, 1], [1, 2]))
+
+    def test_plan_sends_newer_parent(self):
+        self.assertEqual([('2014-01-01-0001', '2014-01-01-0003', []),
+                          ('2014-01-01-0002', '2014-01-01-0001',
+                           ['2014-01-01-0003'])],
+                         self.plan([1, 2, 3], [3]))
+
+    def test_plan_sends_gap(self):
+        self.assertEqual([('2014-01-01-0002', '2014-01-01-0001',
+                           ['2014-01-01-0003'])],
+                         self.plan([1, 2, 3], [1, 3], clones=1))
+        self.assertEqual([('2014-01-01-0002', '2014-01-01-0001', [])],
+                         self.plan([1, 2, 3], [1, 3], clones=0))
+
+    def test_plan_sends_full(self):
+        self.assertEqual([('2014-01-01-0001', None, []),
+                          ('2014-01-01-0002', '2014-01-01-0001', [])],
+                         self.plan([1, 2], [5]))
+        self.assertEqual([], self.plan([1, 2], [1, 2]))
+        self.assertRaises(Exception, self.plan, [1], [], clones=-1)
+
+
+class Test_Pump_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+    subvolume = os.path.join(test_dir, 'subvolume')
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.snap_dir)
+        os.mkdir(self.receive_dir)
+        self.backend = btrsnap.SimulatedBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        with open(os.path.join(self.subvolume, 'file'), 'wb') as f:
+            f.write(os.urandom(100000))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def pump_pipe(self, pump, data):
+        read_fd, write_fd = os.pipe()
+        with os.fdopen(read_fd, 'rb') as source:
+            writer = threading.Thread(target=self.write_all,
+                                      args=(write_fd, data))
+            writer.start()
+            with pump.start(source) as stream:
+                received = stream.read()
+            pump.join()
+            writer.join()
+        return received
+
+    @staticmethod
+    def write_all(fd, data):
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+    def test_Pump_pipe(self):
+        data = os.urandom(3 * btrsnap.PUMP_CHUNK + 17)
+        reports = []
+        pump = btrsnap.Pump(progress=lambda *args: reports.append(args))
+        self.assertEqual(data, self.pump_pipe(pump, data))
+        self.assertEqual(len(data), pump.bytes)
+        self.assertIsNone(pump.error)
+        self.assertEqual(len(data), reports[-1][0])
+
+    def test_Pump_copy_fallback(self):
+        data = os.urandom(btrsnap.PUMP_CHUNK + 17)
+        pump = btrsnap.Pump()
+        pump.spliced = False
+        self.assertEqual(data, self.pump_pipe(pump, data))
+        self.assertEqual(len(data), pump.bytes)
+
+    def test_Pump_checksum(self):
+        data = os.urandom(3 * btrsnap.PUMP_CHUNK + 17)
+        pump = btrsnap.Pump(checksum='sha256')
+        self.assertEqual(data, self.pump_pipe(pump, data))
+        self.assertFalse(pump.spliced)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), pump.digest)
+
+    def test_StreamHasher(self):
+        hasher = btrsnap.StreamHasher('sha1', size=10)
+        data = os.urandom(100)
+        for offset in range(0, len(data), 10):
+            buffer = hasher.buffer()
+            buffer[:] = data[offset:offset + 10]
+            hasher.update(buffer, 10)
+        self.assertEqual(hashlib.sha1(data).hexdigest(), hasher.hexdigest())
+        self.assertEqual(100, hasher.bytes)
+        self.assertEqual(hasher.hexdigest(), hasher.hexdigest())
+
+    def test_RateLimiter(self):
+        self.assertRaises(Exception, btrsnap.RateLimiter, 0)
+        limiter = btrsnap.RateLimiter(1000000)
+        start = time.monotonic()
+        threads = [threading.Thread(target=limiter.take, args=(100000,))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the three takes share one budget
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+    def test_sendreceive_pump(self):
+        backend = self.backend
+        timestamp = datetime.date.today().isoformat()
+        btrsnap.snap(self.snap_dir, backend=backend)
+        reports = []
+
+        msg = btrsnap.sendreceive(
+            self.snap_dir, self.receive_dir, backend=backend,
+            bwlimit=500000, progress=lambda *args: reports.append(args))
+        self.assertRegex(msg, r'^1 snapshots copied .* \(0\.1 MB, ')
+        snapshot = os.path.join(self.snap_dir, timestamp + '-0001')
+        self.assertEqual(snapshot, reports[-1][0])
+        self.assertGreater(reports[-1][1], 100000)
+        # about 0.2 seconds at 0.5 MB/s
+        self.assertGreater(reports[-1][2], 0.15)
+        with open(os.path.join(self.subvolume, 'file'), 'rb') as f:
+            with open(os.path.join(self.receive_dir, timestamp + '-0001',
+                                   'file'), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_sendreceive_deep_pump(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        send_dir = os.path.join(self.test_dir, 'send_dir')
+        os.mkdir(send_dir)
+        os.rename(self.snap_dir, os.path.join(send_dir, 'data'))
+
+        msg = btrsnap.sendreceive_deep(send_dir, self.receive_dir,
+                                       backend=backend, jobs=2, pump=True)
+        self.assertRegex(msg, r'\nStreamed 0\.1 MB, ')
+
+    def test_sendreceive_pump_error(self):
+        btrsnap.snap(self.snap_dir, backend=self.backend)
+        second = os.path.join(self.test_dir, 'second')
+        os.mkdir(second)
+
+        def progress(*args):
+            raise RuntimeError('progress failed')
+        # a stream cut short never counts as received
+        for receive in (self.receive_dir, [self.receive_dir, second]):
+            self.assertRaisesRegex(btrsnap.BtrfsError, 'progress failed',
+                                   btrsnap.sendreceive, self.snap_dir,
+                                   receive, backend=self.backend,
+                                   progress=progress)
+
+    def test_main_send_progress(self):
+        timestamp = datetime.date.today().isoformat()
+        btrsnap.snap(self.snap_dir, backend=self.backend)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        argv = sys.argv
+        sys.argv = ['btrsnap', '-b', 'sim', 'send', '--progress',
+                    self.snap_dir, self.receive_dir]
+        try:
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                btrsnap.main()
+        finally:
+            sys.argv = argv
+
+        snapshot = os.path.join(self.snap_dir, timestamp + '-0001')
+        self.assertRegex(stdout.getvalue(), r'^1 snapshots copied ')
+        self.assertRegex(stderr.getvalue().splitlines()[-1],
+                         r"^'{}' 0\.1 MB, ".format(snapshot))
+        with open(os.path.join(self.subvolume, 'file'), 'rb') as f:
+            with open(os.path.join(self.receive_dir, timestamp + '-0001',
+                                   'file'), 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+
+class FanoutBackend(ConcurrencyBackend):
+    '''
+    ConcurrencyBackend counting sends that fails receives into BROKEN.
+    '''
+
+    def __init__(self):
+        ConcurrencyBackend.__init__(self)
+        self.sends = 0
+        self.broken = None
+
+    def send(self, snapshot, parent=None, clones=()):
+        self.sends += 1
+        return ConcurrencyBackend.send(self, snapshot, parent, clones)
+
+    def receive(self, path, stream):
+        if path == self.broken:
+            stream.read(10)
+            raise btrsnap.BtrfsError('Receive failed')
+        ConcurrencyBackend.receive(self, path, stream)
+
+
+class Test_sendreceive_fanout(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    receive_dirs = (os.path.join(test_dir, 'first'),
+                    os.path.join(test_dir, 'second'))
+
+    def setUp(self):
+        os.mkdir(self.test_dir)
+        os.mkdir(self.snap_dir)
+        for receive_dir in self.receive_dirs:
+            os.mkdir(receive_dir)
+        self.backend = FanoutBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        with open(os.path.join(self.subvolume, 'file'), 'wb') as f:
+            f.write(os.urandom(3 * btrsnap.PUMP_CHUNK))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def received(self, receive_dir):
+        return btrsnap.ReceivePath(receive_dir).snapshots()
+
+    def test_sendreceive_fanout(self):
+        backend = self.backend
+        for _ in range(2):
+            btrsnap.snap(self.snap_dir, backend=backend)
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dirs,
+                                  backend=backend)
+        self.assertEqual(2, backend.sends)
+        self.assertEqual(2, backend.most)
+        self.assertTrue(msg.endswith('2 stream(s) sent for 4 snapshot(s)'))
+        expected = btrsnap.SnapPath(self.snap_dir).snapshots()
+        with open(os.path.join(self.subvolume, 'file'), 'rb') as f:
+            data = f.read()
+        for receive_dir in self.receive_dirs:
+            self.assertEqual(expected, self.received(receive_dir))
+            for name in expected:
+                with open(os.path.join(receive_dir, name, 'file'),
+                          'rb') as f:
+                    self.assertEqual(data, f.read())
+
+    def test_sendreceive_fanout_different_parents(self):
+        backend = self.backend
+        first, second = self.receive_dirs
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.sendreceive(self.snap_dir, first, backend=backend)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        backend.sends = 0
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dirs,
+                                  backend=backend, dry_run=True)
+        self.assertTrue(msg.endswith(
+            'Would send 2 stream(s) for 3 snapshot(s)'))
+        self.assertEqual(0, backend.sends)
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dirs,
+                                  backend=backend)
+        # the full send only goes to second, the increment to both
+        self.assertEqual(2, backend.sends)
+        self.assertEqual(self.received(first), self.received(second))
+
+    def test_sendreceive_fanout_failure(self):
+        backend = self.backend
+        first, second = self.receive_dirs
+        backend.broken = first
+        for _ in range(2):
+            btrsnap.snap(self.snap_dir, backend=backend)
+
+        with self.assertRaisesRegex(btrsnap.BtrfsError,
+                                    'failed after 0 snapshot'):
+            btrsnap.sendreceive(self.snap_dir, self.receive_dirs,
+                                backend=backend)
+        self.assertEqual(2, len(self.received(second)))
+        self.assertEqual(2, backend.sends)
+
+    def test_sendreceive_deep_fanout(self):
+        backend = self.backend
+        send_dir = os.path.join(self.test_dir, 'send_dir')
+        os.mkdir(send_dir)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        os.rename(self.snap_dir, os.path.join(send_dir, 'data'))
+
+        btrsnap.sendreceive_deep(send_dir, self.receive_dirs,
+                                 backend=backend, jobs=2)
+        self.assertEqual(1, backend.sends)
+        for receive_dir in self.receive_dirs:
+            self.assertEqual(
+                1, len(self.received(os.path.join(receive_dir, 'data'))))
+
+    def test_Pump_tee(self):
+        data = os.urandom(4 * btrsnap.PUMP_CHUNK)
+        read_fd, write_fd = os.pipe()
+        pump = btrsnap.Pump()
+        with os.fdopen(read_fd, 'rb') as source:
+            writer = threading.Thread(target=Test_Pump_Class.write_all,
+                                      args=(write_fd, data))
+            writer.start()
+            streams = pump.tee(source, 3)
+            # a reader that goes away does not stop the others
+            streams[0].close()
+            results = [None] * 3
+
+            def read(number):
+                if number == 2:
+                    time.sleep(0.1)
+                results[number] = streams[number].read()
+
+            threads = [threading.Thread(target=read, args=(number,))
+                       for number in (1, 2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            pump.join()
+            writer.join()
+        self.assertEqual([None, data, data], results)
+        self.assertEqual(len(data), pump.bytes)
+        self.assertIsNone(pump.error)
+        self.assertRaises(Exception, pump.tee, source, 0)
+
+
+class Test_ExportPath_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    export_dir = os.path.join(test_dir, 'export_dir')
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+
+    def setUp(self):
+        for path in (self.test_dir, self.snap_dir, self.export_dir,
+                     self.receive_dir):
+            os.mkdir(path)
+        self.backend = btrsnap.SimulatedBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        self.data = os.urandom(300000)
+        with open(os.path.join(self.subvolume, 'file'), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_export_import(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        msg = btrsnap.export_snaps(self.snap_dir, self.export_dir,
+                                   backend=backend, codec='none',
+                                   chunk_size=100000)
+        self.assertTrue(msg.startswith('2 snapshots exported'))
+        with open(os.path.join(self.subvolume, 'file.new'), 'wb') as f:
+            f.write(b'second')
+        os.replace(os.path.join(self.subvolume, 'file.new'),
+                   os.path.join(self.subvolume, 'file'))
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.export_snaps(self.snap_dir, self.export_dir,
+                             backend=backend, codec='lzma')
+
+        export = btrsnap.ExportPath(self.export_dir)
+        first, second, third = export.read()['snapshots']
+        self.assertIsNone(first['parent'])
+        self.assertEqual(first['name'], second['parent'])
+        self.assertEqual(second['name'], third['parent'])
+        self.assertEqual([first['name']], third['clones'])
+        self.assertEqual(4, len(first['chunks']))
+        self.assertEqual([100000, 100000, 100000],
+                         [chunk['size'] for chunk in first['chunks'][:3]])
+        self.assertEqual('lzma', third['codec'])
+        self.assertEqual(btrsnap.SnapPath(self.snap_dir).snapshots(),
+                         export.snapshots())
+        self.assertTrue(btrsnap.export_snaps(
+            self.snap_dir, self.export_dir,
+            backend=backend).startswith('No new snapshots'))
+
+        msg = btrsnap.import_snaps(self.export_dir, self.receive_dir,
+                                   backend=backend)
+        self.assertTrue(msg.startswith('3 snapshots imported'))
+        for entry, content in ((first, self.data), (third, b'second')):
+            with open(os.path.join(self.receive_dir, entry['name'],
+                                   'file'), 'rb') as f:
+                self.assertEqual(content, f.read())
+        received = backend.show(os.path.join(self.receive_dir,
+                                             third['name']))
+        sent = backend.show(os.path.join(self.snap_dir, third['name']))
+        self.assertEqual(sent['uuid'], received['received_uuid'])
+
+    def test_import_missing_parent(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.export_snaps(self.snap_dir, self.export_dir, backend=backend)
+        export = btrsnap.ExportPath(self.export_dir)
+        data = export.read()
+        data['snapshots'] = data['snapshots'][1:]
+        export._save(data)
+
+        self.assertRaisesRegex(btrsnap.BtrfsError, 'not in',
+                               btrsnap.import_snaps, self.export_dir,
+                               self.receive_dir, backend=backend)
+
+    def test_import_corrupt_chunk(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.export_snaps(self.snap_dir, self.export_dir, backend=backend)
+        entry = btrsnap.ExportPath(self.export_dir).read()['snapshots'][0]
+        chunk = os.path.join(self.export_dir, entry['chunks'][-1]['file'])
+        with open(chunk, 'r+b') as f:
+            f.truncate(entry['chunks'][-1]['size'] - 10)
+
+        self.assertRaisesRegex(btrsnap.BtrfsError, 'should hold',
+                               btrsnap.import_snaps, self.export_dir,
+                               self.receive_dir, backend=backend)
+
+    def test_replay_checks_chunks_first(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.export_snaps(self.snap_dir, self.export_dir, backend=backend,
+                             codec='none', chunk_size=100000)
+        export = btrsnap.ExportPath(self.export_dir)
+        entry = export.read()['snapshots'][0]
+        chunk = os.path.join(self.export_dir, entry['chunks'][1]['file'])
+        with open(chunk, 'r+b') as f:
+            byte = f.read(1)
+            f.seek(0)
+            f.write(bytes([byte[0] ^ 1]))
+
+        out = io.BytesIO()
+        self.assertRaisesRegex(Exception, 'does not match its checksum',
+                               export.replay, out, entry)
+        # only the intact first chunk reached OUT
+        self.assertEqual(100000, len(out.getvalue()))
+
+    def test_decompress_bounded(self):
+        data = bytes(5 * btrsnap.PUMP_CHUNK + 17)
+        for codec in ('zlib', 'lzma', 'none'):
+            compressor, decompressor = btrsnap.get_codec(codec)
+            compressor = compressor(None)
+            block = compressor.compress(data) + compressor.flush()
+            decompressor = decompressor()
+            pieces = list(btrsnap._decompress(decompressor, block))
+            self.assertEqual(data, b''.join(pieces))
+            self.assertTrue(decompressor.eof)
+            if codec != 'none':
+                self.assertLess(len(block), btrsnap.PUMP_CHUNK)
+                self.assertTrue(all(len(piece) <= btrsnap.PUMP_CHUNK
+                                    for piece in pieces))
+
+    def test_export_leftovers(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        name = btrsnap.SnapPath(self.snap_dir).snapshots()[0].name
+        # left behind by an interrupted export
+        for leftover in ('{}.0007.zlib', '{}.0000.lzma'):
+            open(os.path.join(self.export_dir, leftover.format(name)),
+                 'w').close()
+        btrsnap.export_snaps(self.snap_dir, self.export_dir, backend=backend)
+
+        self.assertEqual(['{}.0000.zlib'.format(name),
+                          btrsnap.EXPORT_MANIFEST],
+                         sorted(os.listdir(self.export_dir)))
+
+    def test_export_errors(self):
+        self.assertRaises(Exception, btrsnap.get_codec, 'missing')
+        self.assertRaises(Exception, btrsnap.export_snaps, self.snap_dir,
+                          self.export_dir, codec='missing')
+        with open(os.path.join(self.export_dir, btrsnap.EXPORT_MANIFEST),
+                  'w') as f:
+            f.write('{"version": 0}')
+        self.assertRaises(Exception, btrsnap.ExportPath(
+            self.export_dir).read)
+
+
+class BrokenStream:
+    '''
+    A stream that fails after LIMIT bytes, like a dropped connection.
+    '''
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+
+    def _count(self, data):
+        self.limit -= len(data)
+        if self.limit < 0:
+            raise OSError(errno.ECONNRESET, 'Connection reset')
+        return data
+
+    def read(self, size=-1):
+        return self._count(self.stream.read(size))
+
+    def readline(self):
+        return self._count(self.stream.readline())
+
+
+class Test_sendreceive_resumable(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snap_dir = os.path.join(test_dir, 'snap_dir')
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+
+    def setUp(self):
+        for path in (self.test_dir, self.snap_dir, self.receive_dir):
+            os.mkdir(path)
+        self.backend = FanoutBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        self.data = os.urandom(300000)
+        with open(os.path.join(self.subvolume, 'file'), 'wb') as f:
+            f.write(self.data)
+        self.chunk_size = btrsnap.SPOOL_CHUNK_SIZE
+        btrsnap.SPOOL_CHUNK_SIZE = 100000
+
+    def tearDown(self):
+        btrsnap.SPOOL_CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.test_dir)
+
+    def interrupted(self):
+        backend = self.backend
+        receive = backend.receive
+        backend.receive = lambda path, stream: receive(
+            path, BrokenStream(stream, 200000))
+        try:
+            self.assertRaises(btrsnap.BtrfsError, btrsnap.sendreceive,
+                              self.snap_dir, self.receive_dir,
+                              backend=backend, resumable=True)
+        finally:
+            del backend.receive
+        self.assertEqual(1, backend.sends)
+        backend.sends = 0
+
+    def test_sendreceive_resumable(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        name = btrsnap.SnapPath(self.snap_dir).snapshots()[0].name
+        self.interrupted()
+        partial = os.path.join(self.receive_dir, name)
+        self.assertFalse(backend.show(partial)['readonly'])
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dir,
+                                  backend=backend, resumable=True)
+        self.assertEqual(0, backend.sends)
+        self.assertTrue(msg.endswith('Spooled 0 chunk(s), copied 0 and'
+                                     ' reused 4. Deleted 1 partial'
+                                     ' receive(s)'))
+        info = backend.show(partial)
+        self.assertTrue(info['readonly'])
+        self.assertIsNotNone(info['received_uuid'])
+        with open(os.path.join(partial, 'file'), 'rb') as f:
+            self.assertEqual(self.data, f.read())
+        for path in (self.snap_dir, self.receive_dir):
+            spool = btrsnap.ExportPath(os.path.join(path, btrsnap.SPOOL_DIR))
+            self.assertEqual([], spool.read()['snapshots'])
+            self.assertEqual([btrsnap.EXPORT_MANIFEST],
+                             os.listdir(spool.path))
+
+    def test_sendreceive_resumable_unstaged(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        self.interrupted()
+        btrsnap.snap(self.snap_dir, backend=backend)
+        older, newer = sorted(btrsnap.SnapPath(self.snap_dir).snapshots(),
+                              key=btrsnap.SNAPSHOT_SORT_KEY)
+        # writable snapshots btrsnap was not receiving
+        for name in ('2000-01-01-0001', newer.name):
+            backend.snap(self.subvolume, os.path.join(self.receive_dir, name),
+                         readonly=False)
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dir,
+                                  backend=backend, resumable=True)
+        self.assertIn('1 snapshots copied', msg)
+        self.assertIn('Deleted 1 partial receive(s)', msg)
+        self.assertIn('Skipped 1 snapshot(s) in \'{}\' that were not fully'
+                      ' received: {}'.format(self.receive_dir, newer.name),
+                      msg)
+        self.assertIsNotNone(backend.show(os.path.join(
+            self.receive_dir, older.name))['received_uuid'])
+        for name in ('2000-01-01-0001', newer.name):
+            info = backend.show(os.path.join(self.receive_dir, name))
+            self.assertFalse(info['readonly'])
+            self.assertIsNone(info['received_uuid'])
+
+    def test_sendreceive_resumable_damaged_chunk(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        self.interrupted()
+        stage = btrsnap.ExportPath(os.path.join(self.receive_dir,
+                                                btrsnap.SPOOL_DIR))
+        chunk = stage.read()['snapshots'][0]['chunks'][1]
+        with open(os.path.join(stage.path, chunk['file']), 'r+b') as f:
+            f.write(b'damaged')
+        os.unlink(os.path.join(stage.path,
+                               stage.read()['snapshots'][0]['chunks'][2][
+                                   'file']))
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dir,
+                                  backend=backend, resumable=True)
+        self.assertEqual(0, backend.sends)
+        self.assertIn('copied 2 and reused 2', msg)
+
+
+class Test_verify(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    send_dir = os.path.join(test_dir, 'send_dir')
+    snap_dir = os.path.join(send_dir, 'data')
+    receive_dirs = (os.path.join(test_dir, 'first'),
+                    os.path.join(test_dir, 'second'))
+
+    def setUp(self):
+        for path in (self.test_dir, self.send_dir, self.snap_dir) + \
+                self.receive_dirs:
+            os.mkdir(path)
+        self.backend = FanoutBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        with open(os.path.join(self.subvolume, 'file'), 'wb') as f:
+            f.write(os.urandom(2 * btrsnap.PUMP_CHUNK))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_sendreceive_checksum(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        name = btrsnap.SnapPath(self.snap_dir).snapshots()[0].name
+
+        msg = btrsnap.sendreceive(self.snap_dir, self.receive_dirs,
+                                  backend=backend, checksum='sha256')
+        self.assertEqual(1, backend.sends)
+        self.assertIn('Recorded sha256 checksums of 2 received stream(s)',
+                      msg)
+        stream = io.BytesIO()
+        backend.stream(stream, os.path.join(self.snap_dir, name))
+        sent = btrsnap.ChecksumManifest(self.snap_dir).read()['snapshots']
+        self.assertEqual(1, len(sent[name]))
+        self.assertEqual(hashlib.sha256(stream.getvalue()).hexdigest(),
+                         sent[name][0]['digest'])
+        self.assertEqual(len(stream.getvalue()), sent[name][0]['bytes'])
+        for receive_dir in self.receive_dirs:
+            received = btrsnap.ChecksumManifest(receive_dir).read()
+            self.assertEqual(sent, received['snapshots'])
+            self.assertIn('Verified 1 snapshot(s)', btrsnap.verify(
+                self.snap_dir, receive_dir))
+
+    def test_verify(self):
+        backend = self.backend
+        receive_dir = self.receive_dirs[0]
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.sendreceive(self.snap_dir, receive_dir, backend=backend)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.sendreceive(self.snap_dir, receive_dir, backend=backend,
+                            checksum='sha256')
+        self.assertTrue(btrsnap.verify(self.snap_dir, receive_dir).endswith(
+            'Verified 1 snapshot(s) in \'{}\' against \'{}\': 1'
+            ' unverified, 0 not recorded by the sender, 0'
+            ' mismatched'.format(receive_dir, self.snap_dir)))
+
+        manifest = btrsnap.ChecksumManifest(receive_dir)
+        name, streams = manifest.read()['snapshots'].popitem()
+        manifest.record(name, dict(streams[0], digest='0' * 64),
+                        replace=True)
+        self.assertRaisesRegex(Exception, '{}: checksum mismatch'.format(
+            name), btrsnap.verify, self.snap_dir, receive_dir)
+        self.assertRaises(Exception, btrsnap.sendreceive, self.snap_dir,
+                          receive_dir, backend=backend, via='sh -c',
+                          checksum='sha256')
+
+    def test_ChecksumManifest_prune(self):
+        backend = self.backend
+        receive_dir = self.receive_dirs[0]
+        for _ in range(2):
+            btrsnap.snap(self.snap_dir, backend=backend)
+            btrsnap.sendreceive(self.snap_dir, receive_dir, backend=backend,
+                                checksum='sha256')
+        older, newer = sorted(btrsnap.SnapPath(self.snap_dir).snapshots(),
+                              key=btrsnap.SNAPSHOT_SORT_KEY)
+        btrsnap.unsnap(self.snap_dir, keep=1, backend=backend)
+        btrsnap.unsnap(receive_dir, keep=1, backend=backend)
+        for path in (self.snap_dir, receive_dir):
+            self.assertEqual([older.name, newer.name], sorted(
+                btrsnap.ChecksumManifest(path).read()['snapshots']))
+
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.sendreceive(self.snap_dir, receive_dir, backend=backend,
+                            checksum='sha256')
+        # the records of deleted snapshots go with the next change
+        for path in (self.snap_dir, receive_dir):
+            snapshots = btrsnap.ChecksumManifest(path).read()['snapshots']
+            self.assertNotIn(older.name, snapshots)
+            self.assertIn(newer.name, snapshots)
+            self.assertEqual(2, len(snapshots))
+
+    def test_sendreceive_deep_checksum(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.sendreceive_deep(self.send_dir, self.receive_dirs[0],
+                                 backend=backend, jobs=2,
+                                 checksum='sha256')
+        receive_dir = os.path.join(self.receive_dirs[0], 'data')
+        msg = btrsnap.verify_deep(self.send_dir, self.receive_dirs[0])
+        self.assertIn('Verified 1 snapshot(s) in \'{}\''.format(
+            receive_dir), msg)
+
+        manifest = btrsnap.ChecksumManifest(receive_dir)
+        name, streams = manifest.read()['snapshots'].popitem()
+        manifest.record(name, dict(streams[0], bytes=1), replace=True)
+        self.assertRaisesRegex(Exception, 'mismatch', btrsnap.verify_deep,
+                               self.send_dir, self.receive_dirs[0])
+
+
+class ScanBackend(FanoutBackend):
+    '''
+    FanoutBackend counting list_filesystem calls.
+    '''
+
+    def __init__(self):
+        FanoutBackend.__init__(self)
+        self.scans = []
+
+    def list_filesystem(self, paths):
+        self.scans.append(sorted(paths))
+        return FanoutBackend.list_filesystem(self, paths)
+
+
+class MountedProgsBackend(btrsnap.ProgsBackend):
+    '''
+    ProgsBackend on the mount table MOUNTINFO, answering every btrfs
+    command with OUTPUT and remembering the commands.
+    '''
+
+    def __init__(self, mountinfo, output):
+        self.mounts = btrsnap._mounts(mountinfo)
+        self.output = output
+        self.commands = []
+
+    def _resolve(self, paths):
+        return list(paths)
+
+    def _mount_table(self):
+        return self.mounts
+
+    def _output(self, args):
+        self.commands.append(args)
+        return self.output
+
+
+class Test_ReceiveScan_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    send_dir = os.path.join(test_dir, 'send_dir')
+    snap_dirs = (os.path.join(send_dir, 'first'),
+                 os.path.join(send_dir, 'second'))
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+
+    def setUp(self):
+        for path in (self.test_dir, self.send_dir, self.receive_dir):
+            os.mkdir(path)
+        self.backend = ScanBackend()
+        self.backend.create(self.subvolume)
+        for snap_dir in self.snap_dirs:
+            os.mkdir(snap_dir)
+            os.symlink(self.subvolume, os.path.join(snap_dir, 'target'))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_ReceiveScan(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dirs[0], backend=backend)
+        receive = os.path.join(self.receive_dir, 'first')
+        os.mkdir(receive)
+        btrsnap.sendreceive(self.snap_dirs[0], receive, backend=backend)
+        name = btrsnap.SnapPath(self.snap_dirs[0]).snapshots()[0].name
+        backend.snap(self.subvolume, os.path.join(receive, '2000-01-01-0001'),
+                     readonly=False)
+        missing = os.path.join(self.receive_dir, 'missing')
+
+        scan = btrsnap.ReceiveScan([receive, missing], backend=backend)
+        self.assertEqual([[receive]], backend.scans)
+        self.assertEqual(1, scan.scans)
+        self.assertEqual([name], [snapshot.name
+                                  for snapshot in scan.snapshots(receive)])
+        self.assertEqual(['2000-01-01-0001'], scan.unreceived(receive))
+        self.assertEqual([], scan.snapshots(missing))
+        received = backend.show(os.path.join(receive, name))['received_uuid']
+        self.assertEqual(os.path.join(receive, name),
+                         scan.find(receive, received)['path'])
+        scan.forget(receive, [name])
+        self.assertEqual([], scan.snapshots(receive))
+        self.assertIsNone(scan.find(receive, received))
+
+    def test_ReceiveScan_ignore_invalid_dates(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dirs[0], backend=backend)
+        btrsnap.sendreceive(self.snap_dirs[0], self.receive_dir,
+                            backend=backend)
+        name = btrsnap.SnapPath(self.snap_dirs[0]).snapshots()[0].name
+        os.rename(os.path.join(self.receive_dir, name),
+                  os.path.join(self.receive_dir, '2020-13-45-0001'))
+        backend.snap(self.subvolume,
+                     os.path.join(self.receive_dir, '2020-02-30-0001'),
+                     readonly=False)
+
+        scan = btrsnap.ReceiveScan([self.receive_dir], backend=backend)
+        self.assertEqual([], scan.snapshots(self.receive_dir))
+        self.assertEqual([], scan.unreceived(self.receive_dir))
+        msg = btrsnap.sendreceive(self.snap_dirs[0], self.receive_dir,
+                                  backend=backend, scan=True)
+        self.assertTrue(msg.startswith('No new snapshots to copy'))
+
+    def test_sendreceive_scan_partial(self):
+        backend = self.backend
+        for _ in range(2):
+            btrsnap.snap(self.snap_dirs[0], backend=backend)
+        older, newer = sorted(btrsnap.SnapPath(self.snap_dirs[0]).snapshots(),
+                              key=btrsnap.SNAPSHOT_SORT_KEY)
+        # left behind by an interrupted receive
+        backend.snap(self.subvolume,
+                     os.path.join(self.receive_dir, older.name),
+                     readonly=False)
+
+        msg = btrsnap.sendreceive(self.snap_dirs[0], self.receive_dir,
+                                  backend=backend, scan=True)
+        self.assertEqual(1, backend.sends)
+        self.assertIn('1 snapshots copied', msg)
+        self.assertTrue(msg.endswith(
+            'Skipped 1 snapshot(s) in \'{}\' that were not fully received:'
+            ' {}'.format(self.receive_dir, older.name)))
+        self.assertIsNotNone(backend.show(os.path.join(
+            self.receive_dir, newer.name))['received_uuid'])
+        self.assertIsNone(backend.show(os.path.join(
+            self.receive_dir, older.name))['received_uuid'])
+
+        # not staged by a resumable send, so it is not deleted either
+        msg = btrsnap.sendreceive(self.snap_dirs[0], self.receive_dir,
+                                  backend=backend, scan=True, resumable=True)
+        self.assertEqual(1, backend.sends)
+        self.assertIn('Skipped 1 snapshot(s)', msg)
+        self.assertIsNone(backend.show(os.path.join(
+            self.receive_dir, older.name))['received_uuid'])
+
+    def test_sendreceive_scan_renamed(self):
+        backend = self.backend
+        snap_dir = self.snap_dirs[0]
+        btrsnap.snap(snap_dir, backend=backend)
+        btrsnap.sendreceive(snap_dir, self.receive_dir, backend=backend)
+        first = btrsnap.SnapPath(snap_dir).snapshots()[0].name
+        os.rename(os.path.join(self.receive_dir, first),
+                  os.path.join(self.receive_dir, 'renamed'))
+        btrsnap.snap(snap_dir, backend=backend)
+        second = btrsnap.SnapPath(snap_dir).snapshots()[0].name
+        backend.sends = 0
+
+        msg = btrsnap.sendreceive(snap_dir, self.receive_dir,
+                                  backend=backend, scan=True, dry_run=True)
+        self.assertIn('Would copy 1 snapshot(s)', msg)
+        self.assertIn('{}: from {}'.format(second, first), msg)
+        btrsnap.sendreceive(snap_dir, self.receive_dir, backend=backend,
+                            scan=True)
+        self.assertEqual(1, backend.sends)
+        self.assertEqual(
+            backend.show(os.path.join(self.receive_dir, 'renamed'))['uuid'],
+            backend.show(os.path.join(self.receive_dir,
+                                      second))['parent_uuid'])
+
+    def test_sendreceive_scan_relocated(self):
+        backend = self.backend
+        snap_dir = self.snap_dirs[0]
+        old = os.path.join(self.receive_dir, 'old')
+        new = os.path.join(self.receive_dir, 'new')
+        for path in (old, new):
+            os.mkdir(path)
+        for _ in range(2):
+            btrsnap.snap(snap_dir, backend=backend)
+        first, second = sorted(btrsnap.SnapPath(snap_dir).snapshots(),
+                               key=btrsnap.SNAPSHOT_SORT_KEY)
+        btrsnap.Btrfs(old, backend=backend).receive(
+            btrsnap.Btrfs(snap_dir, backend=backend).send(second))
+
+        # without UUIDs the oldest snapshot is sent in full
+        msg = btrsnap.sendreceive(snap_dir, new, backend=backend,
+                                  dry_run=True)
+        self.assertIn('{}: full'.format(first), msg)
+        msg = btrsnap.sendreceive(snap_dir, new, backend=backend,
+                                  scan=True, dry_run=True)
+        self.assertIn('{}: from {}'.format(first, second), msg)
+        self.assertIn('Matched 1 parent(s) and clone source(s) for \'{}\''
+                      ' by UUID elsewhere on its filesystem: {}'.format(
+                          new, second), msg)
+
+        btrsnap.sendreceive(snap_dir, new, backend=backend, scan=True)
+        self.assertEqual(
+            backend.show(os.path.join(old, second.name))['uuid'],
+            backend.show(os.path.join(new, first.name))['parent_uuid'])
+        self.assertEqual([second, first],
+                         btrsnap.ReceivePath(new).snapshots())
+
+    def test_sendreceive_deep_scan(self):
+        backend = self.backend
+        for snap_dir in self.snap_dirs:
+            btrsnap.snap(snap_dir, backend=backend)
+        other = os.path.join(self.test_dir, 'other')
+        os.mkdir(other)
+
+        msg = btrsnap.sendreceive_deep(self.send_dir,
+                                       [self.receive_dir, other],
+                                       backend=backend, jobs=2, scan=True)
+        # both destinations are on the same filesystem
+        self.assertEqual(1, len(backend.scans))
+        self.assertEqual(4, len(backend.scans[0]))
+        self.assertIn('Listed 4 receive path(s) with 1 scan(s)', msg)
+        for root in (self.receive_dir, other):
+            for snap_dir in self.snap_dirs:
+                self.assertEqual(
+                    btrsnap.SnapPath(snap_dir).snapshots(),
+                    btrsnap.ReceivePath(os.path.join(
+                        root, os.path.basename(snap_dir))).snapshots())
+
+        msg = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                       backend=backend, scan=True)
+        self.assertEqual(2, msg.count('No new snapshots'))
+
+    def test_ProgsBackend_list_filesystem(self):
+        btrfs = btrsnap.ProgsBackend()
+        receives = [os.path.join(self.receive_dir, name)
+                    for name in ('first', 'second')]
+        for receive in receives:
+            os.mkdir(receive)
+            for name in ('2000-01-01-0001', '2000-01-01-0002'):
+                self.backend.snap(self.subvolume, os.path.join(receive, name))
+        other = os.path.join(self.receive_dir, 'other')
+        self.backend.create(other)
+        try:
+            listing, subvolumes = btrfs.list_filesystem(receives)
+        except (OSError, btrsnap.BtrfsError):
+            self.skipTest('btrfs is not available')
+        self.assertEqual(sorted(receives), sorted(listing))
+        for receive in receives:
+            self.assertEqual(
+                sorted(subvolume['path'] for subvolume in btrfs.list(receive)),
+                sorted(subvolume['path'] for subvolume in listing[receive]))
+            self.assertEqual(2, len(listing[receive]))
+        # subvolumes outside the listed paths are seen too, the simulated
+        # btrfs only lists those below the parent of the first path
+        self.assertIn(os.path.realpath(other),
+                      [subvolume['path'] for subvolume in subvolumes])
+
+    def test_ProgsBackend_list_filesystem_mounts(self):
+        # one filesystem mounted twice, the root is another filesystem
+        backend = MountedProgsBackend(
+            '1 0 8:1 / / rw - ext4 /dev/sda1 rw\n'
+            '2 1 0:40 /vol /mnt/a rw - btrfs /dev/sdb rw\n'
+            '3 1 0:40 /vol/b /srv/b rw - btrfs /dev/sdb rw\n',
+            'ID 256 gen 9 top level 5 parent_uuid - received_uuid r1 uuid u1'
+            ' path vol/x/2000-01-01-0001\n'
+            'ID 257 gen 9 top level 5 parent_uuid - received_uuid r2 uuid u2'
+            ' path vol/b/y/2000-01-01-0001\n'
+            'ID 258 gen 9 top level 5 parent_uuid - received_uuid - uuid u3'
+            ' path other/z\n')
+
+        listing, subvolumes = backend.list_filesystem(['/mnt/a/x',
+                                                       '/srv/b/y'])
+        self.assertEqual([['btrfs', 'subvolume', 'list', '-q', '-R', '-u',
+                           '/mnt/a/x']], backend.commands)
+        self.assertEqual(['/mnt/a/x/2000-01-01-0001'],
+                         [subvolume['path']
+                          for subvolume in listing['/mnt/a/x']])
+        self.assertEqual(['/srv/b/y/2000-01-01-0001'],
+                         [subvolume['path']
+                          for subvolume in listing['/srv/b/y']])
+        self.assertEqual(['/mnt/a/x/2000-01-01-0001',
+                          '/mnt/a/b/y/2000-01-01-0001', None],
+                         [subvolume['path'] for subvolume in subvolumes])
+
+
+class Test_Transport_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    send_dir = os.path.join(test_dir, 'send_dir')
+    snap_dir = os.path.join(send_dir, 'data')
+    receive_dir = os.path.join(test_dir, 'receive_dir')
+    bin_dir = os.path.join(test_dir, 'bin')
+    log = os.path.join(test_dir, 'log')
+
+    def setUp(self):
+        for path in (self.test_dir, self.send_dir, self.snap_dir,
+                     self.receive_dir, self.bin_dir):
+            os.mkdir(path)
+        self.backend = btrsnap.SimulatedBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        # stand-ins for btrfs and for a remote shell
+        write_btrfs_stand_in(self.bin_dir)
+        with open(os.path.join(self.bin_dir, 'remote'), 'w') as f:
+            f.write('#!/bin/sh\necho "$1" >> "{}"\nPATH="{}:$PATH" exec sh'
+                    ' -c "$1"\n'.format(self.log, self.bin_dir))
+        os.chmod(os.path.join(self.bin_dir, 'remote'), 0o755)
+        self.via = os.path.join(self.bin_dir, 'remote')
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def commands(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_Transport_ssh(self):
+        transport = btrsnap.Transport('ssh -p 2222 host')
+        args = transport.args(['btrfs', 'receive', '/backup/a b'])
+        self.assertEqual(['ssh', '-o', 'ControlMaster=auto'], args[:3])
+        self.assertEqual('-o', args[3])
+        self.assertTrue(args[4].startswith('ControlPath='))
+        self.assertEqual(['-o', 'ControlPersist={}'.format(
+            btrsnap.TRANSPORT_PERSIST_SECONDS), '-p', '2222', 'host',
+            "btrfs receive '/backup/a b'"], args[5:])
+        # every command shares the master connection
+        self.assertEqual(args[:-1], transport.args(['ls'])[:-1])
+        self.assertEqual(2, transport.commands)
+        control = os.path.dirname(args[4].partition('=')[2])
+        self.assertTrue(os.path.isdir(control))
+        transport.close()
+        self.assertFalse(os.path.exists(control))
+        self.assertRaises(Exception, btrsnap.Transport, ' ')
+
+    def test_sendreceive_deep_via(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        btrsnap.snap(self.snap_dir, backend=backend)
+        remote = os.path.join(self.receive_dir, 'data')
+
+        with btrsnap.Transport(self.via) as transport:
+            btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                     backend=backend, jobs=2, via=transport)
+            # one mkdir, one listing and a receive per snapshot
+            commands = self.commands()
+            self.assertEqual(4, transport.commands)
+            self.assertEqual(4, len(commands))
+            self.assertTrue(commands[0].startswith('mkdir -p'))
+            self.assertTrue(commands[1].startswith('ls '))
+            self.assertTrue(all(command.startswith('btrfs receive')
+                                for command in commands[2:]))
+            self.assertEqual(btrsnap.SnapPath(self.snap_dir).snapshots(),
+                             transport.snapshots(remote))
+            received = btrsnap.RemoteBackend(transport).list(remote)
+        self.assertEqual(sorted(os.path.join(remote, name) for name
+                                in btrsnap.ReceivePath(remote).snapshots()),
+                         sorted(subvolume['path'] for subvolume in received))
+        self.assertTrue(all(subvolume['received_uuid'] is not None
+                            for subvolume in received))
+
+        msg = btrsnap.sendreceive(self.snap_dir, remote, backend=backend,
+                                  via=self.via)
+        self.assertTrue(msg.startswith('No new snapshots'))
+
+    def test_sendreceive_deep_via_scan(self):
+        backend = self.backend
+        btrsnap.snap(self.snap_dir, backend=backend)
+        os.mkdir(os.path.join(self.send_dir, 'more'))
+        os.symlink(self.subvolume,
+                   os.path.join(self.send_dir, 'more', 'target'))
+        btrsnap.snap(os.path.join(self.send_dir, 'more'), backend=backend)
+
+        msg = btrsnap.sendreceive_deep(self.send_dir, self.receive_dir,
+                                       backend=backend, via=self.via,
+                                       scan=True)
+        self.assertIn('Listed 2 receive path(s) with 1 scan(s)', msg)
+        commands = self.commands()
+        self.assertEqual(1, sum(command.startswith('btrfs subvolume list')
+                                for command in commands))
+        self.assertFalse(any(command.startswith('ls ')
+                             for command in commands))
+        for name in ('data', 'more'):
+            self.assertEqual(
+                btrsnap.SnapPath(os.path.join(self.send_dir,
+                                              name)).snapshots(),
+                btrsnap.ReceivePath(os.path.join(self.receive_dir,
+                                                 name)).snapshots())
+
+    def test_Transport_snapshots_ignore_invalid_dates(self):
+        btrsnap.snap(self.snap_dir, backend=self.backend)
+        remote = os.path.join(self.receive_dir, 'data')
+        os.mkdir(remote)
+        for name in ('2020-13-45-0001', '2020-02-30-000001'):
+            os.mkdir(os.path.join(remote, name))
+
+        with btrsnap.Transport(self.via) as transport:
+            self.assertEqual([], transport.snapshots(remote))
+        msg = btrsnap.sendreceive(self.snap_dir, remote, backend=self.backend,
+                                  via=self.via)
+        self.assertIn('1 snapshots copied', msg)
+        self.assertEqual(btrsnap.SnapPath(self.snap_dir).snapshots(),
+                         btrsnap.ReceivePath(remote).snapshots())
+
+    def test_sendreceive_via_errors(self):
+        btrsnap.snap(self.snap_dir, backend=self.backend)
+        missing = os.path.join(self.receive_dir, 'missing')
+        self.assertRaises(btrsnap.PathError, btrsnap.sendreceive,
+                          self.snap_dir, missing, backend=self.backend,
+                          via=self.via)
+        self.assertIn('Would copy 1', btrsnap.sendreceive(
+            self.snap_dir, missing, backend=self.backend, via=self.via,
+            dry_run=True))
+        self.assertRaises(Exception, btrsnap.sendreceive, self.snap_dir,
+                          self.receive_dir, backend=self.backend,
+                          via=self.via, resumable=True)
+
+
+class Test_Daemon_Class(unittest.TestCase):
+    test_dir = get_test_dir()
+    subvolume = os.path.join(test_dir, 'subvolume')
+    snaps_dir = os.path.join(test_dir, 'snaps')
+    snap_dir = os.path.join(snaps_dir, 'data')
+    backup_dir = os.path.join(test_dir, 'backup')
+    schedule_file = os.path.join(test_dir, 'schedule.json')
+
+    def setUp(self):
+        for path in (self.test_dir, self.snaps_dir, self.snap_dir,
+                     self.backup_dir):
+            os.mkdir(path)
+        self.backend = btrsnap.SimulatedBackend()
+        self.backend.create(self.subvolume)
+        os.symlink(self.subvolume, os.path.join(self.snap_dir, 'target'))
+        self.lines = []
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def schedule(self, **job):
+        job = dict({'name': 'data', 'path': self.snaps_dir,
+                    'recursive': True, 'snap_every': 60,
+                    'resolution': 'microsecond', 'keep': 2,
+                    'send_to': self.backup_dir, 'send_every': 600}, **job)
+        with open(self.schedule_file, 'w') as f:
+            json.dump({'jitter': 0, 'jobs': [job]}, f)
+        return btrsnap.Schedule(self.schedule_file)
+
+    def daemon(self, **job):
+        return btrsnap.Daemon(self.schedule(**job), backend=self.backend,
+                              log=self.lines.append)
+
+    def test_Schedule(self):
+        schedule = self.schedule(daily=7, max_age='90d')
+        self.assertEqual(self.schedule_file + '.sock', schedule.socket)
+        job = schedule.jobs[0]
+        self.assertEqual([self.backup_dir], job['send_to'])
+        self.assertEqual('keep 2, daily 7, max age 90 days, 0:00:00',
+                         str(job['policy']))
+        self.assertIsNone(self.schedule(keep=3).jobs[0]['policy'])
+
+        for job in ({'snap_every': 0}, {'send_every': None},
+                    {'resolution': 'hour'}, {'keep': -1}, {'daily': 'x'},
+                    {'max_age': '2s'}, {'colour': 'blue'},
+                    {'hourly': 24, 'resolution': 'day'},
+                    {'snap_every': None, 'send_to': None,
+                     'send_every': None}):
+            self.assertRaises(Exception, self.schedule, **job)
+        with open(self.schedule_file, 'w') as f:
+            f.write('{"jobs": [{"path": "/a"}, ')
+        self.assertRaises(Exception, btrsnap.Schedule, self.schedule_file)
+
+    def test_Daemon_run_pending(self):
+        daemon = self.daemon()
+        self.assertEqual(['data/send', 'data/snap'], sorted(daemon.tasks))
+        for task in daemon.tasks.values():
+            task['due'] = time.monotonic() + 3600
+        for run in range(3):
+            # a snapshot and then a send, one at a time
+            for name in ('data/snap', 'data/send'):
+                task = daemon.tasks[name]
+                task['due'] = task['nominal'] = time.monotonic()
+                self.assertGreater(daemon.run_pending(), 59)
+                daemon.wait()
+
+        status = daemon.status()
+        self.assertEqual(3, status['data/snap']['runs'])
+        self.assertTrue(status['data/snap']['last']['ok'])
+        self.assertGreater(status['data/send']['next'], 599)
+        self.assertEqual(2, len(btrsnap.ReceivePath(
+            self.snap_dir).snapshots()))
+        # every snapshot was sent before retention deleted it
+        self.assertEqual(3, len(btrsnap.ReceivePath(
+            os.path.join(self.backup_dir, 'data')).snapshots()))
+        self.assertTrue(os.path.isfile(os.path.join(self.snaps_dir,
+                                                    btrsnap.INDEX_FILE)))
+        self.assertTrue(any('data/snap: Deleted 1 snapshot(s)' in line
+                            for line in self.lines))
+
+    def test_Daemon_overlap(self):
+        daemon = self.daemon(send_to=None, send_every=None)
+        task = daemon.tasks['data/snap']
+        start = time.monotonic()
+        task['nominal'] = start - 150
+        task['due'] = start - 1
+        task['running'] = True
+        daemon.run_pending()
+
+        self.assertEqual(1, task['skipped'])
+        self.assertEqual(0, task['runs'])
+        # the next run is the next one on the grid, not 60s from now
+        self.assertAlmostEqual(start + 30, task['due'], delta=1)
+        self.assertEqual([], btrsnap.ReceivePath(self.snap_dir).snapshots())
+        self.assertIn('skipped', self.lines[0])
+        self.assertRaises(Exception, daemon.trigger, 'data/send')
+
+    def test_Daemon_serve(self):
+        daemon = self.daemon(snap_every=3600, send_to=None, send_every=None)
+        socket_path = self.schedule_file + '.sock'
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        try:
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.01)
+            reply = btrsnap.control(socket_path, 'status')
+            self.assertTrue(reply['ok'])
+            self.assertEqual(['data/snap'], list(reply['tasks']))
+            self.assertRaises(Exception, btrsnap.Daemon(
+                daemon.schedule, backend=self.backend)._listen)
+
+            runs = daemon.status()['data/snap']['runs']
+            self.assertEqual('Started \'data/snap\'', btrsnap.daemon_run(
+                self.schedule_file, 'data/snap'))
+            for _ in range(100):
+                if daemon.status()['data/snap']['runs'] > runs:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(runs + 1, daemon.status()['data/snap']['runs'])
+            status = btrsnap.daemon_status(self.schedule_file)
+            self.assertIn('data/snap: next in', status)
+            self.assertIn('{} run(s), 0 skipped. Last ok at'.format(
+                runs + 1), status)
+            reply = btrsnap.control(socket_path, 'run', 'nope')
+            self.assertFalse(reply['ok'])
+        finally:
+            daemon.stop()
+            thread.join()
+        self.assertFalse(os.path.exists(socket_path))
+        self.assertRaises(Exception, btrsnap.daemon_status,
+                          self.schedule_file)
+
+
 class Test_Btrfs_Class(unittest.TestCase):
     test_dir = get_test_dir()
     snap_dir = os.path.join(test_dir, 'snap_dir')
@@ -470,6 +3104,37 @@ class Test_functions_(unittest.TestCase):
         # cleanup
         subprocess.call(['btrfs', 'subvolume', 'delete', first])
 
+    def test_snapdeep_parallel(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        first = os.path.join(snap_dir, timestamp + '-0001')
+
+        output = btrsnap.snapdeep(test_dir, readonly=False, jobs=2)
+        self.assertTrue(os.path.isdir(first))
+        self.assertIn(snap_dir, output)
+        self.assertIn('0 failed', output)
+
+        # cleanup
+        subprocess.call(['btrfs', 'subvolume', 'delete', first])
+
+    def test_snapdeep_consistent(self):
+        test_dir = self.test_dir
+        snap_dir = self.snap_dir
+        today = datetime.date.today()
+        timestamp = today.isoformat()
+        first = os.path.join(snap_dir, timestamp + '-0001')
+
+        output = btrsnap.snapdeep(test_dir, readonly=False, consistent=True)
+        self.assertTrue(os.path.isdir(first))
+        self.assertIn(timestamp + '-0001', output)
+        self.assertRaises(Exception, btrsnap.snapdeep, test_dir,
+                          consistent=True, jobs=2)
+
+        # cleanup
+        subprocess.call(['btrfs', 'subvolume', 'delete', first])
+
     def test_snapdeep_no_snappaths(self):
         test_dir = self.test_dir
         snap_dir = self.snap_dir
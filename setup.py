@@ -6,6 +6,7 @@ setup(
     entry_points = {
         'console_scripts': [
             'btrsnap = btrsnap.btrsnap:main',
+            'btrsnap-btrfs-sim = btrsnap.btrsnap:simulate',
         ]
     },
 